@@ -27,7 +27,8 @@
 
 # python decorators feel like black magic to me
 @app.app.route('/a1-p/metrics', methods=['GET'])
-def metrics():  # pylint: disable=unused-variable
+def get_metrics():  # pylint: disable=unused-variable
+    # not named metrics, which would hide the a1.metrics module
     # /metrics API shouldn't be visible in the API documentation,
     # hence it's added here in the create_app step
     # requires environment variable prometheus_multiproc_dir
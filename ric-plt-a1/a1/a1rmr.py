@@ -17,18 +17,23 @@
 """
 A1 RMR functionality
 """
+import asyncio
 import os
-import queue
+import random
 import time
 import json
 import requests
-from threading import Thread
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from threading import Thread, Event, Condition
 from ricxappframe.rmr import rmr, helpers
-from mdclogpy import Logger
-from a1 import data, messages
-from a1.exceptions import PolicyTypeNotFound, PolicyInstanceNotFound
+from prometheus_client import Gauge, Counter
+from a1 import data, messages, metrics
+from a1.log import LazyLogger, lazy, LOG_DEBUG_SAMPLE
+from a1.exceptions import PolicyTypeNotFound
 
-mdc_logger = Logger()
+mdc_logger = LazyLogger()
 mdc_logger.mdclog_format_init(configmap_monitor=True)
 
 
@@ -38,6 +43,10 @@
 # and a retry state happened often for even moderately "verbose" applications.
 # With SI95 there is still a possibility that a retry is necessary, but it is very rare.
 RETRY_TIMES = int(os.environ.get("A1_RMR_RETRY_TIMES", 4))
+# how long one receive call blocks waiting for messages; bounds how stale the healthcheck timestamp gets
+RCV_TIMEOUT_MS = int(os.environ.get("A1_RMR_RCV_TIMEOUT_MS", 1000))
+SENDER_THREADS = int(os.environ.get("A1_RMR_SENDER_THREADS", 4))
+SENDER_STOP_TIMEOUT = 5
 A1_POLICY_REQUEST = 20010
 A1_POLICY_RESPONSE = 20011
 A1_POLICY_QUERY = 20012
@@ -49,6 +58,22 @@
 ECS_SERVICE_HOST = os.environ.get("ECS_SERVICE_HOST", "http://ecs-service:8083")
 ESC_EI_TYPE_PATH = ECS_SERVICE_HOST + "/A1-EI/v1/eitypes"
 ECS_EI_JOB_PATH = ECS_SERVICE_HOST + "/A1-EI/v1/eijobs/"
+ECS_TIMEOUT = float(os.environ.get("A1_ECS_TIMEOUT", 5))
+ECS_RETRY_TIMES = int(os.environ.get("A1_ECS_RETRY_TIMES", 3))
+ECS_RETRY_BACKOFF = 0.2
+ECS_THREADS = int(os.environ.get("A1_ECS_THREADS", 4))
+# how long the EI type list fetched from ECS answers A1_EI_QUERY_ALL before it is revalidated
+EI_TYPE_CACHE_TTL = float(os.environ.get("A1_EI_TYPE_CACHE_TTL", 10))
+# if > 0, the EI type list is revalidated in the background this often, so queries never wait for ECS
+EI_TYPE_REFRESH_INTERVAL = float(os.environ.get("A1_EI_TYPE_REFRESH_INTERVAL", 0))
+
+
+a1_send_queue_depth = Gauge('A1RmrSendQueueDepth', 'Messages waiting for an RMR sender thread', ['kind'], multiprocess_mode='livesum')
+a1_rmr_sends = Counter('A1RmrSends', 'RMR sends by kind and final message state', ['kind', 'result'])
+a1_sends_coalesced = Counter('A1RmrSendsCoalesced', 'Queued policy messages superseded before they were sent')
+
+POLICY_WORK = "policy"
+EI_WORK = "ei"
 
 
 # Note; yes, globals are bad, but this is a private (to this module) global
@@ -56,6 +81,280 @@
 __RMR_LOOP__ = None
 
 
+def _coalesce(pending, new):
+    """
+    Merges a queued, not yet sent policy work item with a newer one for the same instance.
+    Answers the single item to send instead of both, or None if neither needs to be sent.
+    Work items are (operation, policy_type_id, policy_instance_id, payload).
+    """
+    pending_op, new_op = pending[0], new[0]
+    if pending_op == "CREATE" and new_op == "DELETE":
+        # the handlers never heard of this instance
+        return None
+    if pending_op == "CREATE":
+        # the handlers still have to learn about the instance, with the latest payload
+        return ("CREATE",) + new[1:]
+    if pending_op == "DELETE" and new_op == "CREATE":
+        # the handlers still have the old instance, so it is replaced rather than created
+        return ("UPDATE",) + new[1:]
+    return new
+
+
+def _observe_send(mtype, started, attempt):
+    """
+    records the time and the retries of one send, which made attempt + 1 attempts
+    """
+    metrics.rmr_send_latency.labels(mtype=mtype).observe(time.perf_counter() - started)
+    metrics.rmr_send_retries.labels(mtype=mtype).observe(attempt)
+
+
+class _CoalescingQueue:
+    """
+    A thread safe FIFO queue in which a newer policy work item replaces the queued one for the
+    same policy instance, so flapping policies cost one send instead of one per update.
+    An item keeps the position of the first queued item it replaced. Items put without a key
+    are never coalesced.
+    """
+
+    def __init__(self):
+        self._items = OrderedDict()
+        self._cond = Condition()
+        self._unique = count()
+
+    def put(self, key, job, coalesce=None):
+        """
+        queue a (kind, work_item) job; coalesce merges two work items, see _coalesce
+        answers the change in the number of queued jobs: 1, 0 (replaced) or -1 (both dropped)
+        """
+        with self._cond:
+            if key is None or coalesce is None:
+                key = ("unique", next(self._unique))
+            elif key in self._items:
+                kind, pending = self._items[key]
+                merged = coalesce(pending, job[1])
+                if merged is None:
+                    del self._items[key]
+                    return -1
+                self._items[key] = (kind, merged)
+                return 0
+            self._items[key] = job
+            self._cond.notify()
+            return 1
+
+    def get(self):
+        """
+        blocks until a job is queued, then answers the oldest one
+        """
+        with self._cond:
+            while not self._items:
+                self._cond.wait()
+            return self._items.popitem(last=False)[1]
+
+    def qsize(self):
+        with self._cond:
+            return len(self._items)
+
+
+class _SenderPool:
+    """
+    A fixed set of long lived sender threads, each with its own queue.
+
+    Work is routed to a thread by key, so all messages about the same policy instance (or ei job)
+    go out in the order they were queued, while a send that blocks on a slow endpoint only holds
+    up the keys that hash to its thread.
+    """
+
+    def __init__(self, handler, size):
+        """
+        handler is called in a sender thread with (kind, work_item) for every submitted item
+        """
+        self.handler = handler
+        self.queues = [_CoalescingQueue() for _ in range(max(size, 1))]
+        self.threads = [
+            Thread(target=self._work, args=(q,), name="a1-rmr-sender-{0}".format(i), daemon=True) for i, q in enumerate(self.queues)
+        ]
+        for t in self.threads:
+            t.start()
+
+    def submit(self, key, kind, work_item, coalesce=None):
+        """
+        queue an item for the thread that owns key
+        if coalesce is given, the item is merged with a queued item of the same key, see _CoalescingQueue
+        """
+        change = self.queues[hash(key) % len(self.queues)].put(key, (kind, work_item), coalesce)
+        a1_send_queue_depth.labels(kind=kind).inc(change)
+        if change < 1:
+            a1_sends_coalesced.inc(1 - change)
+
+    def depth(self):
+        """
+        answers the number of items waiting to be sent
+        """
+        return sum(q.qsize() for q in self.queues)
+
+    def stop(self, timeout=SENDER_STOP_TIMEOUT):
+        """
+        lets the threads finish what is already queued, then stops them
+        """
+        for q in self.queues:
+            q.put(None, None)
+        deadline = time.time() + timeout
+        for t in self.threads:
+            t.join(max(deadline - time.time(), 0))
+
+    def _work(self, q):
+        while True:
+            job = q.get()
+            if job is None:
+                return
+            kind, work_item = job
+            a1_send_queue_depth.labels(kind=kind).dec()
+            try:
+                self.handler(kind, work_item)
+            except Exception as exc:  # a bad item must not kill the sender
+                mdc_logger.error("Failed to send {0} work item {1}: {2}", kind, work_item, exc, key="send_failed")
+
+
+class _EcsClient:
+    """
+    Calls the A1-EI coordinator service (ECS) from a small thread pool, so a slow ECS never blocks
+    the rmr receive loop. Requests share one keep-alive session, time out after ECS_TIMEOUT seconds,
+    and are retried with jittered exponential backoff on connection errors, timeouts and 5xx answers.
+    """
+
+    def __init__(self, threads):
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=threads)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="a1-ecs")
+
+    def submit(self, func, *args):
+        """
+        run func(*args) in the pool
+        """
+        return self.executor.submit(func, *args)
+
+    def request(self, method, url, **kwargs):
+        """
+        answers the response of the last attempt; raises requests.RequestException if the last attempt failed outright
+        """
+        for attempt in range(1, ECS_RETRY_TIMES + 1):
+            try:
+                resp = self.session.request(method, url, timeout=ECS_TIMEOUT, **kwargs)
+                if resp.status_code < 500 or attempt == ECS_RETRY_TIMES:
+                    return resp
+                mdc_logger.debug("ECS answered {0} to {1} {2}, attempt {3}", resp.status_code, method, url, attempt)
+            except requests.RequestException as exc:
+                if attempt == ECS_RETRY_TIMES:
+                    raise
+                mdc_logger.debug("ECS request {0} {1} failed, attempt {2}: {3}", method, url, attempt, exc)
+            time.sleep(random.uniform(0, ECS_RETRY_BACKOFF * 2 ** attempt))
+
+    def stop(self):
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+
+class _EiTypeCatalogue:
+    """
+    The EI type list of ECS, cached as the raw bytes that are sent to xApps.
+
+    A cached list is used for ttl seconds; after that it is revalidated with If-None-Match /
+    If-Modified-Since, so an unchanged list costs ECS a 304. Concurrent callers that find the
+    list stale share a single refresh. If ECS cannot be reached, the last known list keeps being served.
+    """
+
+    def __init__(self, ecs, ttl):
+        self.ecs = ecs
+        self.ttl = ttl
+        self._cond = Condition()
+        self._content = None
+        self._etag = None
+        self._last_modified = None
+        self._fetched_at = 0
+        self._refreshing = False
+
+    def fresh(self):
+        """
+        answers the cached list if it is younger than the ttl, else None; never calls ECS
+        """
+        with self._cond:
+            if self._content is not None and time.time() - self._fetched_at < self.ttl:
+                return self._content
+            return None
+
+    def get(self):
+        """
+        answers the list, refreshing it first if it is stale
+        answers None if the list was never fetched successfully
+        """
+        with self._cond:
+            if self._content is not None and time.time() - self._fetched_at < self.ttl:
+                return self._content
+        return self._refresh_once()
+
+    def _refresh_once(self):
+        """
+        refreshes the list, unless a refresh is already running, in which case it waits for that one
+        answers the list
+        """
+        with self._cond:
+            if self._refreshing:
+                # someone else is already asking ECS; wait for their answer
+                while self._refreshing:
+                    self._cond.wait()
+                return self._content
+            self._refreshing = True
+        try:
+            self.refresh()
+        finally:
+            with self._cond:
+                self._refreshing = False
+                self._cond.notify_all()
+        return self._content
+
+    def refresh(self):
+        """
+        revalidates the list with ECS
+        """
+        headers = {}
+        if self._content is not None:
+            if self._etag:
+                headers["If-None-Match"] = self._etag
+            if self._last_modified:
+                headers["If-Modified-Since"] = self._last_modified
+        try:
+            resp = self.ecs.request("GET", ESC_EI_TYPE_PATH, headers=headers)
+        except requests.RequestException as exc:
+            mdc_logger.warning("Failed to query EI types from A1-EI service: {0}", exc, key="ecs_ei_types")
+            return
+
+        with self._cond:
+            if resp.status_code == 304 and self._content is not None:
+                self._fetched_at = time.time()
+            elif resp.status_code == 200:
+                mdc_logger.debug("response from A1-EI service : {0}", resp.content)
+                self._content = resp.content
+                self._etag = resp.headers.get("ETag")
+                self._last_modified = resp.headers.get("Last-Modified")
+                self._fetched_at = time.time()
+            else:
+                mdc_logger.warning("Received no reponse from A1-EI service", key="ecs_ei_types")
+
+    def refresh_every(self, interval, stopped):
+        """
+        revalidates the list every interval seconds until the stopped event is set, whether it is stale or not,
+        so xApp queries find it fresh; runs in its own thread
+        """
+        while not stopped.is_set():
+            try:
+                self._refresh_once()
+            except Exception as exc:  # the refresher must not die
+                mdc_logger.error("Failed to refresh EI types: {0}", exc, key="ecs_ei_types")
+            stopped.wait(interval)
+
+
 class _RmrLoop:
     """
     Class represents an rmr loop that constantly reads from rmr and performs operations
@@ -65,7 +364,7 @@ class _RmrLoop:
     TODO: the xapp frame has a version of this looping structure. See if A1 can switch to that.
     """
 
-    def __init__(self, init_func_override=None, rcv_func_override=None):
+    def __init__(self, init_func_override=None, rcv_func_override=None, run_in_thread=True):
         """
         Init
 
@@ -78,15 +377,15 @@ def __init__(self, init_func_override=None, rcv_func_override=None):
         rcv_func_override: function (optional)
             Function that receives messages from RMR and answers a list.
             Supply a trivial function to skip reading from RMR.
+
+        run_in_thread: bool (optional)
+            Start the loop in its own thread. If False, the caller runs loop_async as an asyncio task.
         """
         self.keep_going = True
         self.rcv_func = None
+        self.rcv_blocks = rcv_func_override is None
         self.last_ran = time.time()
-
-        # see docs/overview#resiliency for a discussion of this
-        self.instance_send_queue = queue.Queue()  # thread safe queue https://docs.python.org/3/library/queue.html
-        # queue for data delivery item
-        self.ei_job_result_queue = queue.Queue()
+        self.stopped = Event()
 
         # intialize rmr context
         if init_func_override:
@@ -104,42 +403,55 @@ def __init__(self, init_func_override=None, rcv_func_override=None):
         self.rcv_func = (
             rcv_func_override
             if rcv_func_override
-            else lambda: helpers.rmr_rcvall_msgs_raw(self.mrc, [A1_POLICY_RESPONSE, A1_POLICY_QUERY, A1_EI_QUERY_ALL, A1_EI_CREATE_JOB])
+            else lambda: helpers.rmr_rcvall_msgs_raw(self.mrc, [A1_POLICY_RESPONSE, A1_POLICY_QUERY, A1_EI_QUERY_ALL, A1_EI_CREATE_JOB], timeout=RCV_TIMEOUT_MS)
         )
 
-        # start the work loop
-        self.thread = Thread(target=self.loop)
-        self.thread.start()
-
-    def _assert_good_send(self, sbuf, pre_send_summary):
+        # start the senders and the work loop
+        # see docs/overview#resiliency for a discussion of the send queues
+        self.senders = _SenderPool(self._handle_send, SENDER_THREADS)
+        self.ecs = _EcsClient(ECS_THREADS)
+        self.ei_types = _EiTypeCatalogue(self.ecs, EI_TYPE_CACHE_TTL)
+        if EI_TYPE_REFRESH_INTERVAL > 0:
+            Thread(target=self.ei_types.refresh_every, args=(EI_TYPE_REFRESH_INTERVAL, self.stopped), name="a1-ei-types", daemon=True).start()
+        self.task = None
+        self.thread = None
+        if run_in_thread:
+            self.thread = Thread(target=self.loop)
+            self.thread.start()
+
+    def _assert_good_send(self, sbuf):
         """
         Extracts the send result and logs a detailed warning if the send failed.
         Returns the message state, an integer that indicates the result.
+        The state is read from the buffer; a message summary copies the payload, so it is only built to be logged.
         """
-        post_send_summary = rmr.message_summary(sbuf)
-        if post_send_summary[rmr.RMR_MS_MSG_STATE] != rmr.RMR_OK:
-            mdc_logger.warning("RMR send failed; pre-send summary: {0}, post-send summary: {1}".format(pre_send_summary, post_send_summary))
-        return post_send_summary[rmr.RMR_MS_MSG_STATE]
+        msg_state = sbuf.contents.state
+        if msg_state != rmr.RMR_OK:
+            mdc_logger.warning("RMR send failed; post-send summary: {0}", lazy(rmr.message_summary, sbuf), key="rmr_send_failed")
+        return msg_state
 
     def _send_msg(self, pay, mtype, subid):
         """
         Creates and sends a message via RMR's send-message feature with the specified payload
         using the specified message type and subscription ID.
+        Returns the final message state.
         """
+        started = time.perf_counter()
         sbuf = rmr.rmr_alloc_msg(self.mrc, len(pay), payload=pay, gen_transaction_id=True, mtype=mtype, sub_id=subid)
         sbuf.contents.sub_id = subid
-        pre_send_summary = rmr.message_summary(sbuf)
-        for _ in range(0, RETRY_TIMES):
-            mdc_logger.debug("_send_msg: sending: {}".format(pre_send_summary))
+        for attempt in range(0, RETRY_TIMES):
+            mdc_logger.debug("_send_msg: sending: {}", lazy(rmr.message_summary, sbuf), sample=LOG_DEBUG_SAMPLE)
             sbuf = rmr.rmr_send_msg(self.mrc, sbuf)
-            msg_state = self._assert_good_send(sbuf, pre_send_summary)
-            mdc_logger.debug("_send_msg: result message state: {}".format(msg_state))
+            msg_state = self._assert_good_send(sbuf)
+            mdc_logger.debug("_send_msg: result message state: {}", msg_state, sample=LOG_DEBUG_SAMPLE)
             if msg_state != rmr.RMR_ERR_RETRY:
                 break
 
         rmr.rmr_free_msg(sbuf)
+        _observe_send(mtype, started, attempt)
         if msg_state != rmr.RMR_OK:
-            mdc_logger.warning("_send_msg: failed after {} retries".format(RETRY_TIMES))
+            mdc_logger.warning("_send_msg: failed after {} retries", RETRY_TIMES, key="rmr_send_failed_retries")
+        return msg_state
 
     def _rts_msg(self, pay, sbuf_rts, mtype):
         """
@@ -147,139 +459,265 @@ def _rts_msg(self, pay, sbuf_rts, mtype):
         This neither allocates nor frees a message buffer because we may rts many times.
         Returns the message buffer from the RTS function, which may reallocate it.
         """
-        pre_send_summary = rmr.message_summary(sbuf_rts)
-        for _ in range(0, RETRY_TIMES):
-            mdc_logger.debug("_rts_msg: sending: {}".format(pre_send_summary))
+        started = time.perf_counter()
+        for attempt in range(0, RETRY_TIMES):
+            mdc_logger.debug("_rts_msg: sending: {}", lazy(rmr.message_summary, sbuf_rts), sample=LOG_DEBUG_SAMPLE)
             sbuf_rts = rmr.rmr_rts_msg(self.mrc, sbuf_rts, payload=pay, mtype=mtype)
-            msg_state = self._assert_good_send(sbuf_rts, pre_send_summary)
-            mdc_logger.debug("_rts_msg: result message state: {}".format(msg_state))
+            msg_state = self._assert_good_send(sbuf_rts)
+            mdc_logger.debug("_rts_msg: result message state: {}", msg_state, sample=LOG_DEBUG_SAMPLE)
             if msg_state != rmr.RMR_ERR_RETRY:
                 break
 
+        _observe_send(mtype, started, attempt)
         if msg_state != rmr.RMR_OK:
-            mdc_logger.warning("_rts_msg: failed after {} retries".format(RETRY_TIMES))
+            mdc_logger.warning("_rts_msg: failed after {} retries", RETRY_TIMES, key="rmr_send_failed_retries")
         return sbuf_rts  # in some cases rts may return a new sbuf
 
-    def _handle_sends(self):
-        # send out all messages waiting for us
-        while not self.instance_send_queue.empty():
-            work_item = self.instance_send_queue.get(block=False, timeout=None)
-            payload = json.dumps(messages.a1_to_handler(*work_item)).encode("utf-8")
-            self._send_msg(payload, A1_POLICY_REQUEST, work_item[1])
+    def _handle_send(self, kind, work_item):
+        """
+        Sends out one queued message (create instance, delete instance, ei data delivery); called in a sender thread.
 
-        # now send all the ei-job related data
-        while not self.ei_job_result_queue.empty():
+        Sends do not happen in the receive loop because there is a difference between how send works in SI95 vs NNG.
+        Send_msg via NNG formerly never blocked.
+        However under SI95 this send may block for some arbitrary period of time on the first send to an endpoint for which a connection is not established
+        If this send takes too long in the receive loop, that loop blocks, and the healthcheck will fail, which will cause Kubernetes to whack A1 and all kinds of horrible things happen.
+        """
+        if kind == POLICY_WORK:
+            payload = messages.a1_to_handler_bytes(*work_item)
+            msg_state = self._send_msg(payload, A1_POLICY_REQUEST, work_item[1])
+        else:
             mdc_logger.debug("perform data delivery to consumer")
-
-            work_item = self.ei_job_result_queue.get(block=False, timeout=None)
-            payload = json.dumps(messages.ei_to_handler(*work_item)).encode("utf-8")
+            payload = messages.ei_to_handler_bytes(*work_item)
             ei_job_id = int(work_item[0])
-            mdc_logger.debug("data-delivery: {}".format(payload))
+            mdc_logger.debug("data-delivery: {}", payload, sample=LOG_DEBUG_SAMPLE)
 
             # send the payload to consumer subscribed for ei_job_id
-            self._send_msg(payload, A1_EI_DATA_DELIVERY, ei_job_id)
+            msg_state = self._send_msg(payload, A1_EI_DATA_DELIVERY, ei_job_id)
+        a1_rmr_sends.labels(kind=kind, result="ok" if msg_state == rmr.RMR_OK else "failed").inc()
+
+    def _handle_ei_query_all(self, sbuf):
+        """
+        Sends the EI-types of the A1-EI co-ordinator service to the xApp, asking the service only if the cached list is stale.
+        Runs in the ECS thread pool; frees the sbuf.
+        """
+        try:
+            ei_types = self.ei_types.get()
+            if ei_types is not None:
+                # send the complete list of EI-types to xApp
+                sbuf = self._rts_msg(ei_types, sbuf, AI_EI_QUERY_ALL_RESP)
+        finally:
+            rmr.rmr_free_msg(sbuf)
+
+    def _handle_ei_create_job(self, msg, sbuf):
+        """
+        Creates an A1-EI job in the A1-EI co-ordinator service and informs the xApp.
+        Runs in the ECS thread pool; frees the sbuf.
+        """
+        try:
+            payload = json.loads(msg[rmr.RMR_MS_PAYLOAD])
+            mdc_logger.debug("Payload: {0}", payload)
+
+            uuidStr = payload["job-id"]
+            del payload["job-id"]
+
+            mdc_logger.debug("Payload after removing job-id: {0}", payload)
+
+            # 1. send request to A1-EI Service to create A1-EI JOB
+            headers = {'Content-type': 'application/json'}
+            r = self.ecs.request("PUT", ECS_EI_JOB_PATH + uuidStr, data=json.dumps(payload), headers=headers)
+            if (r.status_code != 201) and (r.status_code != 200):
+                mdc_logger.warning("failed to create EIJOB : {0}", r, key="ecs_ei_job")
+            else:
+                # 2. inform xApp for Job status
+                mdc_logger.debug("received successful response (ei-job-id) :{0}", uuidStr)
+                rmr_data = messages.ei_job_created_bytes(uuidStr)
+                mdc_logger.debug("rmr_Data to send: {0}", rmr_data)
+                sbuf = self._rts_msg(rmr_data, sbuf, A1_EI_CREATE_JOB_RESP)
+        except (KeyError, TypeError, json.decoder.JSONDecodeError):
+            mdc_logger.warning("Dropping malformed EI create job request: {0}", msg, key="malformed_ei_job")
+        except requests.RequestException as exc:
+            mdc_logger.warning("Failed to create EIJOB in A1-EI service: {0}", exc, key="ecs_ei_job")
+        finally:
+            rmr.rmr_free_msg(sbuf)
+
+    def receive(self):
+        """
+        Reads a1s mailbox once and handles what arrived: answers policy and ei queries from downstream handlers
+        right away, and answers the status updates (policy_type_id, policy_instance_id, handler_id, status)
+        of the policy responses for record_statuses.
+
+        It blocks in the RMR receive call (up to RCV_TIMEOUT_MS) rather than sleeping, so messages are handled as soon as they arrive.
+        """
+        # status updates are collected and written once per batch of received messages
+        statuses = []
+
+        # read our mailbox
+        received = self.rcv_func()
+        if not received:
+            return statuses
+        started = time.perf_counter()
+        for (msg, sbuf) in received:
+            # TODO: in the future we may also have to catch SDL errors
+            try:
+                mtype = msg[rmr.RMR_MS_MSG_TYPE]
+            except (KeyError, TypeError, json.decoder.JSONDecodeError):
+                mdc_logger.warning("Dropping malformed message: {0}", msg, key="malformed_message")
+                mtype = None
+
+            if mtype == A1_POLICY_RESPONSE:
+                try:
+                    # got a policy response, queue the status update
+                    pay = json.loads(msg[rmr.RMR_MS_PAYLOAD])
+                    statuses.append((pay["policy_type_id"], pay["policy_instance_id"], pay["handler_id"], pay["status"]))
+                except (KeyError, TypeError, json.decoder.JSONDecodeError):
+                    mdc_logger.warning("Dropping malformed policy response: {0}", msg, key="malformed_policy_response")
+
+            elif mtype == A1_POLICY_QUERY:
+                try:
+                    # got a query, do a lookup and send out all instances
+                    pti = json.loads(msg[rmr.RMR_MS_PAYLOAD])["policy_type_id"]
+                    payloads = data.get_policy_query_payloads(pti)  # will raise if a bad type
+                    mdc_logger.debug("Received a query for a known policy type: {0}", msg, sample=LOG_DEBUG_SAMPLE)
+                    for payload in payloads:
+                        sbuf = self._rts_msg(payload, sbuf, A1_POLICY_REQUEST)
+                except (PolicyTypeNotFound):
+                    mdc_logger.warning("Received a policy query for a non-existent type: {0}", msg, key="unknown_policy_query")
+                except (KeyError, TypeError, json.decoder.JSONDecodeError):
+                    mdc_logger.warning("Dropping malformed policy query: {0}", msg, key="malformed_policy_query")
+
+            elif mtype == A1_EI_QUERY_ALL:
+                mdc_logger.debug("Received messaage {0}", msg, sample=LOG_DEBUG_SAMPLE)
+                ei_types = self.ei_types.fresh()
+                if ei_types is not None:
+                    sbuf = self._rts_msg(ei_types, sbuf, AI_EI_QUERY_ALL_RESP)
+                else:
+                    # the ECS thread pool answers the xApp and frees the sbuf when ECS has answered
+                    self.ecs.submit(self._handle_ei_query_all, sbuf)
+                    continue
+
+            elif mtype == A1_EI_CREATE_JOB:
+                mdc_logger.debug("Received message {0}", msg, sample=LOG_DEBUG_SAMPLE)
+                # the ECS thread pool answers the xApp and frees the sbuf when ECS has answered
+                self.ecs.submit(self._handle_ei_create_job, msg, sbuf)
+                continue
+
+            else:
+                mdc_logger.warning("Received message type {0} but A1 does not handle this", mtype, key="unhandled_message_type")
+
+            # we must free each sbuf
+            rmr.rmr_free_msg(sbuf)
+
+        metrics.rmr_loop_latency.labels(stage="receive").observe(time.perf_counter() - started)
+        return statuses
+
+    def record_statuses(self, statuses):
+        """
+        Writes a batch of status updates received by receive
+        """
+        if statuses:
+            with metrics.rmr_loop_latency.labels(stage="statuses").time():
+                rejected = data.set_policy_instance_statuses(statuses)
+            for status in rejected:
+                mdc_logger.warning("Received a response for a non-existent type/instance: {0}", status, key="unknown_policy_response")
+            mdc_logger.debug("Successfully received {0} status updates", len(statuses))
+
+    def _pause(self):
+        """
+        receive functions supplied for testing answer immediately; don't spin on them
+        """
+        if not self.rcv_blocks:
+            self.stopped.wait(RCV_TIMEOUT_MS / 1000)
 
     def loop(self):
         """
-        This loop runs forever, and has 3 jobs:
-        - send out any messages that have to go out (create instance, delete instance)
+        This loop runs forever, and has 2 jobs:
         - read a1s mailbox and update the status of all instances based on acks from downstream policy handlers
-        - clean up the database (eg delete the instance) under certain conditions based on those statuses (NOT DONE YET)
+        - answer policy and ei queries from downstream handlers
         """
         # loop forever
         mdc_logger.debug("Work loop starting")
         while self.keep_going:
+            self.record_statuses(self.receive())
+            self.last_ran = time.time()
+            self._pause()
 
-            # Update 3/20/2020
-            # We now handle our sends in a thread (that will just exit when it's done) because there is a difference between how send works in SI95 vs NNG.
-            # Send_msg via NNG formerly never blocked.
-            # However under SI95 this send may block for some arbitrary period of time on the first send to an endpoint for which a connection is not established
-            # If this send takes too long, this loop blocks, and the healthcheck will fail, which will cause A1s healthcheck to fail, which will cause Kubernetes to whack A1 and all kinds of horrible things happen.
-            # Therefore, now under SI95, we thread this.
-            Thread(target=self._handle_sends).start()
-
-            # read our mailbox
-            for (msg, sbuf) in self.rcv_func():
-                # TODO: in the future we may also have to catch SDL errors
+        mdc_logger.debug("RMR Thread Ending!")
+
+    async def loop_async(self, sdl_call):
+        """
+        The same loop as an asyncio task.
+        Receiving runs in a dedicated thread, since the RMR calls block; status updates are written through
+        sdl_call, a coroutine function that runs a blocking a1.data function without blocking the event loop.
+        An iteration that fails is logged and the loop goes on, so the task only ends when stopped.
+        """
+        mdc_logger.debug("Work loop task starting")
+        event_loop = asyncio.get_event_loop()
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix="a1-rmr-rcv") as rcv_executor:
+            while self.keep_going:
                 try:
-                    mtype = msg[rmr.RMR_MS_MSG_TYPE]
-                except (KeyError, TypeError, json.decoder.JSONDecodeError):
-                    mdc_logger.warning("Dropping malformed message: {0}".format(msg))
-
-                if mtype == A1_POLICY_RESPONSE:
-                    try:
-                        # got a policy response, update status
-                        pay = json.loads(msg[rmr.RMR_MS_PAYLOAD])
-                        data.set_policy_instance_status(
-                            pay["policy_type_id"], pay["policy_instance_id"], pay["handler_id"], pay["status"]
-                        )
-                        mdc_logger.debug("Successfully received status update: {0}".format(pay))
-                    except (PolicyTypeNotFound, PolicyInstanceNotFound):
-                        mdc_logger.warning("Received a response for a non-existent type/instance: {0}".format(msg))
-                    except (KeyError, TypeError, json.decoder.JSONDecodeError):
-                        mdc_logger.warning("Dropping malformed policy response: {0}".format(msg))
-
-                elif mtype == A1_POLICY_QUERY:
-                    try:
-                        # got a query, do a lookup and send out all instances
-                        pti = json.loads(msg[rmr.RMR_MS_PAYLOAD])["policy_type_id"]
-                        instance_list = data.get_instance_list(pti)  # will raise if a bad type
-                        mdc_logger.debug("Received a query for a known policy type: {0}".format(msg))
-                        for pii in instance_list:
-                            instance = data.get_policy_instance(pti, pii)
-                            payload = json.dumps(messages.a1_to_handler("CREATE", pti, pii, instance)).encode("utf-8")
-                            sbuf = self._rts_msg(payload, sbuf, A1_POLICY_REQUEST)
-                    except (PolicyTypeNotFound):
-                        mdc_logger.warning("Received a policy query for a non-existent type: {0}".format(msg))
-                    except (KeyError, TypeError, json.decoder.JSONDecodeError):
-                        mdc_logger.warning("Dropping malformed policy query: {0}".format(msg))
-
-                elif mtype == A1_EI_QUERY_ALL:
-                    mdc_logger.debug("Received messaage {0}".format(msg))
-
-                    # query A1-EI co-ordinator service to get the EI-types
-                    resp = requests.get(ESC_EI_TYPE_PATH)
-                    if resp.status_code != 200:
-                        mdc_logger.warning("Received no reponse from A1-EI service")
-
-                    mdc_logger.debug("response from A1-EI service : {0}".format(resp.json()))
-
-                    # send the complete list of EI-types to xApp
-                    sbuf = self._rts_msg(resp.content, sbuf, AI_EI_QUERY_ALL_RESP)
-
-                elif mtype == A1_EI_CREATE_JOB:
-                    mdc_logger.debug("Received message {0}".format(msg))
-                    payload = json.loads(msg[rmr.RMR_MS_PAYLOAD])
-                    mdc_logger.debug("Payload: {0}".format(payload))
-
-                    uuidStr = payload["job-id"]
-                    del payload["job-id"]
-
-                    mdc_logger.debug("Payload after removing job-id: {0}".format(payload))
-
-                    # 1. send request to A1-EI Service to create A1-EI JOB
-                    headers = {'Content-type': 'application/json'}
-                    r = requests.put(ECS_EI_JOB_PATH + uuidStr, data=json.dumps(payload), headers=headers)
-                    if (r.status_code != 201) and (r.status_code != 200):
-                        mdc_logger.warning("failed to create EIJOB : {0}".format(r))
-                    else:
-                        # 2. inform xApp for Job status
-                        mdc_logger.debug("received successful response (ei-job-id) :{0}".format(uuidStr))
-                        rmr_data = """{{
-                                "ei_job_id": "{id}"
-                                }}""".format(id=uuidStr)
-                        mdc_logger.debug("rmr_Data to send: {0}".format(rmr_data))
-                        sbuf = self._rts_msg(str.encode(rmr_data), sbuf, A1_EI_CREATE_JOB_RESP)
+                    statuses = await event_loop.run_in_executor(rcv_executor, self.receive)
+                    await sdl_call(self.record_statuses, statuses)
+                except Exception as exc:  # keep serving; the healthcheck notices if this repeats
+                    mdc_logger.error("RMR loop iteration failed: {0}", exc, key="rmr_loop_failed")
+                    await asyncio.sleep(RCV_TIMEOUT_MS / 1000)
+                    continue
+                self.last_ran = time.time()
+                if not self.rcv_blocks:
+                    await asyncio.sleep(RCV_TIMEOUT_MS / 1000)
+
+        mdc_logger.debug("RMR Task Ending!")
+
+    def stop(self):
+        """
+        stops the loop, then the senders and the ECS pool
+        """
+        self.keep_going = False
+        self.stopped.set()
+        self.senders.stop()
+        self.ecs.stop()
 
-                else:
-                    mdc_logger.warning("Received message type {0} but A1 does not handle this".format(mtype))
+    def is_alive(self):
+        """
+        answers whether the loop thread or task is still running
+        """
+        if self.task is not None:
+            return not self.task.done()
+        return self.thread is not None and self.thread.is_alive()
 
-                # we must free each sbuf
-                rmr.rmr_free_msg(sbuf)
-            self.last_ran = time.time()
-            time.sleep(1)
 
-        mdc_logger.debug("RMR Thread Ending!")
+class _ForwardingSenders:
+    """
+    Stands in for the sender pool in an http worker process: work is passed to the rmr owning process
+    over channel, a multiprocessing queue, and is queued (and coalesced) there.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def submit(self, key, kind, work_item, coalesce=None):
+        self.channel.put((kind, work_item))
+
+
+class _RmrProxy:
+    """
+    Stands in for the rmr loop in an http worker process of the multi-worker mode (see a1/workers.py),
+    where another process owns rmr. Its health comes from heartbeat, a shared double holding the time
+    the rmr owner was last seen healthy, or 0 if it is not.
+    """
+
+    def __init__(self, channel, heartbeat):
+        self.senders = _ForwardingSenders(channel)
+        self.heartbeat = heartbeat
+
+    @property
+    def last_ran(self):
+        return self.heartbeat.value
+
+    def is_alive(self):
+        return self.heartbeat.value > 0
+
+    def stop(self):
+        pass
 
 
 # Public
@@ -304,27 +742,51 @@ def start_rmr_thread(init_func_override=None, rcv_func_override=None):
         __RMR_LOOP__ = _RmrLoop(init_func_override, rcv_func_override)
 
 
+def start_rmr_task(sdl_call, init_func_override=None, rcv_func_override=None):
+    """
+    Start a1s rmr loop as a task of the running asyncio event loop, see _RmrLoop.loop_async
+    Initializing RMR blocks, so this is called before the event loop serves requests.
+    Answers the task.
+    """
+    global __RMR_LOOP__
+    if __RMR_LOOP__ is None:
+        __RMR_LOOP__ = _RmrLoop(init_func_override, rcv_func_override, run_in_thread=False)
+        __RMR_LOOP__.task = asyncio.ensure_future(__RMR_LOOP__.loop_async(sdl_call))
+    return __RMR_LOOP__.task
+
+
+def forward_rmr(channel, heartbeat):
+    """
+    Used instead of start_rmr_thread in a process that does not own rmr: queued sends are passed to the
+    owner over channel as (kind, work item), and the healthcheck follows the owner's heartbeat, see _RmrProxy
+    """
+    global __RMR_LOOP__
+    if __RMR_LOOP__ is None:
+        __RMR_LOOP__ = _RmrProxy(channel, heartbeat)
+
+
 def stop_rmr_thread():
     """
     stops the rmr thread
     """
-    __RMR_LOOP__.keep_going = False
+    __RMR_LOOP__.stop()
 
 
 def queue_instance_send(item):
     """
     push an item into the work queue
     currently the only type of work is to send out messages
+    an item that is still queued for the same instance is replaced, see _coalesce
     """
-    __RMR_LOOP__.instance_send_queue.put(item)
+    __RMR_LOOP__.senders.submit((POLICY_WORK, item[1], item[2]), POLICY_WORK, item, _coalesce)
 
 
 def queue_ei_job_result(item):
     """
     push an item into the ei_job_queue
     """
-    mdc_logger.debug("queuing data delivery item {0}".format(item))
-    __RMR_LOOP__.ei_job_result_queue.put(item)
+    mdc_logger.debug("queuing data delivery item {0}", item, sample=LOG_DEBUG_SAMPLE)
+    __RMR_LOOP__.senders.submit((EI_WORK, item[0]), EI_WORK, item)
 
 
 def healthcheck_rmr_thread(seconds=30):
@@ -333,9 +795,10 @@ def healthcheck_rmr_thread(seconds=30):
     1. is it running?,
     2. is it stuck in a long (> seconds) loop?
     """
-    return __RMR_LOOP__.thread.is_alive() and ((time.time() - __RMR_LOOP__.last_ran) < seconds)
+    return __RMR_LOOP__.is_alive() and ((time.time() - __RMR_LOOP__.last_ran) < seconds)
 
 
 def replace_rcv_func(rcv_func):
     """purely for the ease of unit testing to test different rcv scenarios"""
+    __RMR_LOOP__.rcv_blocks = False
     __RMR_LOOP__.rcv_func = rcv_func
@@ -0,0 +1,87 @@
+# ==================================================================================
+#       Copyright (c) 2019 Nokia
+#       Copyright (c) 2018-2019 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+asyncio server mode (A1_SERVER_MODE=asyncio)
+
+The API is served by uvicorn on one asyncio event loop, so idle and slow client connections cost
+no thread. The connexion app is unchanged: requests are handed to it through a WSGI adapter that runs
+handlers on a bounded pool of A1_HTTP_THREADS threads. The rmr loop runs as a task of the same event
+loop, and its SDL writes go through AsyncSDL, which bounds the blocking SDL calls to A1_SDL_THREADS.
+
+uvicorn and a2wsgi are only needed in this mode; see setup.py extras.
+"""
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from mdclogpy import Logger
+from a1 import app
+from a1 import a1rmr, data
+
+
+mdc_logger = Logger(name=__name__)
+mdc_logger.mdclog_format_init(configmap_monitor=True)
+
+HTTP_THREADS = int(os.environ.get("A1_HTTP_THREADS", 32))
+SDL_THREADS = int(os.environ.get("A1_SDL_THREADS", 8))
+
+
+class AsyncSDL:
+    """
+    Runs the blocking a1.data functions on a bounded thread pool, so coroutines can await them
+    without blocking the event loop, and a burst of work cannot open more SDL calls than there are threads.
+    """
+
+    def __init__(self, threads):
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="a1-sdl")
+
+    async def call(self, func, *args, **kwargs):
+        """
+        answers func(*args, **kwargs), run in the pool
+        """
+        return await asyncio.get_event_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def stop(self):
+        self.executor.shutdown(wait=False)
+
+
+async def _serve(port):
+    sdl = AsyncSDL(SDL_THREADS)
+    # index sets and value encoding, before anything reads the database
+    await sdl.call(data.prepare_database)
+    mdc_logger.debug("RMR initialization must complete before webserver can start")
+    a1rmr.start_rmr_task(sdl.call)
+    mdc_logger.debug("RMR initialization complete")
+    # pick up instance deletions that were still pending when A1 last stopped
+    mdc_logger.debug("Resumed {0} pending instance deletions".format(await sdl.call(data.resume_pending_deletions)))
+
+    mdc_logger.debug("Starting asyncio webserver on port {0}".format(port))
+    config = uvicorn.Config(WSGIMiddleware(app, workers=HTTP_THREADS), host="0.0.0.0", port=port, lifespan="off", access_log=False)
+    try:
+        await uvicorn.Server(config).serve()
+    finally:
+        a1rmr.stop_rmr_thread()
+        sdl.stop()
+
+
+def serve(port):
+    """
+    serves the A1 API on port until the process is told to stop
+    """
+    asyncio.run(_serve(port))
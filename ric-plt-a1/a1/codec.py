@@ -0,0 +1,174 @@
+# ==================================================================================
+#       Copyright (c) 2019 Nokia
+#       Copyright (c) 2018-2019 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+Encoding of the values A1 stores in SDL.
+
+A1 used to store every value as plain msgpack, so each metadata blob repeats the names of its
+fields. The compact codec replaces the names of A1's own fields by small numbers and, if the
+zstandard package is installed, compresses large values. Compact values start with a byte that
+msgpack never uses, so every codec reads plain msgpack as well and existing databases keep
+working; values are rewritten in the configured encoding at startup, see a1.data.prepare_database,
+and when they are next written.
+"""
+import os
+import threading
+import msgpack
+
+try:
+    import zstandard
+except ImportError:  # optional; see setup.py extras
+    zstandard = None
+
+# msgpack (what A1 wrote before codecs, readable by older A1s) or compact, which only A1s with codecs can read,
+# so it is only safe once every replica sharing the database runs this version
+SDL_CODEC = os.environ.get("A1_SDL_CODEC", "msgpack")
+# compact values of at least this many bytes are compressed, if zstandard is installed; 0 never compresses
+SDL_COMPRESS_MIN = int(os.environ.get("A1_SDL_COMPRESS_MIN", 1024))
+SDL_COMPRESS_LEVEL = int(os.environ.get("A1_SDL_COMPRESS_LEVEL", 3))
+
+# 0xc1 is the one byte msgpack never uses, so no msgpack value starts with it
+_MARKER = b"\xc1"
+_COMPACT = b"\x01"
+_COMPACT_ZSTD = b"\x02"
+
+# Field names that are stored as their index in this tuple. Indexes are stored in SDL,
+# so names can only ever be appended.
+FIELDS = (
+    # instance metadata
+    "created_at",
+    "has_been_deleted",
+    "deleted_at",
+    "version",
+    "last_modified",
+    "handlers_ok",
+    "handlers_total",
+    "status_updated_at",
+    "write_id",
+    # policy types
+    "name",
+    "description",
+    "policy_type_id",
+    "create_schema",
+    # instance metadata, added later
+    "content_version",
+)
+_FIELD_INDEXES = {name: i for i, name in enumerate(FIELDS)}
+
+# zstandard compressors and decompressors must not be shared between threads
+_local = threading.local()
+
+
+def _compressor():
+    compressor = getattr(_local, "compressor", None)
+    if compressor is None:
+        compressor = _local.compressor = zstandard.ZstdCompressor(level=SDL_COMPRESS_LEVEL)
+    return compressor
+
+
+def _decompressor():
+    decompressor = getattr(_local, "decompressor", None)
+    if decompressor is None:
+        decompressor = _local.decompressor = zstandard.ZstdDecompressor()
+    return decompressor
+
+
+def _compact(value):
+    """
+    answers value with the top level field names in FIELDS replaced by their indexes,
+    or None if there is nothing to replace
+    """
+    if not isinstance(value, dict) or not any(k in _FIELD_INDEXES for k in value):
+        return None
+    return {_FIELD_INDEXES.get(k, k): v for k, v in value.items()}
+
+
+def _expand(value):
+    """
+    the reverse of _compact; A1 values never have integer keys of their own, they come from JSON
+    """
+    if not isinstance(value, dict):
+        return value
+    return {FIELDS[k] if isinstance(k, int) and 0 <= k < len(FIELDS) else k: v for k, v in value.items()}
+
+
+def decode(packed):
+    """
+    answers the value of packed, in any of the encodings
+    """
+    if packed[:1] != _MARKER:
+        return msgpack.unpackb(packed, raw=False)
+    kind, body = packed[1:2], packed[2:]
+    if kind == _COMPACT_ZSTD:
+        if zstandard is None:
+            raise ValueError("value is compressed with zstd, but the zstandard package is not installed")
+        body = _decompressor().decompress(body)
+    elif kind != _COMPACT:
+        raise ValueError("unknown value encoding {0!r}".format(kind))
+    return _expand(msgpack.unpackb(body, raw=False, strict_map_key=False))
+
+
+class MsgpackCodec:
+    """
+    plain msgpack, the way A1 stored values before codecs
+    """
+
+    name = "msgpack"
+
+    def encode(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, packed):
+        return decode(packed)
+
+
+class CompactCodec:
+    """
+    msgpack with the field names in FIELDS numbered, compressed with zstd from compress_min bytes on.
+    Values that have none of those fields and are not compressed are plain msgpack.
+    """
+
+    name = "compact"
+
+    def __init__(self, compress_min=SDL_COMPRESS_MIN):
+        self.compress_min = compress_min if zstandard is not None else 0
+
+    def encode(self, value):
+        compacted = _compact(value)
+        packed = msgpack.packb(value if compacted is None else compacted, use_bin_type=True)
+        if self.compress_min and len(packed) >= self.compress_min:
+            compressed = _compressor().compress(packed)
+            if len(compressed) + 2 < len(packed):
+                return _MARKER + _COMPACT_ZSTD + compressed
+        if compacted is None:
+            return packed
+        return _MARKER + _COMPACT + packed
+
+    def decode(self, packed):
+        return decode(packed)
+
+
+CODECS = {MsgpackCodec.name: MsgpackCodec, CompactCodec.name: CompactCodec}
+
+
+def get_codec(name=SDL_CODEC):
+    """
+    answers the codec called name
+    """
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise ValueError("unknown A1_SDL_CODEC {0}, expected one of {1}".format(name, ", ".join(sorted(CODECS)))) from None
@@ -17,27 +17,38 @@
 """
 Main a1 controller
 """
-from jsonschema import validate
+import base64
+import binascii
+import calendar
+import collections
+import itertools
+import time
+import urllib.parse
 from jsonschema.exceptions import ValidationError
 import connexion
+import flask
+from werkzeug.http import http_date, quote_etag
 from prometheus_client import Counter
-from mdclogpy import Logger
+from a1.log import LazyLogger
 from ricsdl.exceptions import RejectedByBackend, NotConnected, BackendError
-from a1 import a1rmr, exceptions, data
+from a1 import a1rmr, exceptions, data, messages, metrics, validation
 
 
-mdc_logger = Logger(name=__name__)
+mdc_logger = LazyLogger(name=__name__)
 mdc_logger.mdclog_format_init(configmap_monitor=True)
 
 a1_counters = Counter('A1Policy', 'Policy type and instance counters', ['counter'])
 
+# ids encoded at a time when a list is streamed
+LIST_STREAM_CHUNK = 1000
+
 
 def _log_build_http_resp(exception, http_resp_code):
     """
     helper method that logs the exception and returns a tuple of (str, int) as a http response
     """
     msg = repr(exception)
-    mdc_logger.warning("Request failed, returning {0}: {1}".format(http_resp_code, msg))
+    mdc_logger.warning("Request failed, returning {0}: {1}", http_resp_code, msg, key="request_failed")
     return msg, http_resp_code
 
 
@@ -51,6 +62,10 @@ def _try_func_return(func):
         return _log_build_http_resp(exc, 400)
     except (exceptions.PolicyTypeNotFound, exceptions.PolicyInstanceNotFound) as exc:
         return _log_build_http_resp(exc, 404)
+    except exceptions.PolicyInstanceConflict as exc:
+        return _log_build_http_resp(exc, 409)
+    except exceptions.PolicyInstancePreconditionFailed as exc:
+        return _log_build_http_resp(exc, 412)
     except (RejectedByBackend, NotConnected, BackendError) as exc:
         """
         These are SDL errors. At the time of development here, we do not have a good understanding
@@ -65,6 +80,43 @@ def _try_func_return(func):
     # let other types of unexpected exceptions blow up and log
 
 
+def _conditional(etag, last_modified, func):
+    """
+    helper method for conditional GETs: answers 304 Not Modified if the request's If-None-Match or
+    If-Modified-Since header shows that the client already has this version, otherwise func's response.
+    Either way the response carries the ETag (and Last-Modified, if given) of the version.
+    """
+    headers = {"ETag": quote_etag(etag)}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+
+    request = connexion.request
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    else:
+        # http dates have a resolution of seconds
+        since = request.if_modified_since
+        not_modified = last_modified is not None and since is not None and int(last_modified) <= calendar.timegm(since.utctimetuple())
+    if not_modified:
+        return "", 304, headers
+    resp = func()
+    if isinstance(resp, flask.Response):
+        resp.headers.extend(headers)
+        return resp
+    return resp, 200, headers
+
+
+def _if_match():
+    """
+    answers the entity tags of the request's If-Match header as a set, in which "*" stands for any,
+    or None if the request has no If-Match header
+    """
+    etags = connexion.request.if_match
+    if etags.star_tag:
+        return {"*"}
+    return etags.as_set() or None
+
+
 # Healthcheck
 
 
@@ -92,7 +144,8 @@ def get_all_policy_types():
     """
     Handles GET /a1-p/policytypes
     """
-    return _try_func_return(data.get_type_list)
+    with metrics.request_latency.labels(operation="get_all_policy_types").time():
+        return _try_func_return(data.get_type_list)
 
 
 def create_policy_type(policy_type_id):
@@ -103,18 +156,20 @@ def create_policy_type(policy_type_id):
 
     def put_type_handler():
         data.store_policy_type(policy_type_id, body)
-        mdc_logger.debug("Policy type {} created.".format(policy_type_id))
+        mdc_logger.debug("Policy type {} created.", policy_type_id)
         return "", 201
 
-    body = connexion.request.json
-    return _try_func_return(put_type_handler)
+    with metrics.request_latency.labels(operation="create_policy_type").time():
+        body = connexion.request.json
+        return _try_func_return(put_type_handler)
 
 
 def get_policy_type(policy_type_id):
     """
     Handles GET /a1-p/policytypes/policy_type_id
     """
-    return _try_func_return(lambda: data.get_policy_type(policy_type_id))
+    with metrics.request_latency.labels(operation="get_policy_type").time():
+        return _try_func_return(lambda: _conditional(data.get_policy_type_etag(policy_type_id), None, lambda: data.get_policy_type(policy_type_id)))
 
 
 def delete_policy_type(policy_type_id):
@@ -125,27 +180,131 @@ def delete_policy_type(policy_type_id):
 
     def delete_policy_type_handler():
         data.delete_policy_type(policy_type_id)
-        mdc_logger.debug("Policy type {} deleted.".format(policy_type_id))
+        validation.evict(policy_type_id)
+        mdc_logger.debug("Policy type {} deleted.", policy_type_id)
         return "", 204
 
-    return _try_func_return(delete_policy_type_handler)
+    with metrics.request_latency.labels(operation="delete_policy_type").time():
+        return _try_func_return(delete_policy_type_handler)
 
 
 # Policy instances
 
 
-def get_all_instances_for_type(policy_type_id):
+def _encode_cursor(policy_instance_id):
+    return base64.urlsafe_b64encode(policy_instance_id.encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor):
+    """
+    answers the policy instance id in a cursor; raises ValueError if it is not a cursor
+    """
+    try:
+        return base64.b64decode(cursor.encode("ascii"), altchars=b"-_", validate=True).decode("utf-8")
+    except (binascii.Error, UnicodeError) as exc:
+        raise ValueError("invalid cursor {0}".format(cursor)) from exc
+
+
+def _stream_json_list(first, rest):
+    """
+    yields the JSON encoding of the list of the items in first (a list) and then rest (an iterator),
+    a chunk at a time, so long lists are never held in memory as one string
+    """
+    yield b"["
+    chunk, separator = first, b""
+    while chunk:
+        yield separator + messages.dumps(chunk)[1:-1]
+        chunk, separator = list(itertools.islice(rest, LIST_STREAM_CHUNK)), b","
+    yield b"]"
+
+
+def _json_list_response(items, headers=None):
+    """
+    answers a response that streams the JSON list of items. The first chunk is read right away,
+    so if reading it fails, the request is answered like any other failed request.
+    """
+    items = iter(items)
+    first = list(itertools.islice(items, LIST_STREAM_CHUNK))
+    return flask.Response(_stream_json_list(first, items), 200, headers, mimetype="application/json")
+
+
+def _finish_stream(chunks, operation, started):
+    """
+    yields the chunks of a streamed response, then records how long the request took.
+    If reading the rest of the items fails, the error is logged and raised to the web server, which then
+    closes the connection without ending the body, so clients cannot take the partial list for a whole one.
+    """
+    try:
+        yield from chunks
+    except Exception as exc:
+        mdc_logger.error("Streaming the response of {0} failed, aborting it: {1!r}", operation, exc, key="stream_failed")
+        raise
+    finally:
+        metrics.request_latency.labels(operation=operation).observe(time.perf_counter() - started)
+
+
+def _try_func_stream(operation, func):
+    """
+    helper method that runs func like _try_func_return and records how long the request took.
+    A streamed response is timed until its last chunk is sent, see _finish_stream.
+    """
+    started = time.perf_counter()
+    try:
+        resp = _try_func_return(func)
+    except Exception:
+        metrics.request_latency.labels(operation=operation).observe(time.perf_counter() - started)
+        raise
+    if isinstance(resp, flask.Response) and resp.is_streamed:
+        resp.response = _finish_stream(resp.response, operation, started)
+    else:
+        metrics.request_latency.labels(operation=operation).observe(time.perf_counter() - started)
+    return resp
+
+
+def get_all_instances_for_type(policy_type_id, limit=None, cursor=None, status=None, created_after=None, created_before=None):
     """
     Handles GET /a1-p/policytypes/policy_type_id/policies
+
+    Answers the instance ids in order. With limit, answers at most limit ids and, if there are more,
+    a Link header (rel="next") to the next page, which continues after the cursor.
+    The ids can be filtered by instance status and creation time.
     """
-    return _try_func_return(lambda: data.get_instance_list(policy_type_id))
+
+    try:
+        after = None if cursor is None else _decode_cursor(cursor)
+    except ValueError as exc:
+        return _log_build_http_resp(exc, 400)
+
+    def list_handler():
+        ids = data.iter_instance_list(policy_type_id, after, status, created_after, created_before)
+
+        headers = {}
+        if limit is not None:
+            page = list(itertools.islice(ids, limit + 1))
+            if len(page) > limit:
+                page = page[:limit]
+                args = dict(connexion.request.args, cursor=_encode_cursor(page[-1]))
+                headers["Link"] = '<{0}?{1}>; rel="next"'.format(connexion.request.path, urllib.parse.urlencode(args))
+            ids = page
+        return _json_list_response(ids, headers)
+
+    if status is None and created_after is None and created_before is None:
+        # membership alone decides the answer, so the list version tells whether it changed
+        return _try_func_stream("get_all_instances_for_type", lambda: _conditional(data.get_instance_list_etag(policy_type_id), None, list_handler))
+    return _try_func_stream("get_all_instances_for_type", list_handler)
 
 
 def get_policy_instance(policy_type_id, policy_instance_id):
     """
     Handles GET /a1-p/policytypes/polidyid/policies/policy_instance_id
     """
-    return _try_func_return(lambda: data.get_policy_instance(policy_type_id, policy_instance_id))
+
+    def get_instance_handler():
+        etag, last_modified = data.get_policy_instance_version(policy_type_id, policy_instance_id)
+        return _conditional(etag, last_modified, lambda: data.get_policy_instance(policy_type_id, policy_instance_id))
+
+    with metrics.request_latency.labels(operation="get_policy_instance").time():
+        return _try_func_return(get_instance_handler)
 
 
 def get_policy_instance_status(policy_type_id, policy_instance_id):
@@ -157,7 +316,28 @@ def get_policy_instance_status(policy_type_id, policy_instance_id):
         2. if a1 has received at least one status and at least one is OK, we return "IN EFFECT"
         3. "NOT IN EFFECT" otherwise (no statuses, or none are OK but not all are deleted)
     """
-    return _try_func_return(lambda: data.get_policy_instance_status(policy_type_id, policy_instance_id))
+
+    def get_status_handler():
+        etag, last_modified = data.get_policy_instance_status_version(policy_type_id, policy_instance_id)
+        return _conditional(etag, last_modified, lambda: data.get_policy_instance_status(policy_type_id, policy_instance_id))
+
+    with metrics.request_latency.labels(operation="get_policy_instance_status").time():
+        return _try_func_return(get_status_handler)
+
+
+def get_policy_instance_statuses(policy_type_id, policy_instance_id=None):
+    """
+    Handles GET /a1-p/policytypes/policy_type_id/policies:status
+
+    Returns the aggregated status of every instance of the type, or of the instances asked for, computed as
+    in get_policy_instance_status
+    """
+
+    def statuses_handler():
+        statuses = data.iter_policy_instance_statuses(policy_type_id, policy_instance_id)
+        return _json_list_response(statuses)
+
+    return _try_func_stream("get_policy_instance_statuses", statuses_handler)
 
 
 def create_or_replace_policy_instance(policy_type_id, policy_instance_id):
@@ -165,7 +345,6 @@ def create_or_replace_policy_instance(policy_type_id, policy_instance_id):
     Handles PUT /a1-p/policytypes/polidyid/policies/policy_instance_id
     """
     a1_counters.labels(counter='CreatePolicyInstanceReqs').inc()
-    instance = connexion.request.json
 
     def put_instance_handler():
         """
@@ -175,17 +354,66 @@ def put_instance_handler():
         """
         #  validate the PUT against the schema
         schema = data.get_policy_type(policy_type_id)["create_schema"]
-        validate(instance=instance, schema=schema)
+        validation.validate_instance(policy_type_id, schema, instance)
 
-        # store the instance
-        operation = data.store_policy_instance(policy_type_id, policy_instance_id, instance)
+        # store the instance, if it still has the version the client expects
+        operation = data.store_policy_instance(policy_type_id, policy_instance_id, instance, _if_match())
 
-        # queue rmr send (best effort)
-        a1rmr.queue_instance_send((operation, policy_type_id, policy_instance_id, instance))
+        # queue rmr send (best effort); the body is sent as received, it does not need to be encoded again
+        a1rmr.queue_instance_send((operation, policy_type_id, policy_instance_id, connexion.request.get_data()))
 
         return "", 202
 
-    return _try_func_return(put_instance_handler)
+    with metrics.request_latency.labels(operation="create_or_replace_policy_instance").time():
+        instance = connexion.request.json
+        return _try_func_return(put_instance_handler)
+
+
+def create_or_replace_policy_instances(policy_type_id):
+    """
+    Handles POST /a1-p/policytypes/polidyid/policies:batch
+    """
+    a1_counters.labels(counter='CreatePolicyInstanceBatchReqs').inc()
+
+    def batch_handler():
+        """
+        Validates every item, stores the valid ones with one batch and queues their rmr sends
+        """
+        schema = data.get_policy_type(policy_type_id)["create_schema"]
+
+        # an id given twice is ambiguous, so none of its items is stored
+        counts = collections.Counter(item["policy_instance_id"] for item in items)
+        results = []
+        instances = {}
+        for item in items:
+            policy_instance_id = item["policy_instance_id"]
+            if counts[policy_instance_id] > 1:
+                results.append({"policy_instance_id": policy_instance_id, "status": 400, "detail": "policy_instance_id is given more than once"})
+                continue
+            try:
+                validation.validate_instance(policy_type_id, schema, item["payload"])
+            except ValidationError as exc:
+                results.append({"policy_instance_id": policy_instance_id, "status": 400, "detail": exc.message})
+                continue
+            instances[policy_instance_id] = item["payload"]
+            results.append({"policy_instance_id": policy_instance_id, "status": 202})
+
+        # store the instances; those that other writers kept changing are left out
+        operations = data.store_policy_instances(policy_type_id, instances)
+        for result in results:
+            if result["status"] == 202 and result["policy_instance_id"] not in operations:
+                result.update(status=409, detail="the instance kept being changed by other writers; try again")
+
+        # queue rmr sends (best effort)
+        for policy_instance_id, operation in operations.items():
+            a1rmr.queue_instance_send((operation, policy_type_id, policy_instance_id, instances[policy_instance_id]))
+
+        mdc_logger.debug("Batch for policy type {0}: {1} of {2} instances accepted", policy_type_id, len(operations), len(items))
+        return results, 200
+
+    with metrics.request_latency.labels(operation="create_or_replace_policy_instances").time():
+        items = connexion.request.json
+        return _try_func_return(batch_handler)
 
 
 def delete_policy_instance(policy_type_id, policy_instance_id):
@@ -195,14 +423,15 @@ def delete_policy_instance(policy_type_id, policy_instance_id):
     a1_counters.labels(counter='DeletePolicyInstanceReqs').inc()
 
     def delete_instance_handler():
-        data.delete_policy_instance(policy_type_id, policy_instance_id)
+        data.delete_policy_instance(policy_type_id, policy_instance_id, _if_match())
 
         # queue rmr send (best effort)
         a1rmr.queue_instance_send(("DELETE", policy_type_id, policy_instance_id, ""))
 
         return "", 202
 
-    return _try_func_return(delete_instance_handler)
+    with metrics.request_latency.labels(operation="delete_policy_instance").time():
+        return _try_func_return(delete_instance_handler)
 
 
 # data delivery
@@ -214,10 +443,11 @@ def data_delivery():
     """
 
     def data_delivery_handler():
-        mdc_logger.debug("data: {}".format(connexion.request.json))
+        mdc_logger.debug("data: {}", connexion.request.json)
         ei_job_result_json = connexion.request.json
-        mdc_logger.debug("jobid: {}".format(ei_job_result_json.get("job")))
-        a1rmr.queue_ei_job_result((ei_job_result_json.get("job"), ei_job_result_json))
+        mdc_logger.debug("jobid: {}", ei_job_result_json.get("job"))
+        a1rmr.queue_ei_job_result((ei_job_result_json.get("job"), connexion.request.get_data()))
         return "", 200
 
-    return _try_func_return(data_delivery_handler)
+    with metrics.request_latency.labels(operation="data_delivery").time():
+        return _try_func_return(data_delivery_handler)
@@ -17,30 +17,199 @@
 """
 Represents A1s database and database access functions.
 """
+import bisect
 import distutils.util
+import hashlib
+import heapq
+import json
 import os
 import time
-from threading import Thread
-from mdclogpy import Logger
-from ricxappframe.xapp_sdl import SDLWrapper
+import uuid
+from collections import OrderedDict
+from threading import Thread, Lock, Condition
+from a1.log import LazyLogger
+from ricsdl.syncstorage import SyncStorage
+from ricsdl.exceptions import RejectedByBackend, NotConnected, BackendError
+from a1 import codec, messages, metrics
+from a1.sdl import SDLClient
 from a1.exceptions import PolicyTypeNotFound, PolicyInstanceNotFound, PolicyTypeAlreadyExists, PolicyTypeIdMismatch, CantDeleteNonEmptyType
+from a1.exceptions import PolicyInstancePreconditionFailed, PolicyInstanceConflict
 
 # constants
 INSTANCE_DELETE_NO_RESP_TTL = int(os.environ.get("INSTANCE_DELETE_NO_RESP_TTL", 5))
 INSTANCE_DELETE_RESP_TTL = int(os.environ.get("INSTANCE_DELETE_RESP_TTL", 5))
+INSTANCE_DELETE_RETRY_DELAY = 1
+# deletions that fail unexpectedly this many times in a row are left to resume_pending_deletions
+INSTANCE_DELETE_MAX_ERRORS = 10
 USE_FAKE_SDL = bool(distutils.util.strtobool(os.environ.get("USE_FAKE_SDL", "False")))
 A1NS = "A1m_ns"
 TYPE_PREFIX = "a1.policy_type."
 INSTANCE_PREFIX = "a1.policy_instance."
 METADATA_PREFIX = "a1.policy_inst_metadata."
 HANDLER_PREFIX = "a1.policy_handler."
+TYPE_GENERATION_KEY = "a1.policy_type_generation"
+# Index sets (SDL groups); their names must not start with any of the key prefixes above.
+# SDL has no transaction spanning keys and groups, so the sets are not updated atomically with the keys:
+# ids are added after their keys are written and removed after their keys are deleted. A plain listing may
+# briefly show an id whose keys were just deleted; the status and query readers skip such ids. Every write
+# of an instance adds its id again, so retrying a write that failed in between repairs the set.
+TYPE_SET = "a1.policy_types"
+INSTANCE_SET_PREFIX = "a1.policy_instances."
+HANDLER_SET_PREFIX = "a1.policy_handlers."
+INDEX_VERSION_KEY = "a1.index_version"
+# the name of the codec the stored values were last re-encoded with, see _reencode_values
+VALUE_CODEC_KEY = "a1.value_codec"
+# instances whose metadata and statuses are read with one multi-get when a listing is filtered
+LIST_CHUNK_SIZE = 500
+# per type, a token that changes whenever an instance of the type is created or finally deleted
+LIST_VERSION_PREFIX = "a1.policy_instance_list_version."
+INDEX_VERSION = 1
+TYPE_CACHE_SIZE = int(os.environ.get("A1_TYPE_CACHE_SIZE", 1000))
+TYPE_CACHE_TTL = float(os.environ.get("A1_TYPE_CACHE_TTL", 30))
+TYPE_CACHE_GENERATION_CHECK = float(os.environ.get("A1_TYPE_CACHE_GENERATION_CHECK", 1))
+# how many times a write of instance metadata is retried when another writer changed it first
+INSTANCE_WRITE_RETRIES = int(os.environ.get("A1_INSTANCE_WRITE_RETRIES", 10))
 
 
-mdc_logger = Logger(name=__name__)
+mdc_logger = LazyLogger(name=__name__)
 mdc_logger.mdclog_format_init(configmap_monitor=True)
 if USE_FAKE_SDL:
     mdc_logger.debug("Using fake SDL")
-SDL = SDLWrapper(use_fake_sdl=USE_FAKE_SDL)
+# the SDL storage A1 uses, in memory with USE_FAKE_SDL; every call is timed, see a1/metrics.py
+SDL = metrics.TimedSDL(SDLClient(storage=SyncStorage(fake_db_backend="dict") if USE_FAKE_SDL else SyncStorage()))
+# types, instances, metadata and handler statuses are encoded with this codec, see a1/codec.py;
+# set members and the version tokens are msgpack, encoded by SDLClient
+_codec = codec.get_codec()
+
+
+class _TypeCache:
+    """
+    Bounded, time limited, write-through cache of policy types.
+
+    Types are read on every instance operation but change very rarely, so this saves an SDL
+    round trip on almost every request. Entries expire after ttl seconds and the least recently
+    used entry is evicted once max_size is reached; a max_size or ttl of 0 disables caching.
+
+    Other A1 replicas share the SDL backend but not this cache. Whenever a type is deleted a new
+    generation token is written to SDL; every replica re-reads that token at most once per
+    generation_check seconds and drops its whole cache when the token has changed.
+    """
+
+    def __init__(self, max_size, ttl, generation_check):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.generation_check = generation_check
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._generation = None
+        self._generation_checked_at = 0
+
+    def _enabled(self):
+        return self.max_size > 0 and self.ttl > 0
+
+    def _check_generation(self):
+        """
+        drop everything if another replica has invalidated types since we last looked
+        """
+        now = time.time()
+        if now - self._generation_checked_at < self.generation_check:
+            return
+        self._generation_checked_at = now
+        generation = SDL.get(A1NS, TYPE_GENERATION_KEY)
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self._generation = generation
+
+    def get(self, policy_type_id):
+        """
+        answers the cached type body, or None on a miss
+        """
+        if not self._enabled():
+            return None
+        self._check_generation()
+        with self._lock:
+            entry = self._entries.get(policy_type_id)
+            if entry is None:
+                return None
+            body, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[policy_type_id]
+                return None
+            self._entries.move_to_end(policy_type_id)
+            return body
+
+    def put(self, policy_type_id, body):
+        """
+        caches a type body that was just read from or written to SDL
+        """
+        if not self._enabled():
+            return
+        with self._lock:
+            self._entries[policy_type_id] = (body, time.time() + self.ttl)
+            self._entries.move_to_end(policy_type_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, policy_type_id):
+        """
+        drops a type locally and tells the other replicas to drop their caches
+        """
+        generation = uuid.uuid4().hex
+        SDL.set(A1NS, TYPE_GENERATION_KEY, generation)
+        with self._lock:
+            # we may have missed a generation change from another replica, so start over
+            self._entries.clear()
+            self._generation = generation
+            self._generation_checked_at = time.time()
+
+
+_type_cache = _TypeCache(TYPE_CACHE_SIZE, TYPE_CACHE_TTL, TYPE_CACHE_GENERATION_CHECK)
+
+
+class _QuerySnapshot:
+    """
+    Per policy type, the CREATE messages that answer an A1_POLICY_QUERY, already serialised.
+
+    When an xApp restarts it queries all instances of a type; serialising thousands of instances
+    for every restarting pod is wasted work since they rarely change in between.
+    Each message is stored next to the packed SDL value it was built from and only served
+    if SDL still holds exactly those bytes, so a change made by another A1 replica is never missed.
+    Entries are dropped when this process stores or deletes the instance.
+    """
+
+    def __init__(self):
+        self._types = {}
+        self._lock = Lock()
+
+    def get(self, policy_type_id, policy_instance_id, packed):
+        """
+        answers the serialised message, or None if there is none for exactly this packed value
+        """
+        entry = self._types.get(policy_type_id, {}).get(policy_instance_id)
+        if entry is not None and entry[0] == packed:
+            return entry[1]
+        return None
+
+    def put(self, policy_type_id, policy_instance_id, packed, payload):
+        with self._lock:
+            self._types.setdefault(policy_type_id, {})[policy_instance_id] = (packed, payload)
+
+    def discard(self, policy_type_id, policy_instance_ids):
+        with self._lock:
+            instances = self._types.get(policy_type_id, {})
+            for policy_instance_id in policy_instance_ids:
+                instances.pop(policy_instance_id, None)
+
+    def drop_type(self, policy_type_id):
+        with self._lock:
+            self._types.pop(policy_type_id, None)
+
+
+_query_snapshot = _QuerySnapshot()
+
+# policy_type_id -> (body, entity tag); see get_policy_type_etag
+_type_etags = {}
 
 # Internal helpers
 
@@ -80,11 +249,261 @@ def _generate_handler_key(policy_type_id, policy_instance_id, handler_id):
     return "{0}{1}".format(_generate_handler_prefix(policy_type_id, policy_instance_id), handler_id)
 
 
+def _generate_instance_set(policy_type_id):
+    """
+    generate the name of the set of instance ids of a type
+    """
+    return "{0}{1}".format(INSTANCE_SET_PREFIX, policy_type_id)
+
+
+def _generate_handler_set(policy_type_id, policy_instance_id):
+    """
+    generate the name of the set of handler ids that reported a status for an instance
+    """
+    return "{0}{1}.{2}".format(HANDLER_SET_PREFIX, policy_type_id, policy_instance_id)
+
+
+def _generate_list_version_key(policy_type_id):
+    """
+    generate the key of the instance list version of a type
+    """
+    return "{0}{1}".format(LIST_VERSION_PREFIX, policy_type_id)
+
+
+def _bump_list_version(policy_type_id):
+    """
+    record that the instance list of a type changed
+    """
+    SDL.set(A1NS, _generate_list_version_key(policy_type_id), uuid.uuid4().hex)
+
+
+def _next_version(metadata, field="version"):
+    """
+    answers the version that follows the one in instance metadata (which may be None)
+    version counts every change of the instance or its status, content_version only writes of the instance;
+    metadata written before either was introduced counts as version 0
+    """
+    return (metadata or {}).get(field, 0) + 1
+
+
+def _instance_etag(metadata):
+    """
+    answers the entity tag of an instance, which status updates do not change
+    created_at tells apart instances that were deleted and created again before versions were introduced
+    """
+    return "{0}-{1}".format(metadata.get("content_version", 0), int(metadata["created_at"] * 1000000))
+
+
+def _status_etag(metadata):
+    """
+    answers the entity tag of the status of an instance
+    """
+    return "{0}-{1}".format(metadata.get("version", 0), int(metadata["created_at"] * 1000000))
+
+
+def _check_precondition(policy_type_id, if_match, metadata):
+    """
+    raises PolicyInstancePreconditionFailed unless the instance with this metadata (None if there is none)
+    matches if_match, a set of entity tags in which "*" matches any instance; None matches anything
+    """
+    if if_match is None:
+        return
+    if metadata is None or ("*" not in if_match and _instance_etag(metadata) not in if_match):
+        raise PolicyInstancePreconditionFailed(policy_type_id)
+
+
+def _get_many(keys):
+    """
+    get several keys in one SDL round trip; answers a dict of key to value for the keys that exist
+    """
+    if not keys:
+        return {}
+    found = SDL.get_many(A1NS, keys)
+    return {k: _codec.decode(v) for k, v in found.items()}
+
+
+def _get_many_packed(keys):
+    """
+    like _get_many, but answers the values as stored, without decoding them
+    """
+    if not keys:
+        return {}
+    return SDL.get_many(A1NS, keys)
+
+
+def _set_many(values):
+    """
+    set several keys in one SDL round trip; values is a dict of key to value
+    """
+    if values:
+        SDL.set_many(A1NS, {k: _codec.encode(v) for k, v in values.items()})
+
+
+def _set_many_packed(values):
+    """
+    like _set_many, but takes the values already encoded
+    """
+    if values:
+        SDL.set_many(A1NS, values)
+
+
+def _delete_many(keys):
+    """
+    delete several keys in one SDL round trip
+    """
+    if keys:
+        SDL.delete_many(A1NS, keys)
+
+
+def _add_members(group, members):
+    """
+    add several members to an SDL group in one round trip
+    """
+    if members:
+        SDL.add_members(A1NS, group, members)
+
+
+def _unpack(packed):
+    return None if packed is None else _codec.decode(packed)
+
+
+def _get(key):
+    """
+    get one key; answers None if it does not exist
+    """
+    return _unpack(SDL.get(A1NS, key, usemsgpack=False))
+
+
+def _set_if(key, old_packed, value):
+    """
+    compare-and-swap: set key to value if it still holds old_packed, as read by _get_many_packed,
+    or, if old_packed is None, if it does not exist. Answers whether the value was written.
+    """
+    packed = _codec.encode(value)
+    if old_packed is None:
+        return SDL.set_if_not_exists(A1NS, key, packed, usemsgpack=False)
+    return SDL.set_if(A1NS, key, old_packed, packed, usemsgpack=False)
+
+
+_indexes_ready = False
+_indexes_lock = Lock()
+
+
+def _split_handler_key(rest, instance_ids):
+    """
+    splits "policy_instance_id.handler_id", the end of a handler key, into its ids, given the ids of the instances of its type
+    ids may contain dots, so the longest instance id that fits wins; answers None for a handler of an unknown instance
+    """
+    end = len(rest)
+    while True:
+        end = rest.rfind(".", 0, end)
+        if end < 0:
+            return None
+        if rest[:end] in instance_ids:
+            return rest[:end], rest[end + 1:]
+
+
+def _rebuild_indexes():
+    """
+    builds the index sets from the existing keys
+    each key prefix is listed once (a KEYS over the whole database), the keys are grouped here
+    and every set is written with a single call
+    """
+    mdc_logger.debug("Building policy type, instance and handler index sets")
+    type_ids = {int(key[len(TYPE_PREFIX):]) for key in SDL.find_keys(A1NS, TYPE_PREFIX)}
+    instances = {}
+    for key in SDL.find_keys(A1NS, INSTANCE_PREFIX):
+        policy_type_id, policy_instance_id = key[len(INSTANCE_PREFIX):].split(".", 1)
+        if int(policy_type_id) in type_ids:
+            instances.setdefault(int(policy_type_id), set()).add(policy_instance_id)
+    handlers = {}
+    for key in SDL.find_keys(A1NS, HANDLER_PREFIX):
+        policy_type_id, rest = key[len(HANDLER_PREFIX):].split(".", 1)
+        ids = _split_handler_key(rest, instances.get(int(policy_type_id), ()))
+        if ids is not None:
+            handlers.setdefault((int(policy_type_id), ids[0]), []).append(ids[1])
+
+    _add_members(TYPE_SET, type_ids)
+    for policy_type_id, policy_instance_ids in instances.items():
+        _add_members(_generate_instance_set(policy_type_id), policy_instance_ids)
+    for (policy_type_id, policy_instance_id), handler_ids in handlers.items():
+        _add_members(_generate_handler_set(policy_type_id, policy_instance_id), handler_ids)
+    mdc_logger.debug("Indexed {0} types, {1} instances and {2} handlers", len(type_ids), sum(len(i) for i in instances.values()), sum(len(h) for h in handlers.values()))
+
+
+def _reencode_values():
+    """
+    Rewrites the stored values in the encoding of _codec, with compare-and-swap so a value written meanwhile is left alone.
+    Values are readable in any encoding, so this only saves memory, or, with the msgpack codec, makes the
+    database readable by an A1 that predates codecs.
+    """
+    mdc_logger.debug("Re-encoding stored values with the {0} codec", _codec.name)
+    keys = [key for prefix in (TYPE_PREFIX, INSTANCE_PREFIX, METADATA_PREFIX, HANDLER_PREFIX) for key in SDL.find_keys(A1NS, prefix)]
+    for start in range(0, len(keys), LIST_CHUNK_SIZE):
+        for key, packed in _get_many_packed(keys[start:start + LIST_CHUNK_SIZE]).items():
+            encoded = _codec.encode(_codec.decode(packed))
+            if encoded != packed:
+                SDL.set_if(A1NS, key, packed, encoded, usemsgpack=False)
+
+
+def _ensure_indexes():
+    """
+    The list and status functions read index sets instead of scanning the keyspace.
+    Databases written by an A1 that predates the index sets have the keys but not the sets,
+    so the first time a process finds the index version marker missing, it builds them.
+    This runs at startup, see prepare_database; the calls on the request paths only check a flag.
+    """
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    with _indexes_lock:
+        if _indexes_ready:
+            return
+        if SDL.get(A1NS, INDEX_VERSION_KEY) != INDEX_VERSION:
+            _rebuild_indexes()
+            SDL.set(A1NS, INDEX_VERSION_KEY, INDEX_VERSION)
+        _indexes_ready = True
+
+
+def _ensure_value_codec():
+    """
+    Re-encodes the stored values once when the codec is not the one the database was last prepared with.
+    Without a marker, the database was only written by A1s that predate codecs, so its values are plain msgpack.
+    """
+    stored = SDL.get(A1NS, VALUE_CODEC_KEY)
+    if stored == _codec.name:
+        return
+    if stored is not None or _codec.name != codec.MsgpackCodec.name:
+        _reencode_values()
+    SDL.set(A1NS, VALUE_CODEC_KEY, _codec.name)
+
+
+def prepare_database():
+    """
+    brings the database up to date, see _ensure_indexes and _ensure_value_codec
+    called once at startup, before A1 serves requests or rmr; the request paths never re-encode
+    """
+    _ensure_indexes()
+    _ensure_value_codec()
+
+
+def _get_type(policy_type_id):
+    """
+    get a type through the type cache; answers None if the type does not exist
+    """
+    body = _type_cache.get(policy_type_id)
+    if body is None:
+        body = _get(_generate_type_key(policy_type_id))
+        if body is not None:
+            _type_cache.put(policy_type_id, body)
+    return body
+
+
 def _type_is_valid(policy_type_id):
     """
     check that a type is valid
     """
-    if SDL.get(A1NS, _generate_type_key(policy_type_id)) is None:
+    if _get_type(policy_type_id) is None:
         raise PolicyTypeNotFound(policy_type_id)
 
 
@@ -93,7 +512,7 @@ def _instance_is_valid(policy_type_id, policy_instance_id):
     check that an instance is valid
     """
     _type_is_valid(policy_type_id)
-    if SDL.get(A1NS, _generate_instance_key(policy_type_id, policy_instance_id)) is None:
+    if _get(_generate_instance_key(policy_type_id, policy_instance_id)) is None:
         raise PolicyInstanceNotFound(policy_type_id)
 
 
@@ -101,9 +520,29 @@ def _get_statuses(policy_type_id, policy_instance_id):
     """
     shared helper to get statuses for an instance
     """
-    _instance_is_valid(policy_type_id, policy_instance_id)
-    prefixes_for_handler = "{0}{1}.{2}.".format(HANDLER_PREFIX, policy_type_id, policy_instance_id)
-    return list(SDL.find_and_get(A1NS, prefixes_for_handler).values())
+    _ensure_indexes()
+    handler_ids = SDL.get_members(A1NS, _generate_handler_set(policy_type_id, policy_instance_id))
+    keys = [_generate_handler_key(policy_type_id, policy_instance_id, h) for h in handler_ids]
+    return list(_get_many(keys).values())
+
+
+def _get_aggregate(policy_type_id, policy_instance_id, metadata):
+    """
+    answers (number of handlers that reported OK, number of handlers that reported) for an instance
+    these are kept in the metadata by set_policy_instance_statuses; metadata written before that
+    was done has them computed from the handler statuses
+    """
+    if "handlers_total" in metadata:
+        return metadata["handlers_ok"], metadata["handlers_total"]
+    statuses = _get_statuses(policy_type_id, policy_instance_id)
+    return sum(1 for i in statuses if i == "OK"), len(statuses)
+
+
+def _instance_status(policy_type_id, policy_instance_id, metadata):
+    """
+    IN EFFECT if at least one handler reported OK, NOT IN EFFECT otherwise
+    """
+    return "IN EFFECT" if _get_aggregate(policy_type_id, policy_instance_id, metadata)[0] > 0 else "NOT IN EFFECT"
 
 
 def _get_instance_list(policy_type_id):
@@ -111,45 +550,165 @@ def _get_instance_list(policy_type_id):
     shared helper to get instance list for a type
     """
     _type_is_valid(policy_type_id)
-    prefixes_for_type = "{0}{1}.".format(INSTANCE_PREFIX, policy_type_id)
-    instancekeys = SDL.find_and_get(A1NS, prefixes_for_type).keys()
-    return [k.split(prefixes_for_type)[1] for k in instancekeys]
+    _ensure_indexes()
+    return sorted(SDL.get_members(A1NS, _generate_instance_set(policy_type_id)))
 
 
-def _clear_handlers(policy_type_id, policy_instance_id):
+def _clear_handlers(policy_type_id, policy_instance_ids):
     """
-    delete all the handlers for a policy instance
+    delete all the handlers for some policy instances of a type
     """
-    all_handlers_pref = _generate_handler_prefix(policy_type_id, policy_instance_id)
-    keys = SDL.find_and_get(A1NS, all_handlers_pref)
-    for k in keys:
-        SDL.delete(A1NS, k)
+    _ensure_indexes()
+    keys = []
+    for policy_instance_id in policy_instance_ids:
+        handler_set = _generate_handler_set(policy_type_id, policy_instance_id)
+        handler_ids = SDL.get_members(A1NS, handler_set)
+        if handler_ids:
+            keys.extend(_generate_handler_key(policy_type_id, policy_instance_id, h) for h in handler_ids)
+            SDL.remove_group(A1NS, handler_set)
+    _delete_many(keys)
 
 
-def _get_metadata(policy_type_id, policy_instance_id):
+def _delete_ttl(has_handlers):
     """
-    get instance metadata
+    answers how long a deleted instance is kept; see the delete flowchart in docs/
     """
-    _instance_is_valid(policy_type_id, policy_instance_id)
+    if has_handlers:
+        # handler is not empty, we wait max t1,t2 to expire then goodnight
+        return max(INSTANCE_DELETE_RESP_TTL, INSTANCE_DELETE_NO_RESP_TTL)
+    # handler is empty; we wait for t1 to expire then goodnight
+    return INSTANCE_DELETE_NO_RESP_TTL
+
+
+def _delete_now(policy_type_id, policy_instance_id):
+    """
+    deletes an instance whose delete timer has expired
+    the instance is left alone if it was created again in the meantime
+    """
+    _type_is_valid(policy_type_id)
+    instance_key = _generate_instance_key(policy_type_id, policy_instance_id)
     metadata_key = _generate_instance_metadata_key(policy_type_id, policy_instance_id)
-    return SDL.get(A1NS, metadata_key)
+    found = _get_many_packed([instance_key, metadata_key])
+    if not found:
+        raise PolicyInstanceNotFound(policy_type_id)
+    if metadata_key in found and not _unpack(found[metadata_key]).get("has_been_deleted"):
+        mdc_logger.debug("type {0} instance {1} was recreated, not deleting", policy_type_id, policy_instance_id)
+        return
+
+    # the body goes first and the metadata last, each only if no one wrote it since it was read, so the instance
+    # stays listed until it is gone. Instances are written metadata first, so a write that claims the instance
+    # in between is found below; its body may be the very bytes deleted here, so they are put back unless the
+    # writer already wrote its own. A body without metadata is left from a deletion that failed half way.
+    if instance_key in found and not SDL.delete_if(A1NS, instance_key, found[instance_key], usemsgpack=False):
+        mdc_logger.debug("type {0} instance {1} was recreated, not deleting", policy_type_id, policy_instance_id)
+        return
+    if metadata_key in found:
+        deleted = SDL.delete_if(A1NS, metadata_key, found[metadata_key], usemsgpack=False)
+    else:
+        deleted = SDL.get(A1NS, metadata_key, usemsgpack=False) is None
+    if not deleted:
+        if instance_key in found:
+            SDL.set_if_not_exists(A1NS, instance_key, found[instance_key], usemsgpack=False)
+        mdc_logger.debug("type {0} instance {1} was recreated, not deleting", policy_type_id, policy_instance_id)
+        return
+
+    # then the handlers
+    handler_set = _generate_handler_set(policy_type_id, policy_instance_id)
+    _delete_many([_generate_handler_key(policy_type_id, policy_instance_id, h) for h in SDL.get_members(A1NS, handler_set)])
+    SDL.remove_group(A1NS, handler_set)
+    instance_set = _generate_instance_set(policy_type_id)
+    SDL.remove_member(A1NS, instance_set, policy_instance_id)
+    if SDL.get(A1NS, metadata_key, usemsgpack=False) is not None:
+        # created again meanwhile; its writer may have indexed it before the removal above
+        SDL.add_member(A1NS, instance_set, policy_instance_id)
+    _bump_list_version(policy_type_id)
+    _query_snapshot.discard(policy_type_id, [policy_instance_id])
+    mdc_logger.debug("type {0} instance {1} deleted", policy_type_id, policy_instance_id)
 
 
-def _delete_after(policy_type_id, policy_instance_id, ttl):
+class _DeletionScheduler:
     """
-    this is a blocking function, must call this in a thread to not block!
-    waits ttl seconds, then deletes the instance
+    Deletes policy instances when their delete timers expire.
+
+    One worker thread sleeps until the earliest deadline in a heap, so scheduling is O(log n)
+    and a mass delete costs heap entries instead of one sleeping thread per instance.
+    The deadlines are not persisted separately; they follow from the deleted_at timestamp in the
+    instance metadata, which is what resume_pending_deletions uses after a restart.
     """
-    _instance_is_valid(policy_type_id, policy_instance_id)
 
-    time.sleep(ttl)
+    def __init__(self):
+        self._heap = []
+        self._deadlines = {}  # (policy_type_id, policy_instance_id) -> deadline of its live heap entry
+        self._cond = Condition()
+        self._thread = None
+        self._errors = {}  # (policy_type_id, policy_instance_id) -> unexpected failures in a row
+
+    def schedule(self, policy_type_id, policy_instance_id, delay):
+        """
+        delete the instance after delay seconds; an instance that is already due earlier keeps its deadline
+        """
+        key = (policy_type_id, policy_instance_id)
+        deadline = time.time() + delay
+        with self._cond:
+            if key in self._deadlines and self._deadlines[key] <= deadline:
+                return
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, policy_type_id, policy_instance_id))
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name="a1-deletion-scheduler", daemon=True)
+                self._thread.start()
+            self._cond.notify()
 
-    # ready to delete
-    _clear_handlers(policy_type_id, policy_instance_id)  # delete all the handlers
-    SDL.delete(A1NS, _generate_instance_key(policy_type_id, policy_instance_id))  # delete instance
-    SDL.delete(A1NS, _generate_instance_metadata_key(policy_type_id, policy_instance_id))  # delete instance metadata
-    mdc_logger.debug("type {0} instance {1} deleted".format(policy_type_id, policy_instance_id))
+    def pending(self):
+        """
+        answers the number of instances waiting to be deleted
+        """
+        with self._cond:
+            return len(self._deadlines)
 
+    def _next_due(self):
+        """
+        blocks until an instance is due, then answers its (policy_type_id, policy_instance_id)
+        """
+        with self._cond:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                deadline, policy_type_id, policy_instance_id = self._heap[0]
+                now = time.time()
+                if deadline > now:
+                    self._cond.wait(deadline - now)
+                    continue
+                heapq.heappop(self._heap)
+                key = (policy_type_id, policy_instance_id)
+                if self._deadlines.get(key) == deadline:  # otherwise superseded by an earlier deadline
+                    del self._deadlines[key]
+                    return key
+
+    def _run(self):
+        while True:
+            policy_type_id, policy_instance_id = self._next_due()
+            try:
+                _delete_now(policy_type_id, policy_instance_id)
+                self._errors.pop((policy_type_id, policy_instance_id), None)
+            except (PolicyTypeNotFound, PolicyInstanceNotFound):
+                mdc_logger.debug("type {0} instance {1} already gone", policy_type_id, policy_instance_id)
+            except (RejectedByBackend, NotConnected, BackendError) as exc:
+                mdc_logger.warning("Deleting type {0} instance {1} failed, will retry: {2}", policy_type_id, policy_instance_id, exc, key="delete_failed")
+                self.schedule(policy_type_id, policy_instance_id, INSTANCE_DELETE_RETRY_DELAY)
+            except Exception as exc:  # one bad instance must not stop all later deletions
+                key = (policy_type_id, policy_instance_id)
+                errors = self._errors[key] = self._errors.get(key, 0) + 1
+                if errors < INSTANCE_DELETE_MAX_ERRORS:
+                    mdc_logger.error("Deleting type {0} instance {1} failed, will retry: {2!r}", policy_type_id, policy_instance_id, exc, key="delete_error")
+                    self.schedule(policy_type_id, policy_instance_id, INSTANCE_DELETE_RETRY_DELAY)
+                else:
+                    del self._errors[key]
+                    mdc_logger.error("Deleting type {0} instance {1} failed {2} times, giving up until A1 restarts: {3!r}", policy_type_id, policy_instance_id, errors, exc, key="delete_error")
+
+
+_deletion_scheduler = _DeletionScheduler()
 
 # Types
 
@@ -158,9 +717,8 @@ def get_type_list():
     """
     retrieve all type ids
     """
-    typekeys = SDL.find_and_get(A1NS, TYPE_PREFIX).keys()
-    # policy types are ints but they get butchered to strings in the KV
-    return [int(k.split(TYPE_PREFIX)[1]) for k in typekeys]
+    _ensure_indexes()
+    return sorted(SDL.get_members(A1NS, TYPE_SET))
 
 
 def store_policy_type(policy_type_id, body):
@@ -170,9 +728,11 @@ def store_policy_type(policy_type_id, body):
     if policy_type_id != body['policy_type_id']:
         raise PolicyTypeIdMismatch("{0} vs. {1}".format(policy_type_id, body['policy_type_id']))
     key = _generate_type_key(policy_type_id)
-    if SDL.get(A1NS, key) is not None:
+    if SDL.get(A1NS, key, usemsgpack=False) is not None:
         raise PolicyTypeAlreadyExists(policy_type_id)
-    SDL.set(A1NS, key, body)
+    SDL.set(A1NS, key, _codec.encode(body), usemsgpack=False)
+    SDL.add_member(A1NS, TYPE_SET, policy_type_id)
+    _type_cache.put(policy_type_id, body)
 
 
 def delete_policy_type(policy_type_id):
@@ -182,6 +742,12 @@ def delete_policy_type(policy_type_id):
     pil = get_instance_list(policy_type_id)
     if pil == []:  # empty, can delete
         SDL.delete(A1NS, _generate_type_key(policy_type_id))
+        SDL.remove_member(A1NS, TYPE_SET, policy_type_id)
+        SDL.remove_group(A1NS, _generate_instance_set(policy_type_id))
+        SDL.delete(A1NS, _generate_list_version_key(policy_type_id))
+        _type_cache.invalidate(policy_type_id)
+        _query_snapshot.drop_type(policy_type_id)
+        _type_etags.pop(policy_type_id, None)
     else:
         raise CantDeleteNonEmptyType(policy_type_id)
 
@@ -189,42 +755,221 @@ def delete_policy_type(policy_type_id):
 def get_policy_type(policy_type_id):
     """
     retrieve a type
+    the answer may be shared with the type cache, so callers must not modify it
     """
-    _type_is_valid(policy_type_id)
-    return SDL.get(A1NS, _generate_type_key(policy_type_id))
+    body = _get_type(policy_type_id)
+    if body is None:
+        raise PolicyTypeNotFound(policy_type_id)
+    return body
+
+
+def get_policy_type_etag(policy_type_id):
+    """
+    answers an entity tag of a type; types cannot be replaced, so it only changes if the type is deleted and created again
+    """
+    body = get_policy_type(policy_type_id)
+    entry = _type_etags.get(policy_type_id)
+    if entry is None or entry[0] is not body:
+        entry = (body, hashlib.sha1(json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest())
+        _type_etags[policy_type_id] = entry
+    return entry[1]
 
 
 # Instances
 
 
-def store_policy_instance(policy_type_id, policy_instance_id, instance):
+def _write_instance_body(instance_key, packed_instance, instance, metadata_key, write_id):
     """
-    Store a policy instance
+    writes the body of an instance whose metadata was claimed by the write write_id, see _claim_instance
+    packed_instance is the body read before the claim
+    """
+    # a failed swap means someone else wrote the body in between; that was either a newer claim,
+    # whose body must win, or an older one, which gives up after its next read, so this ends
+    while not _set_if(instance_key, packed_instance, instance):
+        found = _get_many_packed([instance_key, metadata_key])
+        metadata = _unpack(found.get(metadata_key))
+        if metadata is None or metadata.get("write_id") != write_id:
+            return
+        packed_instance = found.get(instance_key)
+
+
+def _new_metadata(existing_metadata, timestamp, write_id):
+    """
+    answers the metadata of an instance written by the write write_id, replacing existing_metadata (which may be None)
+    """
+    # the version carries on from the previous metadata, so an entity tag never comes back for different content
+    return {
+        "created_at": timestamp,
+        "has_been_deleted": False,
+        "version": _next_version(existing_metadata),
+        "content_version": _next_version(existing_metadata, "content_version"),
+        "last_modified": timestamp,
+        # the handlers were cleared by the caller
+        "handlers_ok": 0,
+        "handlers_total": 0,
+        "status_updated_at": timestamp,
+        "write_id": write_id,
+    }
+
+
+def _claim_instance(policy_type_id, policy_instance_id, instance, packed_instance, packed_metadata, if_match, timestamp):
+    """
+    stores an instance with optimistic concurrency: its new metadata is swapped in only if the metadata
+    did not change since it was read (packed_metadata), otherwise it is read again and the write retried.
+    The metadata is the version of record; the body is written after it, see _write_instance_body.
+    Answers CREATE or UPDATE; raises PolicyInstanceConflict if other writers kept changing the metadata.
+    """
+    instance_key = _generate_instance_key(policy_type_id, policy_instance_id)
+    metadata_key = _generate_instance_metadata_key(policy_type_id, policy_instance_id)
+    write_id = uuid.uuid4().hex
+    for _ in range(INSTANCE_WRITE_RETRIES):
+        existing_metadata = _unpack(packed_metadata)
+        _check_precondition(policy_type_id, if_match, existing_metadata)
+        metadata = _new_metadata(existing_metadata, timestamp, write_id)
+        if _set_if(metadata_key, packed_metadata, metadata):
+            _write_instance_body(instance_key, packed_instance, instance, metadata_key, write_id)
+            return "CREATE" if packed_instance is None else "UPDATE"
+        found = _get_many_packed([instance_key, metadata_key])
+        packed_instance, packed_metadata = found.get(instance_key), found.get(metadata_key)
+    raise PolicyInstanceConflict(policy_type_id)
+
+
+def _write_instances(instances, keys, metadata_keys, existing, timestamp):
+    """
+    writes the bodies and metadata of instances with one multi-set, without compare-and-swap, then reads the metadata back.
+    Each body goes to SDL in the same call as its metadata, so it never mixes with those of another write.
+    Answers the ids of the instances whose metadata another writer replaced in between; they have to be
+    written again with _claim_instance, so that their version carries on from the other write.
+    """
+    write_id = uuid.uuid4().hex
+    values = {}
+    for pii, instance in instances.items():
+        values[keys[pii]] = _codec.encode(instance)
+        values[metadata_keys[pii]] = _codec.encode(_new_metadata(_unpack(existing.get(metadata_keys[pii])), timestamp, write_id))
+    _set_many_packed(values)
+    found = _get_many_packed(list(metadata_keys.values()))
+    return [pii for pii in instances if found.get(metadata_keys[pii]) != values[metadata_keys[pii]]]
+
+
+def store_policy_instances(policy_type_id, instances, if_match=None):
+    """
+    Store several policy instances of one type
+    instances is a dict of policy instance id to instance
+    if_match is a set of entity tags the instances must have, see _check_precondition
+    answers a dict of policy instance id to the operation, CREATE or UPDATE, of the instances that were stored;
+    instances that other writers kept changing are left out, see _claim_instance
+
+    The instances are read with one multi-get. Without if_match they are all written with one multi-set,
+    and only those that another writer changed at the same time are written again with compare-and-swap;
+    with if_match each one is written with compare-and-swap. Either way concurrent writers (for example
+    several A1 replicas) never mix the body of one write with the metadata of another.
     """
     _type_is_valid(policy_type_id)
+    _ensure_indexes()
     creation_timestamp = time.time()
 
-    # store the instance
-    operation = "CREATE"
-    key = _generate_instance_key(policy_type_id, policy_instance_id)
-    if SDL.get(A1NS, key) is not None:
-        operation = "UPDATE"
-        # Reset the statuses because this is a new policy instance, even if it was overwritten
-        _clear_handlers(policy_type_id, policy_instance_id)  # delete all the handlers
-    SDL.set(A1NS, key, instance)
+    keys = {pii: _generate_instance_key(policy_type_id, pii) for pii in instances}
+    metadata_keys = {pii: _generate_instance_metadata_key(policy_type_id, pii) for pii in instances}
+    existing = _get_many_packed(list(keys.values()) + list(metadata_keys.values()))
+    for pii in instances:
+        _check_precondition(policy_type_id, if_match, _unpack(existing.get(metadata_keys[pii])))
 
-    metadata_key = _generate_instance_metadata_key(policy_type_id, policy_instance_id)
-    SDL.set(A1NS, metadata_key, {"created_at": creation_timestamp, "has_been_deleted": False})
+    # the operation is decided by what was stored before this request, whoever writes in between
+    replaced = [pii for pii in instances if keys[pii] in existing]
+    operations_of = dict.fromkeys(instances, "CREATE")
+    operations_of.update(dict.fromkeys(replaced, "UPDATE"))
+
+    # Reset the statuses of replaced instances because this is a new policy instance, even if it was overwritten
+    _clear_handlers(policy_type_id, replaced)
+
+    operations = {}
+    try:
+        found = existing
+        contended = list(instances)
+        if if_match is None:
+            contended = _write_instances(instances, keys, metadata_keys, existing, creation_timestamp)
+            lost = set(contended)
+            operations.update((pii, op) for pii, op in operations_of.items() if pii not in lost)
+            found = _get_many_packed([keys[pii] for pii in contended] + [metadata_keys[pii] for pii in contended])
 
-    return operation
+        for pii in contended:
+            try:
+                _claim_instance(policy_type_id, pii, instances[pii], found.get(keys[pii]), found.get(metadata_keys[pii]), if_match, creation_timestamp)
+            except PolicyInstanceConflict:
+                mdc_logger.warning("Gave up writing type {0} instance {1}, other writers kept changing it", policy_type_id, pii, key="instance_conflict")
+                continue
+            operations[pii] = operations_of[pii]
+    finally:
+        # whatever was stored is indexed, even if a write failed half way; all of it, so a retry
+        # repairs the set if a previous write failed before indexing
+        _add_members(_generate_instance_set(policy_type_id), list(operations))
+        if "CREATE" in operations.values():
+            _bump_list_version(policy_type_id)
+        _query_snapshot.discard(policy_type_id, instances)
+
+    return operations
+
+
+def store_policy_instance(policy_type_id, policy_instance_id, instance, if_match=None):
+    """
+    Store a policy instance
+    if_match is a set of entity tags the instance must have, see _check_precondition
+    answers the operation, CREATE or UPDATE
+    """
+    operations = store_policy_instances(policy_type_id, {policy_instance_id: instance}, if_match)
+    if policy_instance_id not in operations:
+        raise PolicyInstanceConflict(policy_type_id)
+    return operations[policy_instance_id]
+
+
+def get_policy_instances(policy_type_id, policy_instance_ids):
+    """
+    Retrieve several policy instances of one type in one SDL round trip
+    answers a dict of policy instance id to instance; ids that do not exist are left out
+    """
+    _type_is_valid(policy_type_id)
+    keys = {_generate_instance_key(policy_type_id, pii): pii for pii in policy_instance_ids}
+    return {keys[k]: v for k, v in _get_many(keys).items()}
 
 
 def get_policy_instance(policy_type_id, policy_instance_id):
     """
     Retrieve a policy instance
     """
-    _instance_is_valid(policy_type_id, policy_instance_id)
-    return SDL.get(A1NS, _generate_instance_key(policy_type_id, policy_instance_id))
+    _type_is_valid(policy_type_id)
+    instance_key = _generate_instance_key(policy_type_id, policy_instance_id)
+    metadata_key = _generate_instance_metadata_key(policy_type_id, policy_instance_id)
+    found = _get_many([instance_key, metadata_key])
+    if instance_key in found:
+        return found[instance_key]
+    metadata = found.get(metadata_key)
+    if metadata is not None and metadata.get("has_been_deleted"):
+        # a deletion that stopped half way, after the body was deleted; finish it
+        _schedule_deletion(policy_type_id, policy_instance_id, metadata, time.time())
+    raise PolicyInstanceNotFound(policy_type_id)
+
+
+def get_policy_query_payloads(policy_type_id):
+    """
+    Answers the serialised CREATE messages for all instances of a type, to answer an A1_POLICY_QUERY
+    Uses one read of the instance set and one multi-get of the instances; messages come from
+    the query snapshot when the instance has not changed since they were built
+    """
+    policy_instance_ids = _get_instance_list(policy_type_id)
+    keys = {_generate_instance_key(policy_type_id, pii): pii for pii in policy_instance_ids}
+    packed_instances = _get_many_packed(keys)
+    payloads = []
+    for key, pii in keys.items():
+        packed = packed_instances.get(key)
+        if packed is None:  # deleted since we read the set
+            continue
+        payload = _query_snapshot.get(policy_type_id, pii, packed)
+        if payload is None:
+            instance = _unpack(packed)
+            payload = messages.a1_to_handler_bytes("CREATE", policy_type_id, pii, instance)
+            _query_snapshot.put(policy_type_id, pii, packed, payload)
+        payloads.append(payload)
+    return payloads
 
 
 def get_instance_list(policy_type_id):
@@ -234,34 +979,179 @@ def get_instance_list(policy_type_id):
     return _get_instance_list(policy_type_id)
 
 
-def delete_policy_instance(policy_type_id, policy_instance_id):
+def _get_instance_statuses(policy_type_id, policy_instance_ids):
     """
-    initially sets has_been_deleted in the status
-    then launches a thread that waits until the relevent timer expires, and finally deletes the instance
+    answers a dict of policy instance id to (metadata, instance status) for the instances that exist
+    uses a single multi-get of all metadata, which holds the aggregated handler statuses
     """
-    _instance_is_valid(policy_type_id, policy_instance_id)
+    metadata_keys = {_generate_instance_metadata_key(policy_type_id, pii): pii for pii in policy_instance_ids}
+    found = _get_many(metadata_keys)
+    return {
+        pii: (found[key], _instance_status(policy_type_id, pii, found[key]))
+        for key, pii in metadata_keys.items() if key in found
+    }
+
+
+def _iter_instance_statuses(policy_type_id, policy_instance_ids):
+    """
+    yields (policy instance id, metadata, instance status) of the instances that exist, in the given order,
+    reading them a chunk at a time
+    """
+    for start in range(0, len(policy_instance_ids), LIST_CHUNK_SIZE):
+        chunk = policy_instance_ids[start:start + LIST_CHUNK_SIZE]
+        statuses = _get_instance_statuses(policy_type_id, chunk)
+        for pii in chunk:
+            if pii in statuses:  # otherwise deleted since we read the set
+                yield (pii,) + statuses[pii]
+
+
+def _status_body(metadata, instance_status):
+    """
+    answers the status of an instance as the API shows it
+    """
+    # version and last_modified are answered as the ETag and Last-Modified headers, the rest is internal
+    body = {k: v for k, v in metadata.items() if k not in ("version", "content_version", "last_modified", "handlers_ok", "handlers_total", "status_updated_at", "write_id")}
+    body["instance_status"] = instance_status
+    return body
+
+
+def _filter_instances(policy_type_id, policy_instance_ids, status, created_after, created_before):
+    """
+    yields the ids whose instance status and creation time match
+    """
+    for pii, metadata, instance_status in _iter_instance_statuses(policy_type_id, policy_instance_ids):
+        if status is not None and instance_status != status:
+            continue
+        if created_after is not None and metadata["created_at"] <= created_after:
+            continue
+        if created_before is not None and metadata["created_at"] >= created_before:
+            continue
+        yield pii
+
+
+def iter_instance_list(policy_type_id, after=None, status=None, created_after=None, created_before=None):
+    """
+    Answers an iterator over the instance ids of a type, in order, that come after the id after (if given),
+    have the instance status status (if given) and were created in between created_after and created_before
+    (timestamps, if given). The type is checked right away; filtered instances are read as the iterator goes.
+    """
+    policy_instance_ids = _get_instance_list(policy_type_id)
+    if after is not None:
+        policy_instance_ids = policy_instance_ids[bisect.bisect_right(policy_instance_ids, after):]
+    if status is None and created_after is None and created_before is None:
+        return iter(policy_instance_ids)
+    return _filter_instances(policy_type_id, policy_instance_ids, status, created_after, created_before)
 
-    # set the metadata first
-    deleted_timestamp = time.time()
+
+def get_instance_list_etag(policy_type_id):
+    """
+    answers an entity tag of the instance list of a type
+    """
+    _type_is_valid(policy_type_id)
+    key = _generate_list_version_key(policy_type_id)
+    version = SDL.get(A1NS, key)
+    if version is None:  # no instance was created or deleted since versions were introduced
+        version = uuid.uuid4().hex
+        SDL.set_if_not_exists(A1NS, key, version)
+        version = SDL.get(A1NS, key)
+    return version
+
+
+def _get_metadata(policy_type_id, policy_instance_id):
+    """
+    answers the metadata of an instance; raises if the type or the instance does not exist
+    """
+    _type_is_valid(policy_type_id)
+    metadata = _get(_generate_instance_metadata_key(policy_type_id, policy_instance_id))
+    if metadata is None:
+        raise PolicyInstanceNotFound(policy_type_id)
+    return metadata
+
+
+def get_policy_instance_version(policy_type_id, policy_instance_id):
+    """
+    answers (entity tag, last modified timestamp) of an instance with a single read
+    both change only when the instance is written; the entity tag is the one If-Match is checked against
+    """
+    metadata = _get_metadata(policy_type_id, policy_instance_id)
+    # every write sets created_at
+    return _instance_etag(metadata), metadata["created_at"]
+
+
+def get_policy_instance_status_version(policy_type_id, policy_instance_id):
+    """
+    answers (entity tag, last modified timestamp) of the status of an instance with a single read
+    both change when the instance is replaced or deleted, or when one of its handlers reports a different status
+    """
+    metadata = _get_metadata(policy_type_id, policy_instance_id)
+    last_modified = metadata.get("last_modified", metadata.get("deleted_at", metadata["created_at"]))
+    return _status_etag(metadata), last_modified
+
+
+def delete_policy_instance(policy_type_id, policy_instance_id, if_match=None):
+    """
+    initially sets has_been_deleted in the status
+    then schedules the deletion of the instance for when the relevant timer expires
+    if_match is a set of entity tags the instance must have, see _check_precondition
+    """
+    _type_is_valid(policy_type_id)
+    _ensure_indexes()
+    instance_key = _generate_instance_key(policy_type_id, policy_instance_id)
     metadata_key = _generate_instance_metadata_key(policy_type_id, policy_instance_id)
-    existing_metadata = _get_metadata(policy_type_id, policy_instance_id)
-    SDL.set(
-        A1NS,
-        metadata_key,
-        {"created_at": existing_metadata["created_at"], "has_been_deleted": True, "deleted_at": deleted_timestamp},
-    )
+    found = _get_many_packed([instance_key, metadata_key])
 
-    # wait, then delete
-    vector = _get_statuses(policy_type_id, policy_instance_id)
-    if vector == []:
-        # handler is empty; we wait for t1 to expire then goodnight
-        clos = lambda: _delete_after(policy_type_id, policy_instance_id, INSTANCE_DELETE_NO_RESP_TTL)
-    else:
-        # handler is not empty, we wait max t1,t2 to expire then goodnight
-        clos = lambda: _delete_after(
-            policy_type_id, policy_instance_id, max(INSTANCE_DELETE_RESP_TTL, INSTANCE_DELETE_NO_RESP_TTL)
+    # set the metadata first, with compare-and-swap like store_policy_instances
+    # the body may be missing, while the instance is created or after a deletion stopped half way
+    for _ in range(INSTANCE_WRITE_RETRIES):
+        if metadata_key not in found:
+            raise PolicyInstanceNotFound(policy_type_id)
+        existing_metadata = _unpack(found[metadata_key])
+        _check_precondition(policy_type_id, if_match, existing_metadata)
+        deleted_timestamp = time.time()
+        metadata = dict(
+            existing_metadata,
+            has_been_deleted=True,
+            deleted_at=deleted_timestamp,
+            version=_next_version(existing_metadata),
+            last_modified=deleted_timestamp,
         )
-    Thread(target=clos).start()
+        if _set_if(metadata_key, found[metadata_key], metadata):
+            break
+        found = _get_many_packed([instance_key, metadata_key])
+    else:
+        raise PolicyInstanceConflict(policy_type_id)
+
+    # wait, then delete
+    _schedule_deletion(policy_type_id, policy_instance_id, metadata, deleted_timestamp)
+
+
+def _schedule_deletion(policy_type_id, policy_instance_id, metadata, now):
+    """
+    schedules the deletion of an instance marked as deleted in metadata, for what is left of its timer
+    """
+    has_handlers = _get_aggregate(policy_type_id, policy_instance_id, metadata)[1] > 0
+    remaining = metadata.get("deleted_at", now) + _delete_ttl(has_handlers) - now
+    _deletion_scheduler.schedule(policy_type_id, policy_instance_id, max(remaining, 0))
+
+
+def resume_pending_deletions():
+    """
+    Schedules the deletion of every instance that is marked as deleted but still stored,
+    for example because A1 restarted while its delete timer was running.
+    Answers the number of deletions scheduled.
+    """
+    _ensure_indexes()
+    now = time.time()
+    count = 0
+    for policy_type_id in SDL.get_members(A1NS, TYPE_SET):
+        policy_instance_ids = SDL.get_members(A1NS, _generate_instance_set(policy_type_id))
+        keys = {_generate_instance_metadata_key(policy_type_id, pii): pii for pii in policy_instance_ids}
+        for key, metadata in _get_many(keys).items():
+            if not metadata.get("has_been_deleted"):
+                continue
+            _schedule_deletion(policy_type_id, keys[key], metadata, now)
+            count += 1
+    return count
 
 
 # Statuses
@@ -270,22 +1160,125 @@ def delete_policy_instance(policy_type_id, policy_instance_id):
 def set_policy_instance_status(policy_type_id, policy_instance_id, handler_id, status):
     """
     update the database status for a handler
-    called from a1's rmr thread
     """
-    _type_is_valid(policy_type_id)
     _instance_is_valid(policy_type_id, policy_instance_id)
-    SDL.set(A1NS, _generate_handler_key(policy_type_id, policy_instance_id, handler_id), status)
+    set_policy_instance_statuses([(policy_type_id, policy_instance_id, handler_id, status)])
+
+
+def set_policy_instance_statuses(statuses):
+    """
+    update the database statuses of many handlers at once
+    called from a1's rmr thread with all the policy responses it received in one go
+
+    statuses is a list of (policy_type_id, policy_instance_id, handler_id, status); when a handler
+    reports several times for the same instance, the last status wins.
+    Answers the list of statuses that were dropped because their type or instance does not exist.
+    """
+    rejected = []
+    latest = OrderedDict()
+    for item in statuses:
+        try:
+            latest[item[:3]] = item
+        except TypeError:  # unhashable ids in a malformed response
+            rejected.append(item)
+
+    # validate all the instances with one multi-get of their metadata
+    metadata_keys = {}
+    for (policy_type_id, policy_instance_id, _) in latest:
+        if (policy_type_id, policy_instance_id) not in metadata_keys and _get_type(policy_type_id) is not None:
+            metadata_keys[(policy_type_id, policy_instance_id)] = _generate_instance_metadata_key(policy_type_id, policy_instance_id)
+    # and the current statuses, so only changes bump the instance versions
+    handler_keys = {k: _generate_handler_key(*k) for k in latest if k[:2] in metadata_keys}
+    found = _get_many_packed(list(metadata_keys.values()) + list(handler_keys.values()))
+
+    values = {}
+    handler_ids = OrderedDict()
+    # metadata key -> [policy_type_id, policy_instance_id, packed metadata, handlers_ok, handlers_total]
+    aggregates = OrderedDict()
+    for (policy_type_id, policy_instance_id, handler_id), item in latest.items():
+        metadata_key = metadata_keys.get((policy_type_id, policy_instance_id))
+        if metadata_key not in found:
+            rejected.append(item)
+            continue
+        handler_key = handler_keys[(policy_type_id, policy_instance_id, handler_id)]
+        previous = _unpack(found.get(handler_key))
+        if previous == item[3]:
+            continue  # handlers repeat themselves; nothing changed
+        values[handler_key] = item[3]
+        handler_ids.setdefault((policy_type_id, policy_instance_id), []).append(handler_id)
+
+        # keep the aggregated status in the metadata up to date
+        if metadata_key not in aggregates:
+            packed = found[metadata_key]
+            aggregates[metadata_key] = [policy_type_id, policy_instance_id, packed, *_get_aggregate(policy_type_id, policy_instance_id, _unpack(packed))]
+        aggregate = aggregates[metadata_key]
+        if previous is None:
+            aggregate[4] += 1
+        elif previous == "OK":
+            aggregate[3] -= 1
+        if item[3] == "OK":
+            aggregate[3] += 1
+
+    # write all the statuses in one go, index the handlers, then update the aggregates
+    _set_many(values)
+    for (policy_type_id, policy_instance_id), ids in handler_ids.items():
+        _add_members(_generate_handler_set(policy_type_id, policy_instance_id), ids)
+    now = time.time()
+    for metadata_key, (policy_type_id, policy_instance_id, packed, handlers_ok, handlers_total) in aggregates.items():
+        _update_aggregate(policy_type_id, policy_instance_id, metadata_key, packed, handlers_ok, handlers_total, now)
+    return rejected
+
+
+def _update_aggregate(policy_type_id, policy_instance_id, metadata_key, packed_metadata, handlers_ok, handlers_total, timestamp):
+    """
+    writes the aggregated status into the instance metadata read as packed_metadata, with compare-and-swap
+    if the metadata changed meanwhile, for example because another A1 replica recorded statuses of the same
+    instance, the aggregate is counted again from the handler statuses, which already hold ours
+    """
+    for _ in range(INSTANCE_WRITE_RETRIES):
+        metadata = _unpack(packed_metadata)
+        new_metadata = dict(
+            metadata,
+            version=_next_version(metadata),
+            last_modified=timestamp,
+            handlers_ok=handlers_ok,
+            handlers_total=handlers_total,
+            status_updated_at=timestamp,
+        )
+        if _set_if(metadata_key, packed_metadata, new_metadata):
+            return
+        packed_metadata = _get_many_packed([metadata_key]).get(metadata_key)
+        if packed_metadata is None:
+            return  # deleted
+        statuses = _get_statuses(policy_type_id, policy_instance_id)
+        handlers_ok, handlers_total = sum(1 for i in statuses if i == "OK"), len(statuses)
+    mdc_logger.warning("Gave up updating the status of type {0} instance {1}", policy_type_id, policy_instance_id, key="status_conflict")
 
 
 def get_policy_instance_status(policy_type_id, policy_instance_id):
     """
     Gets the status of an instance
     """
-    _instance_is_valid(policy_type_id, policy_instance_id)
-    metadata = _get_metadata(policy_type_id, policy_instance_id)
-    metadata["instance_status"] = "NOT IN EFFECT"
-    for i in _get_statuses(policy_type_id, policy_instance_id):
-        if i == "OK":
-            metadata["instance_status"] = "IN EFFECT"
-            break
-    return metadata
+    _type_is_valid(policy_type_id)
+    metadata = _get(_generate_instance_metadata_key(policy_type_id, policy_instance_id))
+    if metadata is None:
+        raise PolicyInstanceNotFound(policy_type_id)
+    return _status_body(metadata, _instance_status(policy_type_id, policy_instance_id, metadata))
+
+
+def iter_policy_instance_statuses(policy_type_id, policy_instance_ids=None):
+    """
+    Answers an iterator over the statuses of the instances of a type, or of the given instances of it,
+    as get_policy_instance_status answers them plus the policy_instance_id. Ids that do not exist are left out.
+    The type is checked right away; the statuses are read with multi-gets as the iterator goes.
+    """
+    if policy_instance_ids is None:
+        policy_instance_ids = _get_instance_list(policy_type_id)
+    else:
+        _type_is_valid(policy_type_id)
+        _ensure_indexes()
+        policy_instance_ids = list(OrderedDict.fromkeys(policy_instance_ids))
+    return (
+        dict(_status_body(metadata, instance_status), policy_instance_id=pii)
+        for pii, metadata, instance_status in _iter_instance_statuses(policy_type_id, policy_instance_ids)
+    )
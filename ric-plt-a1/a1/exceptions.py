@@ -45,3 +45,11 @@ class PolicyTypeAlreadyExists(A1Error):
 
 class PolicyTypeIdMismatch(A1Error):
     """a policy type request path ID differs from its body ID"""
+
+
+class PolicyInstancePreconditionFailed(A1Error):
+    """a policy instance does not have the entity tag the request required"""
+
+
+class PolicyInstanceConflict(A1Error):
+    """a policy instance could not be written because other writers kept changing it"""
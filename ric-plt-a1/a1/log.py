@@ -0,0 +1,147 @@
+# ==================================================================================
+#       Copyright (c) 2019 Nokia
+#       Copyright (c) 2018-2019 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+Logging for the hot paths.
+
+LazyLogger wraps an mdclogpy Logger. Messages are str.format templates whose arguments are only
+formatted if the level is enabled, and arguments that are expensive to compute can be wrapped in
+lazy(). A message can be sampled (only every n-th is logged) or rate limited by key, so a storm of
+malformed messages costs a counter increment per message instead of a log line.
+"""
+import os
+import time
+from threading import Lock
+from mdclogpy import Logger, Level
+
+# per key, at most LOG_RATE_LIMIT messages are logged every LOG_RATE_WINDOW seconds
+LOG_RATE_LIMIT = int(os.environ.get("A1_LOG_RATE_LIMIT", 10))
+LOG_RATE_WINDOW = float(os.environ.get("A1_LOG_RATE_WINDOW", 10))
+# debug messages logged for every message sent or received are sampled: only one in LOG_DEBUG_SAMPLE is logged
+LOG_DEBUG_SAMPLE = int(os.environ.get("A1_LOG_DEBUG_SAMPLE", 1))
+
+
+class lazy:
+    """
+    a log argument that is computed by func(*args) when, and only if, the message is formatted
+    """
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __format__(self, spec):
+        return format(self.func(*self.args), spec)
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+class _Window:
+    """
+    counts the messages of one key in the current rate limit window
+    """
+
+    __slots__ = ("started", "logged", "suppressed", "calls")
+
+    def __init__(self, now):
+        self.started = now
+        self.logged = 0
+        self.suppressed = 0
+        self.calls = 0
+
+
+class LazyLogger:
+    """
+    An mdclogpy Logger whose debug, info, warning and error take a message template and its arguments:
+
+        mdc_logger.debug("sending {0}", lazy(rmr.message_summary, sbuf))
+        mdc_logger.warning("Dropping malformed message: {0}", msg, key="malformed")
+
+    key: messages with the same key share a budget of LOG_RATE_LIMIT per LOG_RATE_WINDOW seconds; the
+    first message logged in a new window says how many were suppressed in the previous ones.
+    Keys must come from a small, fixed set.
+    sample: only every sample-th call is logged; sampling is per key, or per template if there is no key.
+    Other attributes, like mdclog_format_init and set_level, are those of the wrapped Logger.
+    """
+
+    def __init__(self, name=None, logger=None):
+        if logger is None:
+            logger = Logger() if name is None else Logger(name=name)
+        self._logger = logger
+        self._windows = {}
+        self._lock = Lock()
+
+    def __getattr__(self, name):
+        return getattr(self._logger, name)
+
+    def is_enabled_for(self, level):
+        """
+        answers whether messages of level are logged
+        """
+        return level >= self._logger.get_level()
+
+    def _admit(self, key, sample):
+        """
+        answers None if the message must be dropped, else the number of messages of key suppressed before it
+        """
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = _Window(now)
+            window.calls += 1
+            if sample > 1 and window.calls % sample != 1:
+                return None
+            if now - window.started >= LOG_RATE_WINDOW:
+                window.started = now
+                window.logged = 0
+            if window.logged >= LOG_RATE_LIMIT:
+                window.suppressed += 1
+                return None
+            window.logged += 1
+            suppressed, window.suppressed = window.suppressed, 0
+            return suppressed
+
+    def log(self, level, message, *args, key=None, sample=1):
+        """
+        logs message.format(*args) at level, unless the level is disabled or the key's budget is spent
+        """
+        if level < self._logger.get_level():
+            return
+        if key is not None or sample > 1:
+            suppressed = self._admit(message if key is None else key, sample)
+            if suppressed is None:
+                return
+        else:
+            suppressed = 0
+        if args:
+            message = message.format(*args)
+        if suppressed:
+            message = "{0} ({1} similar messages suppressed)".format(message, suppressed)
+        self._logger.log(level, message)
+
+    def error(self, message, *args, key=None, sample=1):
+        self.log(Level.ERROR, message, *args, key=key, sample=sample)
+
+    def warning(self, message, *args, key=None, sample=1):
+        self.log(Level.WARNING, message, *args, key=key, sample=sample)
+
+    def info(self, message, *args, key=None, sample=1):
+        self.log(Level.INFO, message, *args, key=key, sample=sample)
+
+    def debug(self, message, *args, key=None, sample=1):
+        self.log(Level.DEBUG, message, *args, key=key, sample=sample)
@@ -16,7 +16,48 @@
 # ==================================================================================
 """
 rmr messages
+
+The *_bytes builders answer the encoded message. A payload that is already serialised JSON
+(bytes) is spliced into the envelope as is, so large policies are not decoded and re-encoded
+on the send path. orjson or ujson are used for encoding when installed.
 """
+import json
+
+try:
+    import orjson
+except ImportError:  # optional; see setup.py extras
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # optional; see setup.py extras
+    ujson = None
+
+
+def dumps(obj):
+    """
+    answers obj as compact utf-8 JSON bytes
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:  # e.g. integers beyond 64 bits; json handles them
+            pass
+    elif ujson is not None:
+        try:
+            return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode("utf-8")
+        except (TypeError, OverflowError):
+            pass
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def _encoded(payload):
+    """
+    answers payload as JSON bytes, as is if it already is
+    """
+    if isinstance(payload, (bytes, bytearray)):
+        return bytes(payload)
+    return dumps(payload)
 
 
 def a1_to_handler(operation, policy_type_id, policy_instance_id, payload=None):
@@ -39,3 +80,30 @@ def ei_to_handler(ei_job_id, payload=None):
         "ei_job_id": ei_job_id,
         "payload": payload,
     }
+
+
+def a1_to_handler_bytes(operation, policy_type_id, policy_instance_id, payload=None):
+    """
+    the encoded form of a1_to_handler; payload may be pre-serialised JSON bytes
+    """
+    return b"".join((
+        b'{"operation":', dumps(operation),
+        b',"policy_type_id":', dumps(policy_type_id),
+        b',"policy_instance_id":', dumps(policy_instance_id),
+        b',"payload":', _encoded(payload),
+        b"}",
+    ))
+
+
+def ei_to_handler_bytes(ei_job_id, payload=None):
+    """
+    the encoded form of ei_to_handler; payload may be pre-serialised JSON bytes
+    """
+    return b"".join((b'{"ei_job_id":', dumps(ei_job_id), b',"payload":', _encoded(payload), b"}"))
+
+
+def ei_job_created_bytes(ei_job_id):
+    """
+    used to create the payload that tells an xapp its ei job was created
+    """
+    return b'{"ei_job_id":' + dumps(ei_job_id) + b"}"
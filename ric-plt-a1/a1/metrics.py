@@ -0,0 +1,62 @@
+# ==================================================================================
+#       Copyright (c) 2019 Nokia
+#       Copyright (c) 2018-2019 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+Latency histograms of the stages of a request, exported through /a1-p/metrics.
+
+A slow PUT is the sum of its SDL calls, its schema validation and, later and in a sender thread,
+its RMR send; each has its own histogram so they can be told apart.
+"""
+import time
+from prometheus_client import Histogram
+
+# seconds; the default prometheus buckets start at 5ms, too coarse for SDL calls and validation
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+request_latency = Histogram('A1RequestLatencySeconds', 'Northbound request handling time by operation', ['operation'], buckets=REQUEST_BUCKETS)
+sdl_latency = Histogram('A1SdlLatencySeconds', 'SDL call time by method', ['method'], buckets=FAST_BUCKETS)
+validation_latency = Histogram('A1ValidationSeconds', 'Time to validate a policy instance against its type schema', buckets=FAST_BUCKETS)
+rmr_send_latency = Histogram('A1RmrSendSeconds', 'RMR send time, including retries, by message type', ['mtype'], buckets=FAST_BUCKETS)
+rmr_send_retries = Histogram('A1RmrSendRetries', 'Retries needed by one RMR send, by message type', ['mtype'], buckets=(0, 1, 2, 4, 8, 16))
+rmr_loop_latency = Histogram('A1RmrLoopSeconds', 'Time the rmr loop spends on what one receive call answered, by stage', ['stage'], buckets=FAST_BUCKETS)
+
+
+class TimedSDL:
+    """
+    Wraps an SDLClient (see a1/sdl.py) so that every call to one of its methods is observed in sdl_latency,
+    labeled with the method name. Attributes that are not methods are answered as they are.
+    """
+
+    def __init__(self, sdl):
+        self._wrapped = sdl
+
+    def __getattr__(self, name):
+        attr = getattr(self._wrapped, name)
+        if not callable(attr):
+            return attr
+        observe = sdl_latency.labels(method=name).observe
+
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                observe(time.perf_counter() - started)
+
+        # later lookups find the wrapper without coming back here
+        setattr(self, name, timed)
+        return timed
@@ -21,23 +21,46 @@
 from gevent.pywsgi import WSGIServer
 from mdclogpy import Logger
 from a1 import app
-from a1 import a1rmr
+from a1 import a1rmr, data
 
 
 mdc_logger = Logger()
 mdc_logger.mdclog_format_init(configmap_monitor=True)
 
 
+# gevent (default) or asyncio, see a1/aio.py
+SERVER_MODE = environ.get("A1_SERVER_MODE", "gevent")
+# http worker processes in gevent mode, see a1/workers.py
+WORKERS = int(environ.get("A1_WORKERS", 1))
+
+
 def main():
     """Entrypoint"""
     mdc_logger.debug("A1Mediator starts")
+    port = 10000
+    if SERVER_MODE == "asyncio":
+        from a1 import aio  # its dependencies are optional
+
+        mdc_logger.debug("Starting RMR task with RMR_RTG_SVC {0}, RMR_SEED_RT {1}".format(environ.get('RMR_RTG_SVC'), environ.get('RMR_SEED_RT')))
+        aio.serve(port)
+        return
+    if WORKERS > 1:
+        from a1 import workers
+
+        mdc_logger.debug("Starting {0} http workers; RMR_RTG_SVC {1}, RMR_SEED_RT {2}".format(WORKERS, environ.get('RMR_RTG_SVC'), environ.get('RMR_SEED_RT')))
+        workers.serve(port, WORKERS)
+        return
+
+    # index sets and value encoding, before anything reads the database
+    data.prepare_database()
     # start rmr thread
     mdc_logger.debug("Starting RMR thread with RMR_RTG_SVC {0}, RMR_SEED_RT {1}".format(environ.get('RMR_RTG_SVC'), environ.get('RMR_SEED_RT')))
     mdc_logger.debug("RMR initialization must complete before webserver can start")
     a1rmr.start_rmr_thread()
     mdc_logger.debug("RMR initialization complete")
+    # pick up instance deletions that were still pending when A1 last stopped
+    mdc_logger.debug("Resumed {0} pending instance deletions".format(data.resume_pending_deletions()))
     # start webserver
-    port = 10000
     mdc_logger.debug("Starting gevent webserver on port {0}".format(port))
     http_server = WSGIServer(("", port), app)
     http_server.serve_forever()
@@ -0,0 +1,108 @@
+# ==================================================================================
+#       Copyright (c) 2019 Nokia
+#       Copyright (c) 2018-2019 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+A1's SDL client.
+
+ricxappframe's SDLWrapper only has single key calls and keeps its ricsdl storage private, while
+listing and batching instances needs calls that handle many keys in one round trip. SDLClient holds
+the storage itself and has both.
+"""
+import msgpack
+from ricsdl.syncstorage import SyncStorage
+
+
+def _pack(value):
+    return msgpack.packb(value, use_bin_type=True)
+
+
+def _unpack(packed):
+    return msgpack.unpackb(packed, raw=False)
+
+
+class SDLClient:
+    """
+    The single key calls are those of SDLWrapper: values and group members are msgpack encoded
+    unless usemsgpack is False. The *_many calls take and answer values as stored.
+
+    storage is a ricsdl SyncStorage; by default one is created, in memory if use_fake_sdl.
+    """
+
+    def __init__(self, use_fake_sdl=False, storage=None):
+        if storage is None:
+            storage = SyncStorage(fake_db_backend="dict") if use_fake_sdl else SyncStorage()
+        self.storage = storage
+
+    def get(self, ns, key, usemsgpack=True):
+        value = self.storage.get(ns, {key}).get(key)
+        if value is not None and usemsgpack:
+            value = _unpack(value)
+        return value
+
+    def set(self, ns, key, value, usemsgpack=True):
+        self.storage.set(ns, {key: _pack(value) if usemsgpack else value})
+
+    def set_if(self, ns, key, old_value, new_value, usemsgpack=True):
+        if usemsgpack:
+            old_value, new_value = _pack(old_value), _pack(new_value)
+        return self.storage.set_if(ns, key, old_value, new_value)
+
+    def set_if_not_exists(self, ns, key, value, usemsgpack=True):
+        return self.storage.set_if_not_exists(ns, key, _pack(value) if usemsgpack else value)
+
+    def delete(self, ns, key):
+        self.storage.remove(ns, {key})
+
+    def delete_if(self, ns, key, value, usemsgpack=True):
+        return self.storage.remove_if(ns, key, _pack(value) if usemsgpack else value)
+
+    def find_keys(self, ns, prefix):
+        # SDL patterns are glob style
+        return self.storage.find_keys(ns, "{0}*".format(prefix))
+
+    def add_member(self, ns, group, member, usemsgpack=True):
+        self.storage.add_member(ns, group, {_pack(member) if usemsgpack else member})
+
+    def remove_member(self, ns, group, member, usemsgpack=True):
+        self.storage.remove_member(ns, group, {_pack(member) if usemsgpack else member})
+
+    def remove_group(self, ns, group):
+        self.storage.remove_group(ns, group)
+
+    def get_members(self, ns, group, usemsgpack=True):
+        members = self.storage.get_members(ns, group)
+        return {_unpack(m) for m in members} if usemsgpack else members
+
+    def healthcheck(self):
+        return self.storage.is_active()
+
+    def get_many(self, ns, keys):
+        """
+        answers a dict of key to stored value for the keys that exist
+        """
+        return self.storage.get(ns, set(keys))
+
+    def set_many(self, ns, values):
+        """
+        values is a dict of key to value to store
+        """
+        self.storage.set(ns, values)
+
+    def delete_many(self, ns, keys):
+        self.storage.remove(ns, set(keys))
+
+    def add_members(self, ns, group, members, usemsgpack=True):
+        self.storage.add_member(ns, group, {_pack(m) for m in members} if usemsgpack else set(members))
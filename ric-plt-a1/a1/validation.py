@@ -0,0 +1,132 @@
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+Validation of policy instances against the create_schema of their type.
+
+Building a jsonschema validator (and checking the schema itself) is much more expensive than
+running it, so we keep one compiled validator per policy type, keyed by a hash of its schema.
+"""
+import distutils.util
+import hashlib
+import json
+import os
+from threading import Lock
+from jsonschema.exceptions import ValidationError, best_match
+from jsonschema.validators import validator_for
+from a1 import metrics
+from a1.log import LazyLogger
+
+try:
+    import fastjsonschema
+except ImportError:  # optional; see setup.py extras
+    fastjsonschema = None
+
+USE_FAST_VALIDATOR = bool(distutils.util.strtobool(os.environ.get("A1_FAST_SCHEMA_VALIDATION", "False")))
+
+mdc_logger = LazyLogger(name=__name__)
+mdc_logger.mdclog_format_init(configmap_monitor=True)
+
+# policy_type_id -> (schema, schema hash, check function)
+_validators = {}
+_lock = Lock()
+
+
+def _schema_hash(schema):
+    """
+    answers a stable digest of a schema
+    """
+    return hashlib.sha1(json.dumps(schema, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _compile_fast(schema):
+    """
+    answers a code-generated check function, or None if fastjsonschema cannot handle this schema
+    """
+    try:
+        fast_validate = fastjsonschema.compile(schema)
+    except fastjsonschema.JsonSchemaDefinitionException as exc:
+        mdc_logger.warning("Falling back to jsonschema, fastjsonschema could not compile schema: {0}", exc, key="fast_schema_fallback")
+        return None
+
+    def check(instance):
+        try:
+            fast_validate(instance)
+        except fastjsonschema.JsonSchemaValueException as exc:
+            raise ValidationError(exc.message)
+
+    return check
+
+
+def _compile(schema):
+    """
+    answers a function that raises ValidationError if an instance does not match the schema
+    raises SchemaError if the schema itself is bad, exactly like jsonschema.validate does
+    """
+    if USE_FAST_VALIDATOR and fastjsonschema is not None:
+        check = _compile_fast(schema)
+        if check is not None:
+            return check
+
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    validator = cls(schema)
+
+    def check(instance):
+        error = best_match(validator.iter_errors(instance))
+        if error is not None:
+            raise error
+
+    return check
+
+
+def _get_check(policy_type_id, schema):
+    """
+    answers the compiled check function for a type, compiling it if the schema is new or changed
+    """
+    entry = _validators.get(policy_type_id)
+    if entry is not None and entry[0] is schema:
+        # the type cache hands out the same object until the type changes, so skip hashing
+        return entry[2]
+
+    digest = _schema_hash(schema)
+    if entry is not None and entry[1] == digest:
+        check = entry[2]
+    else:
+        check = _compile(schema)
+    with _lock:
+        _validators[policy_type_id] = (schema, digest, check)
+    return check
+
+
+# Public
+
+
+def validate_instance(policy_type_id, schema, instance):
+    """
+    validates an instance against the create_schema of its type
+    raises ValidationError on a bad instance
+    """
+    with metrics.validation_latency.time():
+        _get_check(policy_type_id, schema)(instance)
+
+
+def evict(policy_type_id):
+    """
+    forget the validator of a type; called when the type is deleted
+    """
+    with _lock:
+        _validators.pop(policy_type_id, None)
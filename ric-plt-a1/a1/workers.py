@@ -0,0 +1,137 @@
+# ==================================================================================
+#       Copyright (c) 2019 Nokia
+#       Copyright (c) 2018-2019 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+multi-worker mode (A1_WORKERS > 1)
+
+The master process binds the listening socket and starts A1_WORKERS http worker processes that all
+accept on it, each with its own SDL connection. Only the master initializes RMR and runs the rmr loop:
+workers forward their sends to it over a multiprocessing queue and follow its health through a shared
+heartbeat, so the healthcheck of every worker fails when the rmr loop does. Dead workers are replaced.
+
+Workers are started with the spawn method, so they never inherit the master's rmr threads or locks.
+All processes must share a real SDL backend; with USE_FAKE_SDL each process would have its own store.
+"""
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import time
+from threading import Event, Thread
+import gevent.socket
+from gevent.pywsgi import WSGIServer
+from mdclogpy import Logger
+from prometheus_client import multiprocess
+from a1 import app
+from a1 import a1rmr, data
+
+
+mdc_logger = Logger(name=__name__)
+mdc_logger.mdclog_format_init(configmap_monitor=True)
+
+HEARTBEAT_INTERVAL = 1
+LISTEN_BACKLOG = 1024
+
+
+def _worker(listener, channel, heartbeat):
+    """
+    runs in a worker process
+    """
+    a1rmr.forward_rmr(channel, heartbeat)
+    # gevent needs its own cooperative socket around the inherited one
+    WSGIServer(gevent.socket.socket(fileno=listener.detach()), app).serve_forever()
+
+
+def _forward(channel, heartbeat, stopped):
+    """
+    runs in the master until stopped is set; queues the sends of the workers and keeps the heartbeat current
+    """
+    while not stopped.is_set():
+        heartbeat.value = time.time() if a1rmr.healthcheck_rmr_thread() else 0
+        try:
+            kind, work_item = channel.get(timeout=HEARTBEAT_INTERVAL)
+        except queue.Empty:
+            continue
+        if kind == a1rmr.POLICY_WORK:
+            a1rmr.queue_instance_send(work_item)
+        else:
+            a1rmr.queue_ei_job_result(work_item)
+
+
+class _Master:
+    def __init__(self, port, workers):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("", port))
+        self.listener.listen(LISTEN_BACKLOG)
+        self.ctx = multiprocessing.get_context("spawn")
+        self.channel = self.ctx.Queue()
+        self.heartbeat = self.ctx.Value("d", 0.0, lock=False)
+        self.size = workers
+        self.workers = []
+        self.keep_going = True
+        self.stopped = Event()
+
+    def _spawn(self):
+        proc = self.ctx.Process(target=_worker, args=(self.listener, self.channel, self.heartbeat), name="a1-http-worker", daemon=True)
+        proc.start()
+        mdc_logger.debug("Started http worker {0}".format(proc.pid))
+        return proc
+
+    def _reap(self, proc):
+        mdc_logger.warning("http worker {0} exited with {1}, replacing it".format(proc.pid, proc.exitcode))
+        if os.environ.get("prometheus_multiproc_dir"):
+            multiprocess.mark_process_dead(proc.pid)
+        # instance deletions the worker had scheduled died with it
+        data.resume_pending_deletions()
+
+    def _stop(self, signum, frame):
+        self.keep_going = False
+
+    def serve(self):
+        # index sets and value encoding, once for all the workers, before any of them serves
+        data.prepare_database()
+        self.workers = [self._spawn() for _ in range(self.size)]
+        a1rmr.start_rmr_thread()
+        mdc_logger.debug("RMR initialization complete")
+        # pick up instance deletions that were still pending when A1 last stopped
+        mdc_logger.debug("Resumed {0} pending instance deletions".format(data.resume_pending_deletions()))
+        Thread(target=_forward, args=(self.channel, self.heartbeat, self.stopped), name="a1-worker-forwarder", daemon=True).start()
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        while self.keep_going:
+            for i, proc in enumerate(self.workers):
+                if not proc.is_alive():
+                    self._reap(proc)
+                    self.workers[i] = self._spawn()
+            time.sleep(HEARTBEAT_INTERVAL)
+
+        mdc_logger.debug("Stopping http workers")
+        for proc in self.workers:
+            proc.terminate()
+        for proc in self.workers:
+            proc.join(HEARTBEAT_INTERVAL)
+        self.stopped.set()
+        a1rmr.stop_rmr_thread()
+
+
+def serve(port, workers):
+    """
+    serves the A1 API on port with several worker processes until the process is told to stop
+    """
+    _Master(port, workers).serve()
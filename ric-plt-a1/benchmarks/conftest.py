@@ -0,0 +1,90 @@
+"""
+pytest conftest for the a1.data micro-benchmarks
+"""
+# ==================================================================================
+#       Copyright (c) 2019 Nokia
+#       Copyright (c) 2018-2019 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+import itertools
+import os
+import pytest
+from a1 import data, metrics
+from a1.sdl import SDLClient
+
+# how many instances the populated type holds; list, status and query timings grow with it
+BENCH_INSTANCES = int(os.environ.get("A1_BENCH_INSTANCES", 1000))
+# how many handlers report for each instance
+BENCH_HANDLERS = int(os.environ.get("A1_BENCH_HANDLERS", 3))
+BENCH_TYPE_ID = 20008
+
+_type_ids = itertools.count(100000)
+
+
+def type_body(policy_type_id):
+    """
+    a small policy type, like the ones in the user guide
+    """
+    return {
+        "name": "tsapolicy",
+        "description": "tsa parameters",
+        "policy_type_id": policy_type_id,
+        "create_schema": {
+            "$schema": "http://json-schema.org/draft-07/schema#",
+            "type": "object",
+            "properties": {"threshold": {"type": "integer", "default": 0}},
+            "additionalProperties": False,
+        },
+    }
+
+
+def next_type_id():
+    """
+    a type id that no benchmark used yet
+    """
+    return next(_type_ids)
+
+
+@pytest.fixture(autouse=True)
+def fake_sdl(monkeypatch):
+    """
+    every benchmark starts from an empty fake SDL and cold caches
+    """
+    monkeypatch.setattr(data, "SDL", metrics.TimedSDL(SDLClient(use_fake_sdl=True)))
+    monkeypatch.setattr(data, "_type_cache", data._TypeCache(data.TYPE_CACHE_SIZE, data.TYPE_CACHE_TTL, data.TYPE_CACHE_GENERATION_CHECK))
+    monkeypatch.setattr(data, "_query_snapshot", data._QuerySnapshot())
+    monkeypatch.setattr(data, "_type_etags", {})
+    monkeypatch.setattr(data, "_indexes_ready", False)
+    # deletions scheduled by the benchmarks must not run into the next one's SDL
+    monkeypatch.setattr(data, "INSTANCE_DELETE_NO_RESP_TTL", 3600)
+    monkeypatch.setattr(data, "INSTANCE_DELETE_RESP_TTL", 3600)
+
+
+@pytest.fixture
+def populated_type():
+    """
+    a type with BENCH_INSTANCES instances, each with BENCH_HANDLERS handler statuses, half of them OK
+    answers the type id and the instance ids
+    """
+    data.store_policy_type(BENCH_TYPE_ID, type_body(BENCH_TYPE_ID))
+    instance_ids = ["instance{0:07d}".format(i) for i in range(BENCH_INSTANCES)]
+    data.store_policy_instances(BENCH_TYPE_ID, {iid: {"threshold": i} for i, iid in enumerate(instance_ids)})
+    data.set_policy_instance_statuses(
+        [
+            (BENCH_TYPE_ID, iid, "handler{0}".format(h), "OK" if i % 2 else "ERROR")
+            for i, iid in enumerate(instance_ids)
+            for h in range(BENCH_HANDLERS)
+        ]
+    )
+    return BENCH_TYPE_ID, instance_ids
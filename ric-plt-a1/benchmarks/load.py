@@ -0,0 +1,156 @@
+"""
+HTTP load driver for a running A1 mediator
+
+Creates policy types, then PUTs, lists, reads the status of and DELETEs a number of instances of the first
+from a pool of threads, and reports the throughput and the p50/p99 latency of each operation, e.g.
+
+    python benchmarks/load.py --url http://localhost:10000 --instances 5000 --threads 32
+
+The types are deleted at the end once A1 has finally deleted the instances, which takes the delete TTLs.
+"""
+# ==================================================================================
+#       Copyright (c) 2019 Nokia
+#       Copyright (c) 2018-2019 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+
+TYPE_BODY = {
+    "name": "loadpolicy",
+    "description": "policy type of the A1 load driver",
+    "create_schema": {
+        "$schema": "http://json-schema.org/draft-07/schema#",
+        "type": "object",
+        "properties": {"threshold": {"type": "integer", "default": 0}},
+        "additionalProperties": False,
+    },
+}
+
+
+class Driver:
+    """
+    sends the requests of one operation from a thread pool and records their latencies
+    """
+
+    def __init__(self, url, threads):
+        self.url = url.rstrip("/") + "/a1-p"
+        self.threads = threads
+        self._local = threading.local()
+
+    def _session(self):
+        # requests sessions are not thread safe, so each thread keeps its own connection
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def send(self, method, path, expected, json=None):
+        """
+        sends one request, answers its latency and whether its status code was expected
+        """
+        started = time.perf_counter()
+        try:
+            res = self._session().request(method, self.url + path, json=json, timeout=30)
+            ok = res.status_code in expected
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    def run(self, name, method, calls, expected):
+        """
+        sends one request per (path, body) in calls, answers the operation's report
+        """
+        started = time.perf_counter()
+        with ThreadPoolExecutor(self.threads) as pool:
+            results = list(pool.map(lambda call: self.send(method, call[0], expected, call[1]), calls))
+        return report(name, results, time.perf_counter() - started)
+
+
+def percentile(ordered, fraction):
+    """
+    nearest-rank percentile of a sorted list
+    """
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def report(name, results, elapsed):
+    """
+    answers the throughput and latencies of one operation
+    """
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        "operation": name,
+        "requests": len(results),
+        "errors": sum(1 for _, ok in results if not ok),
+        "throughput": len(results) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def print_reports(reports):
+    """
+    prints the reports as a table
+    """
+    print("{0:<16}{1:>10}{2:>8}{3:>12}{4:>10}{5:>10}".format("operation", "requests", "errors", "req/s", "p50 ms", "p99 ms"))
+    for r in reports:
+        print("{operation:<16}{requests:>10}{errors:>8}{throughput:>12.1f}{p50_ms:>10.2f}{p99_ms:>10.2f}".format(**r))
+
+
+def main():
+    """
+    runs the load
+    """
+    parser = argparse.ArgumentParser(description="A1 mediator HTTP load driver")
+    parser.add_argument("--url", default="http://localhost:10000", help="base url of A1")
+    parser.add_argument("--instances", type=int, default=1000, help="number of policy instances")
+    parser.add_argument("--threads", type=int, default=16, help="number of concurrent clients")
+    parser.add_argument("--types", type=int, default=100, help="number of policy types to create")
+    parser.add_argument("--reads", type=int, default=100, help="number of instance list requests")
+    parser.add_argument("--type-id", type=int, default=900000, help="first policy type id to use")
+    parser.add_argument("--keep", action="store_true", help="do not wait to delete the policy types")
+    args = parser.parse_args()
+
+    driver = Driver(args.url, args.threads)
+    type_ids = list(range(args.type_id, args.type_id + args.types))
+    tid = type_ids[0]
+    instances = ["/policytypes/{0}/policies/load{1}".format(tid, i) for i in range(args.instances)]
+
+    reports = [
+        driver.run("type create", "PUT", [("/policytypes/{0}".format(t), dict(TYPE_BODY, policy_type_id=t)) for t in type_ids], (201,)),
+        driver.run("instance put", "PUT", [(path, {"threshold": 5}) for path in instances], (202,)),
+        driver.run("instance list", "GET", [("/policytypes/{0}/policies".format(tid), None)] * args.reads, (200,)),
+        driver.run("instance status", "GET", [(path + "/status", None) for path in instances], (200,)),
+        driver.run("instance delete", "DELETE", [(path, None) for path in instances], (202,)),
+    ]
+    print_reports(reports)
+
+    if args.keep:
+        return
+    # instances are gone once the delete TTLs expired; then the types can go
+    deadline = time.time() + 600
+    for t in type_ids:
+        while not driver.send("DELETE", "/policytypes/{0}".format(t), (204, 404))[1] and time.time() < deadline:
+            time.sleep(1)
+
+
+if __name__ == "__main__":
+    main()
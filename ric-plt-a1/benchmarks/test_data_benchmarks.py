@@ -0,0 +1,141 @@
+"""
+micro-benchmarks of a1.data on the fake SDL
+
+run with tox -e benchmark, or pytest benchmarks; A1_BENCH_INSTANCES sets the size of the populated type
+"""
+# ==================================================================================
+#       Copyright (c) 2019 Nokia
+#       Copyright (c) 2018-2019 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+import itertools
+from a1 import data
+from conftest import BENCH_HANDLERS, next_type_id, type_body
+
+
+def test_store_policy_type(benchmark):
+    """
+    type create
+    """
+    def setup():
+        policy_type_id = next_type_id()
+        return (policy_type_id, type_body(policy_type_id)), {}
+
+    benchmark.pedantic(data.store_policy_type, setup=setup, rounds=200)
+
+
+def test_get_policy_type(benchmark, populated_type):
+    """
+    type read, answered by the type cache
+    """
+    policy_type_id, _ = populated_type
+    benchmark(data.get_policy_type, policy_type_id)
+
+
+def test_store_policy_instance_create(benchmark, populated_type):
+    """
+    instance PUT of a new instance
+    """
+    policy_type_id, _ = populated_type
+    ids = ("new{0}".format(i) for i in itertools.count())
+
+    def setup():
+        return (policy_type_id, next(ids), {"threshold": 1}), {}
+
+    benchmark.pedantic(data.store_policy_instance, setup=setup, rounds=500)
+
+
+def test_store_policy_instance_update(benchmark, populated_type):
+    """
+    instance PUT replacing an instance that has handler statuses
+    """
+    policy_type_id, instance_ids = populated_type
+    ids = itertools.cycle(instance_ids)
+
+    def setup():
+        return (policy_type_id, next(ids), {"threshold": 2}), {}
+
+    benchmark.pedantic(data.store_policy_instance, setup=setup, rounds=min(500, len(instance_ids)))
+
+
+def test_get_instance_list(benchmark, populated_type):
+    """
+    list of all instance ids of the type
+    """
+    policy_type_id, instance_ids = populated_type
+    assert len(benchmark(data.get_instance_list, policy_type_id)) == len(instance_ids)
+
+
+def test_iter_instance_list_by_status(benchmark, populated_type):
+    """
+    listing filtered by status, which reads the metadata of every instance
+    """
+    policy_type_id, instance_ids = populated_type
+    found = benchmark(lambda: list(data.iter_instance_list(policy_type_id, status="IN EFFECT")))
+    assert len(found) == len(instance_ids) // 2
+
+
+def test_get_policy_instance_status(benchmark, populated_type):
+    """
+    status of one instance
+    """
+    policy_type_id, instance_ids = populated_type
+    benchmark(data.get_policy_instance_status, policy_type_id, instance_ids[len(instance_ids) // 2])
+
+
+def test_iter_policy_instance_statuses(benchmark, populated_type):
+    """
+    bulk status of every instance of the type
+    """
+    policy_type_id, instance_ids = populated_type
+    found = benchmark(lambda: list(data.iter_policy_instance_statuses(policy_type_id)))
+    assert len(found) == len(instance_ids)
+
+
+def test_set_policy_instance_statuses(benchmark, populated_type):
+    """
+    one batch of handler responses as the rmr thread receives it, each one flipping a status
+    """
+    policy_type_id, instance_ids = populated_type
+    batch = instance_ids[:100]
+    rounds = itertools.count()
+
+    def setup():
+        status = "OK" if next(rounds) % 2 else "ERROR"
+        return ([(policy_type_id, iid, "handler{0}".format(h), status) for iid in batch for h in range(BENCH_HANDLERS)],), {}
+
+    benchmark.pedantic(data.set_policy_instance_statuses, setup=setup, rounds=100)
+
+
+def test_get_policy_query_payloads(benchmark, populated_type):
+    """
+    the CREATE messages answering an A1_POLICY_QUERY for the type
+    """
+    policy_type_id, instance_ids = populated_type
+    assert len(benchmark(data.get_policy_query_payloads, policy_type_id)) == len(instance_ids)
+
+
+def test_delete_policy_instance(benchmark, populated_type):
+    """
+    instance DELETE; the instance is only marked, the final deletion is scheduled
+    """
+    policy_type_id, _ = populated_type
+    ids = ("deleted{0}".format(i) for i in itertools.count())
+
+    def setup():
+        policy_instance_id = next(ids)
+        data.store_policy_instance(policy_type_id, policy_instance_id, {"threshold": 3})
+        return (policy_type_id, policy_instance_id), {}
+
+    benchmark.pedantic(data.delete_policy_instance, setup=setup, rounds=500)
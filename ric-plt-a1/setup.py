@@ -26,5 +26,6 @@
     entry_points={"console_scripts": ["run-a1=a1.run:main"]},
     # we require jsonschema, should be in that list, but connexion already requires a specific version of it
     install_requires=["requests", "Flask", "connexion[swagger-ui]", "gevent", "prometheus-client", "mdclogpy", "ricxappframe>=2.0.0,<3.0.0"],
+    extras_require={"fast-validation": ["fastjsonschema"], "fast-json": ["orjson"], "asyncio": ["uvicorn", "a2wsgi"], "compression": ["zstandard"]},
     package_data={"a1": ["openapi.yaml"]},
 )
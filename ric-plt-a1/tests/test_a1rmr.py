@@ -0,0 +1,295 @@
+"""
+tests for the rmr send queues
+"""
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+import json
+import time
+from threading import Event, Lock, Thread
+import pytest
+from a1 import a1rmr, messages
+
+
+def _put(q, operation, policy_instance_id, payload=None):
+    """queue a policy work item the way queue_instance_send does"""
+    item = (operation, 20000, policy_instance_id, payload)
+    return q.put((a1rmr.POLICY_WORK, 20000, policy_instance_id), (a1rmr.POLICY_WORK, item), a1rmr._coalesce)
+
+
+def _drain(q):
+    items = []
+    while q.qsize():
+        items.append(q.get()[1])
+    return items
+
+
+def test_coalesce_updates():
+    """
+    only the latest update of an instance is sent, in the position of the first one
+    """
+    q = a1rmr._CoalescingQueue()
+    assert _put(q, "UPDATE", "a", 1) == 1
+    assert _put(q, "UPDATE", "b", 1) == 1
+    assert _put(q, "UPDATE", "a", 2) == 0
+    assert _put(q, "UPDATE", "a", 3) == 0
+    assert _drain(q) == [("UPDATE", 20000, "a", 3), ("UPDATE", 20000, "b", 1)]
+
+
+def test_coalesce_create_delete():
+    """
+    create then update stays a create; create then delete sends nothing; delete then create is an update
+    """
+    q = a1rmr._CoalescingQueue()
+    _put(q, "CREATE", "a", 1)
+    _put(q, "UPDATE", "a", 2)
+    _put(q, "CREATE", "b", 1)
+    assert _put(q, "DELETE", "b") == -1
+    _put(q, "DELETE", "c")
+    _put(q, "CREATE", "c", 5)
+    assert _drain(q) == [("CREATE", 20000, "a", 2), ("UPDATE", 20000, "c", 5)]
+
+
+def test_no_coalesce_without_key():
+    """
+    ei data deliveries are never merged
+    """
+    q = a1rmr._CoalescingQueue()
+    assert q.put(None, (a1rmr.EI_WORK, ("1", {"n": 1}))) == 1
+    assert q.put(None, (a1rmr.EI_WORK, ("1", {"n": 2}))) == 1
+    assert _drain(q) == [("1", {"n": 1}), ("1", {"n": 2})]
+
+
+def test_sender_pool_order_and_drain():
+    """
+    items of one key are sent in the order they were submitted, even with other keys in flight,
+    and stop returns only once everything queued was sent
+    """
+    sent = []
+    lock = Lock()
+
+    def handler(kind, work_item):
+        time.sleep(0.001)  # keep the queues filled while submitting
+        with lock:
+            sent.append(work_item)
+
+    pool = a1rmr._SenderPool(handler, 3)
+    keys = ["k{0}".format(i) for i in range(8)]
+    submitters = [Thread(target=lambda key=key: [pool.submit(key, a1rmr.EI_WORK, (key, n)) for n in range(50)]) for key in keys]
+    for t in submitters:
+        t.start()
+    for t in submitters:
+        t.join()
+    assert pool.depth() > 0
+    pool.stop(timeout=30)
+
+    assert pool.depth() == 0
+    assert not any(t.is_alive() for t in pool.threads)
+    assert len(sent) == len(keys) * 50
+    for key in keys:
+        assert [n for k, n in sent if k == key] == list(range(50))
+
+
+class _FakeResponse:
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+
+class _FakeEcs:
+    """answers queued responses and records the request headers"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, headers=None, **kwargs):
+        self.requests.append(headers)
+        resp = self.responses.pop(0)
+        if isinstance(resp, Exception):
+            raise resp
+        return resp
+
+    def stop(self):
+        pass
+
+
+def test_ei_types_revalidated():
+    """
+    a stale ei type list is revalidated with its etag; a 304 or an unreachable ECS keeps the cached list
+    """
+    ecs = _FakeEcs(
+        _FakeResponse(200, b'["t1"]', {"ETag": '"v1"'}),
+        _FakeResponse(304),
+        a1rmr.requests.ConnectionError("down"),
+        _FakeResponse(200, b'["t1","t2"]', {"ETag": '"v2"'}),
+    )
+    catalogue = a1rmr._EiTypeCatalogue(ecs, ttl=60)
+    assert catalogue.fresh() is None
+    assert catalogue.get() == b'["t1"]'
+    assert catalogue.get() == b'["t1"]'
+    assert len(ecs.requests) == 1
+
+    catalogue.ttl = 0
+    assert catalogue.get() == b'["t1"]'
+    assert ecs.requests[1] == {"If-None-Match": '"v1"'}
+    assert catalogue.get() == b'["t1"]'
+    assert catalogue.get() == b'["t1","t2"]'
+    assert ecs.requests[3] == {"If-None-Match": '"v1"'}
+
+
+def test_ei_types_refresher():
+    """
+    the background refresher revalidates the list on every tick, even while it is fresh
+    """
+    ecs = _FakeEcs(_FakeResponse(200, b'["t1"]', {"ETag": '"v1"'}), _FakeResponse(304), _FakeResponse(200, b'["t2"]', {"ETag": '"v2"'}))
+    catalogue = a1rmr._EiTypeCatalogue(ecs, ttl=3600)
+    stopped = Event()
+    refresher = Thread(target=catalogue.refresh_every, args=(0.01, stopped))
+    refresher.start()
+    deadline = time.time() + 5
+    while ecs.responses and time.time() < deadline:
+        time.sleep(0.01)
+    stopped.set()
+    refresher.join(5)
+    assert ecs.requests[1:3] == [{"If-None-Match": '"v1"'}] * 2
+    assert catalogue.fresh() == b'["t2"]'
+
+
+def test_ei_types_not_cached_on_error():
+    """
+    an error answer is never sent to xApps as the type list
+    """
+    catalogue = a1rmr._EiTypeCatalogue(_FakeEcs(_FakeResponse(500, b"oops")), ttl=60)
+    assert catalogue.get() is None
+
+
+class _FakeSession:
+    """answers queued responses to session.request and records the timeouts"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.timeouts = []
+
+    def request(self, method, url, timeout=None, **kwargs):
+        self.timeouts.append(timeout)
+        resp = self.responses.pop(0)
+        if isinstance(resp, Exception):
+            raise resp
+        return resp
+
+    def close(self):
+        pass
+
+
+def test_ecs_retries(monkeypatch):
+    """
+    connection errors and 5xx answers are retried with exponential backoff; the last attempt is answered or raised
+    """
+    monkeypatch.setattr(a1rmr, "ECS_RETRY_TIMES", 4)
+    backoffs = []
+    monkeypatch.setattr(a1rmr.random, "uniform", lambda low, high: backoffs.append((low, high)) or 0)
+    ecs = a1rmr._EcsClient(1)
+    try:
+        down = a1rmr.requests.ConnectionError("down")
+        ecs.session = _FakeSession(down, a1rmr.requests.Timeout("slow"), _FakeResponse(503), _FakeResponse(200, b"[]"))
+        assert ecs.request("GET", "http://ecs").content == b"[]"
+        assert ecs.session.timeouts == [a1rmr.ECS_TIMEOUT] * 4
+        assert backoffs == [(0, a1rmr.ECS_RETRY_BACKOFF * 2 ** attempt) for attempt in (1, 2, 3)]
+
+        backoffs.clear()
+        ecs.session = _FakeSession(*[_FakeResponse(503)] * 4)
+        assert ecs.request("GET", "http://ecs").status_code == 503
+        assert len(ecs.session.timeouts) == 4
+        ecs.session = _FakeSession(*[down] * 4)
+        with pytest.raises(a1rmr.requests.ConnectionError):
+            ecs.request("GET", "http://ecs")
+        assert len(ecs.session.timeouts) == 4
+        assert len(backoffs) == 6
+    finally:
+        ecs.stop()
+
+
+@pytest.fixture
+def rmr_loop(monkeypatch):
+    """
+    an rmr loop without rmr, that records the buffers it frees and answers with
+    """
+    rmr_loop = a1rmr._RmrLoop(init_func_override=lambda: None, rcv_func_override=lambda: [], run_in_thread=False)
+    rmr_loop.freed = []
+    rmr_loop.answered = []
+
+    def rts(payload, sbuf, mtype):
+        rmr_loop.answered.append((payload, mtype))
+        return "rts " + sbuf  # rts may answer a new buffer
+
+    monkeypatch.setattr(a1rmr.rmr, "rmr_free_msg", rmr_loop.freed.append)
+    monkeypatch.setattr(rmr_loop, "_rts_msg", rts)
+    ecs = rmr_loop.ecs
+    yield rmr_loop
+    rmr_loop.stop()
+    ecs.stop()
+
+
+def test_ei_query_all_frees_sbuf(rmr_loop):
+    """
+    the buffer of an ei type query is freed once, whether ECS answered or not
+    """
+    rmr_loop.ei_types = a1rmr._EiTypeCatalogue(_FakeEcs(_FakeResponse(200, b'["t1"]')), ttl=60)
+    rmr_loop._handle_ei_query_all("sbuf")
+    assert rmr_loop.answered == [(b'["t1"]', a1rmr.AI_EI_QUERY_ALL_RESP)]
+    assert rmr_loop.freed == ["rts sbuf"]
+
+    rmr_loop.ei_types = a1rmr._EiTypeCatalogue(_FakeEcs(_FakeResponse(500)), ttl=60)
+    rmr_loop._handle_ei_query_all("sbuf")
+    rmr_loop.ei_types = a1rmr._EiTypeCatalogue(_FakeEcs(RuntimeError("unexpected")), ttl=60)
+    with pytest.raises(RuntimeError):
+        rmr_loop._handle_ei_query_all("sbuf")
+    assert len(rmr_loop.answered) == 1
+    assert rmr_loop.freed == ["rts sbuf", "sbuf", "sbuf"]
+
+
+def test_ei_create_job_frees_sbuf(rmr_loop):
+    """
+    the buffer of an ei job request is freed once, whether the job was created, refused, failed or malformed
+    """
+    def job(job_id):
+        return {a1rmr.rmr.RMR_MS_PAYLOAD: json.dumps({"job-id": job_id, "ei_type_id": "t1"})}
+
+    rmr_loop.ecs = _FakeEcs(_FakeResponse(201), _FakeResponse(500), a1rmr.requests.ConnectionError("down"))
+    rmr_loop._handle_ei_create_job(job("1"), "sbuf")
+    assert rmr_loop.answered == [(messages.ei_job_created_bytes("1"), a1rmr.A1_EI_CREATE_JOB_RESP)]
+    assert rmr_loop.freed == ["rts sbuf"]
+
+    rmr_loop._handle_ei_create_job(job("2"), "sbuf")
+    rmr_loop._handle_ei_create_job(job("3"), "sbuf")
+    rmr_loop._handle_ei_create_job({a1rmr.rmr.RMR_MS_PAYLOAD: "{"}, "sbuf")
+    assert len(rmr_loop.answered) == 1
+    assert rmr_loop.freed == ["rts sbuf", "sbuf", "sbuf", "sbuf"]
+    assert rmr_loop.ecs.responses == []
+
+
+def test_encoded_messages():
+    """
+    pre-serialised payloads are spliced into the message unchanged
+    """
+    payload = {"enforce": True, "window_length": 10}
+    msg = messages.a1_to_handler_bytes("CREATE", 20000, "a", json.dumps(payload).encode("utf-8"))
+    assert json.loads(msg) == messages.a1_to_handler("CREATE", 20000, "a", payload)
+    assert json.loads(messages.a1_to_handler_bytes("DELETE", 20000, "a", "")) == messages.a1_to_handler("DELETE", 20000, "a", "")
+    assert json.loads(messages.ei_to_handler_bytes("1", payload)) == messages.ei_to_handler("1", payload)
+    assert json.loads(messages.ei_job_created_bytes("1")) == {"ei_job_id": "1"}
@@ -0,0 +1,96 @@
+"""
+smoke test for the asyncio server mode
+"""
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+import asyncio
+import functools
+import socket
+import time
+from threading import Thread
+import pytest
+import requests
+from a1 import a1rmr, data, metrics
+from a1.sdl import SDLClient
+
+pytest.importorskip("uvicorn")
+pytest.importorskip("a2wsgi")
+from a1 import aio  # noqa: E402  only importable with the asyncio extra
+
+TYPE_ID = 20001
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until(condition, seconds=10):
+    deadline = time.time() + seconds
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def test_aio_put_reaches_rmr_loop(monkeypatch, adm_type_good, adm_instance_good):
+    """
+    an instance PUT to the uvicorn server is sent by the rmr loop task of the same event loop
+    """
+    monkeypatch.setattr(data, "SDL", metrics.TimedSDL(SDLClient(use_fake_sdl=True)))
+    monkeypatch.setattr(data, "_type_cache", data._TypeCache(10, 30, 0))
+    monkeypatch.setattr(data, "_indexes_ready", False)
+    monkeypatch.setattr(a1rmr, "__RMR_LOOP__", None)
+    monkeypatch.setattr(a1rmr, "start_rmr_task", functools.partial(a1rmr.start_rmr_task, init_func_override=lambda: None, rcv_func_override=lambda: []))
+
+    sent = []
+    monkeypatch.setattr(a1rmr._RmrLoop, "_handle_send", lambda rmr_loop, kind, work_item: sent.append((rmr_loop, kind, work_item)))
+
+    # keep hold of the server, to stop it
+    servers = []
+
+    class Server(aio.uvicorn.Server):
+        def __init__(self, config):
+            super().__init__(config)
+            servers.append(self)
+
+    monkeypatch.setattr(aio.uvicorn, "Server", Server)
+
+    port = _free_port()
+    thread = Thread(target=asyncio.run, args=(aio._serve(port),), daemon=True)
+    thread.start()
+    base = "http://127.0.0.1:{0}/a1-p".format(port)
+    try:
+        assert _wait_until(lambda: servers and servers[0].started)
+        assert requests.get(base + "/healthcheck").status_code == 200
+
+        adm_type_good["policy_type_id"] = TYPE_ID
+        assert requests.put("{0}/policytypes/{1}".format(base, TYPE_ID), json=adm_type_good).status_code == 201
+        res = requests.put("{0}/policytypes/{1}/policies/smoke".format(base, TYPE_ID), json=adm_instance_good)
+        assert res.status_code == 202
+
+        assert _wait_until(lambda: sent)
+        rmr_loop, kind, work_item = sent[0]
+        assert rmr_loop is a1rmr.__RMR_LOOP__
+        assert rmr_loop.task is not None and rmr_loop.is_alive()
+        assert kind == a1rmr.POLICY_WORK
+        assert work_item[:3] == ("CREATE", TYPE_ID, "smoke")
+    finally:
+        if servers:
+            servers[0].should_exit = True
+        thread.join(10)
+    assert not thread.is_alive()
@@ -0,0 +1,89 @@
+"""
+tests for the encoding of stored values
+"""
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+import msgpack
+from a1 import codec, data
+from a1.sdl import SDLClient
+
+METADATA = {"created_at": 1602840000.5, "has_been_deleted": False, "version": 3, "handlers_ok": 1, "handlers_total": 2}
+
+
+def test_compact_codec():
+    """
+    compact values are smaller and round trip; values without A1's fields are plain msgpack, and every codec reads them all
+    """
+    compact = codec.CompactCodec()
+    packed = compact.encode(METADATA)
+    assert len(packed) < len(msgpack.packb(METADATA)) // 2
+    assert compact.decode(packed) == METADATA
+    assert compact.encode({"threshold": 5}) == msgpack.packb({"threshold": 5})
+    assert codec.MsgpackCodec().decode(packed) == METADATA
+    if codec.zstandard is not None:
+        large = {"created_at": 1, "payload": ["the same words again"] * 100}
+        packed = codec.CompactCodec(compress_min=64).encode(large)
+        assert len(packed) < 100
+        assert compact.decode(packed) == large
+
+
+def test_reencode_at_startup(monkeypatch):
+    """
+    a database written before codecs is read as it is, and re-encoded once when A1 starts with another codec;
+    requests never re-encode
+    """
+    compact = codec.CompactCodec()
+    sdl = SDLClient(use_fake_sdl=True)
+    monkeypatch.setattr(data, "SDL", sdl)
+    monkeypatch.setattr(data, "_indexes_ready", False)
+    monkeypatch.setattr(data, "_codec", compact)
+    sdl.set(data.A1NS, data._generate_type_key(20000), {"name": "t", "description": "", "policy_type_id": 20000, "create_schema": {}})
+    sdl.set(data.A1NS, data._generate_instance_key(20000, "a"), {"threshold": 5})
+    metadata_key = data._generate_instance_metadata_key(20000, "a")
+    metadata = {"created_at": 1602840000.5, "has_been_deleted": False}
+    sdl.set(data.A1NS, metadata_key, metadata)
+
+    assert data.get_instance_list(20000) == ["a"]
+    assert data.get_policy_instance(20000, "a") == {"threshold": 5}
+    assert sdl.get(data.A1NS, metadata_key, usemsgpack=False) == msgpack.packb(metadata)
+
+    data.prepare_database()
+    assert sdl.get(data.A1NS, metadata_key, usemsgpack=False) == compact.encode(metadata)
+    assert data.get_policy_instance_status(20000, "a") == dict(metadata, instance_status="NOT IN EFFECT")
+    assert sdl.get(data.A1NS, data.VALUE_CODEC_KEY) == "compact"
+
+    # and back, for a downgrade
+    monkeypatch.setattr(data, "_codec", codec.MsgpackCodec())
+    data.prepare_database()
+    assert sdl.get(data.A1NS, metadata_key, usemsgpack=False) == msgpack.packb(metadata)
+
+
+def test_msgpack_database_not_scanned(monkeypatch):
+    """
+    with the default codec, a database written before codecs needs no re-encoding
+    """
+    sdl = SDLClient(use_fake_sdl=True)
+    monkeypatch.setattr(data, "SDL", sdl)
+    monkeypatch.setattr(data, "_indexes_ready", True)
+    monkeypatch.setattr(data, "_codec", codec.MsgpackCodec())
+
+    def reencode():
+        raise AssertionError("re-encoded a database that is already msgpack")
+
+    monkeypatch.setattr(data, "_reencode_values", reencode)
+    data.prepare_database()
+    assert sdl.get(data.A1NS, data.VALUE_CODEC_KEY) == "msgpack"
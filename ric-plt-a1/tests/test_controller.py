@@ -19,10 +19,14 @@
 # ==================================================================================
 import time
 import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pytest
 from ricxappframe.rmr.rmr_mocks import rmr_mocks
-from ricxappframe.xapp_sdl import SDLWrapper
 from ricsdl.exceptions import RejectedByBackend, NotConnected, BackendError
-from a1 import a1rmr, data
+from a1 import app, a1rmr, controller, data, metrics
+from a1.exceptions import PolicyInstanceConflict
+from a1.sdl import SDLClient
 
 RCV_ID = "test_receiver"
 ADM_CRTL_TID = 6660666
@@ -30,6 +34,7 @@
 ADM_CTRL_POLICIES = "/a1-p/policytypes/{0}/policies".format(ADM_CRTL_TID)
 ADM_CTRL_INSTANCE = ADM_CTRL_POLICIES + "/" + ADM_CTRL_IID
 ADM_CTRL_INSTANCE_STATUS = ADM_CTRL_INSTANCE + "/status"
+ADM_CTRL_BATCH = ADM_CTRL_POLICIES + ":batch"
 ADM_CTRL_TYPE = "/a1-p/policytypes/{0}".format(ADM_CRTL_TID)
 ACK_MT = 20011
 
@@ -233,7 +238,7 @@ def setup_module():
     """module level setup"""
 
     # swap sdl for the fake backend
-    data.SDL = SDLWrapper(use_fake_sdl=True)
+    data.SDL = metrics.TimedSDL(SDLClient(use_fake_sdl=True))
 
     def noop():
         pass
@@ -320,6 +325,295 @@ def test_cleanup_via_t1(client, monkeypatch, adm_type_good, adm_instance_good):
     _delete_ac_type(client)
 
 
+def test_batch_instances(client, monkeypatch, adm_type_good, adm_instance_good):
+    """
+    create several instances with one request, one of them bad
+    """
+    _put_ac_type(client, adm_type_good)
+
+    a1rmr.replace_rcv_func(_fake_dequeue_none)
+    _test_put_patch(monkeypatch)
+
+    batch = [
+        {"policy_instance_id": ADM_CTRL_IID, "payload": adm_instance_good},
+        {"policy_instance_id": "bad_instance", "payload": {"not": "expected"}},
+        {"policy_instance_id": "second_instance", "payload": adm_instance_good},
+    ]
+    res = client.post(ADM_CTRL_BATCH, json=batch)
+    assert res.status_code == 200
+    assert [(r["policy_instance_id"], r["status"]) for r in res.json] == [
+        (ADM_CTRL_IID, 202),
+        ("bad_instance", 400),
+        ("second_instance", 202),
+    ]
+
+    # only the good ones were stored
+    res = client.get(ADM_CTRL_POLICIES)
+    assert res.status_code == 200
+    assert res.json == [ADM_CTRL_IID, "second_instance"]
+    _verify_instance_and_status(client, adm_instance_good, "NOT IN EFFECT", False)
+
+    # replacing in a batch is allowed too
+    res = client.post(ADM_CTRL_BATCH, json=batch[:1])
+    assert res.status_code == 200
+    assert res.json[0]["status"] == 202
+
+    # but not twice in the same batch
+    twice = [{"policy_instance_id": "third_instance", "payload": adm_instance_good}] * 2 + batch[:1]
+    res = client.post(ADM_CTRL_BATCH, json=twice)
+    assert res.status_code == 200
+    assert [r["status"] for r in res.json] == [400, 400, 202]
+    res = client.get(ADM_CTRL_POLICIES + "/third_instance")
+    assert res.status_code == 404
+
+    # an instance that other writers keep changing is a 409 of its own, and is not sent
+    def contended(policy_type_id, policy_instance_id, *args):
+        if policy_instance_id == "third_instance":
+            raise PolicyInstanceConflict(policy_type_id)
+
+    with monkeypatch.context() as m:
+        m.setattr(data, "_write_instances", lambda instances, *args: list(instances))
+        m.setattr(data, "_claim_instance", contended)
+        sent = []
+        m.setattr(a1rmr, "queue_instance_send", sent.append)
+        res = client.post(ADM_CTRL_BATCH, json=[{"policy_instance_id": "third_instance", "payload": adm_instance_good}] + batch[:1])
+    assert res.status_code == 200
+    assert [r["status"] for r in res.json] == [409, 202]
+    assert [item[2] for item in sent] == [ADM_CTRL_IID]
+
+    # type must exist
+    res = client.post("/a1-p/policytypes/911/policies:batch", json=batch)
+    assert res.status_code == 404
+
+    # clean up
+    res = client.delete(ADM_CTRL_POLICIES + "/second_instance")
+    assert res.status_code == 202
+    _delete_instance(client)
+    _instance_is_gone(client)
+    _delete_ac_type(client)
+
+
+def test_list_instances(client, monkeypatch, adm_type_good, adm_instance_good):
+    """
+    list instances a page at a time, and filtered
+    """
+    _put_ac_type(client, adm_type_good)
+    a1rmr.replace_rcv_func(_fake_dequeue_none)
+    _test_put_patch(monkeypatch)
+
+    ids = [ADM_CTRL_IID, "i1", "i2", "i3", "i4"]
+    res = client.post(ADM_CTRL_BATCH, json=[{"policy_instance_id": i, "payload": adm_instance_good} for i in ids])
+    assert res.status_code == 200
+
+    # follow the pages
+    pages = []
+    url = ADM_CTRL_POLICIES + "?limit=2"
+    while url:
+        res = client.get(url)
+        assert res.status_code == 200
+        pages.append(res.json)
+        url = res.headers["Link"][1:res.headers["Link"].index(">")] if "Link" in res.headers else None
+    assert pages == [ids[0:2], ids[2:4], ids[4:]]
+
+    # filters
+    res = client.get(ADM_CTRL_POLICIES + "?status=IN EFFECT")
+    assert res.status_code == 200
+    assert res.json == []
+    res = client.get(ADM_CTRL_POLICIES + "?status=NOT IN EFFECT&limit=10")
+    assert res.json == ids
+    res = client.get(ADM_CTRL_POLICIES + "?created_after={0}".format(time.time() + 60))
+    assert res.json == []
+    res = client.get(ADM_CTRL_POLICIES + "?created_before={0}".format(time.time() + 60))
+    assert res.json == ids
+
+    res = client.get(ADM_CTRL_POLICIES + "?cursor=%%%")
+    assert res.status_code == 400
+
+    # the list is streamed; an SDL failure before the first chunk is a 503, a later one aborts the response
+    def failing_after(count):
+        def iter_instance_list(*args):
+            yield from ids[:count]
+            raise NotConnected("lost")
+        return iter_instance_list
+
+    with monkeypatch.context() as m:
+        m.setattr(controller, "LIST_STREAM_CHUNK", 2)
+        m.setattr(data, "iter_instance_list", failing_after(1))
+        res = client.get(ADM_CTRL_POLICIES + "?status=NOT IN EFFECT")
+        assert res.status_code == 503
+        m.setattr(data, "iter_instance_list", failing_after(3))
+        res = client.get(ADM_CTRL_POLICIES + "?status=NOT IN EFFECT")
+        assert res.status_code == 200
+        with pytest.raises(NotConnected):
+            res.get_data()
+
+    # clean up
+    for i in ids[1:]:
+        res = client.delete(ADM_CTRL_POLICIES + "/" + i)
+        assert res.status_code == 202
+    _delete_instance(client)
+    _instance_is_gone(client)
+    _delete_ac_type(client)
+
+
+def test_bulk_status(client, monkeypatch, adm_type_good, adm_instance_good):
+    """
+    get the statuses of many instances at once
+    """
+    _put_ac_type(client, adm_type_good)
+    a1rmr.replace_rcv_func(_fake_dequeue_none)
+    _test_put_patch(monkeypatch)
+
+    ids = [ADM_CTRL_IID, "i1", "i2"]
+    res = client.post(ADM_CTRL_BATCH, json=[{"policy_instance_id": i, "payload": adm_instance_good} for i in ids])
+    assert res.status_code == 200
+
+    # only the first instance goes into effect
+    a1rmr.replace_rcv_func(_fake_dequeue)
+    _verify_instance_and_status(client, adm_instance_good, "IN EFFECT", False)
+
+    res = client.get(ADM_CTRL_POLICIES + ":status")
+    assert res.status_code == 200
+    assert [(s["policy_instance_id"], s["instance_status"], s["has_been_deleted"]) for s in res.json] == [
+        (ADM_CTRL_IID, "IN EFFECT", False),
+        ("i1", "NOT IN EFFECT", False),
+        ("i2", "NOT IN EFFECT", False),
+    ]
+    assert all("created_at" in s for s in res.json)
+
+    # some of them, in the order asked; unknown ids are left out
+    res = client.get(ADM_CTRL_POLICIES + ":status?policy_instance_id=i2&policy_instance_id=darkness&policy_instance_id=" + ADM_CTRL_IID)
+    assert res.status_code == 200
+    assert [s["policy_instance_id"] for s in res.json] == ["i2", ADM_CTRL_IID]
+
+    res = client.get("/a1-p/policytypes/911/policies:status")
+    assert res.status_code == 404
+
+    # an SDL failure before the first chunk is a 503, a later one aborts the response
+    def failing_after(count):
+        def iter_policy_instance_statuses(*args):
+            yield from [{"policy_instance_id": i} for i in ids[:count]]
+            raise NotConnected("lost")
+        return iter_policy_instance_statuses
+
+    with monkeypatch.context() as m:
+        m.setattr(controller, "LIST_STREAM_CHUNK", 2)
+        m.setattr(data, "iter_policy_instance_statuses", failing_after(1))
+        res = client.get(ADM_CTRL_POLICIES + ":status")
+        assert res.status_code == 503
+        m.setattr(data, "iter_policy_instance_statuses", failing_after(3))
+        res = client.get(ADM_CTRL_POLICIES + ":status")
+        assert res.status_code == 200
+        with pytest.raises(NotConnected):
+            res.get_data()
+
+    # clean up
+    a1rmr.replace_rcv_func(_fake_dequeue_none)
+    for i in ids[1:]:
+        res = client.delete(ADM_CTRL_POLICIES + "/" + i)
+        assert res.status_code == 202
+    _delete_instance(client)
+    _instance_is_gone(client)
+    _delete_ac_type(client)
+
+
+def test_conditional_get(client, monkeypatch, adm_type_good, adm_instance_good):
+    """
+    unchanged objects answer 304 to conditional GETs
+    """
+    _put_ac_type(client, adm_type_good)
+    a1rmr.replace_rcv_func(_fake_dequeue_none)
+    _put_ac_instance(client, monkeypatch, adm_instance_good)
+
+    # the type and the instance list
+    for url in (ADM_CTRL_TYPE, ADM_CTRL_POLICIES):
+        res = client.get(url)
+        assert res.status_code == 200
+        res = client.get(url, headers={"If-None-Match": res.headers["ETag"]})
+        assert res.status_code == 304
+    list_etag = res.headers["ETag"]
+
+    # the instance and its status, also by date
+    etags = []
+    for url in (ADM_CTRL_INSTANCE, ADM_CTRL_INSTANCE_STATUS):
+        full = client.get(url)
+        assert full.status_code == 200
+        res = client.get(url, headers={"If-None-Match": full.headers["ETag"]})
+        assert res.status_code == 304
+        res = client.get(url, headers={"If-Modified-Since": full.headers["Last-Modified"]})
+        assert res.status_code == 304
+        etags.append(full.headers["ETag"])
+    instance_etag, status_etag = etags
+
+    # a handler reporting a new status changes the status
+    a1rmr.replace_rcv_func(_fake_dequeue)
+    for _ in range(5):
+        res = client.get(ADM_CTRL_INSTANCE_STATUS, headers={"If-None-Match": status_etag})
+        if res.status_code == 200:
+            break
+        time.sleep(1)
+    assert res.status_code == 200
+    assert res.json["instance_status"] == "IN EFFECT"
+
+    # but repeating it does not
+    time.sleep(2)
+    res = client.get(ADM_CTRL_INSTANCE_STATUS, headers={"If-None-Match": res.headers["ETag"]})
+    assert res.status_code == 304
+
+    # and neither changes the instance, so the instance's tag still matches for writes
+    res = client.get(ADM_CTRL_INSTANCE, headers={"If-None-Match": instance_etag})
+    assert res.status_code == 304
+    res = client.put(ADM_CTRL_INSTANCE, json=adm_instance_good, headers={"If-Match": instance_etag})
+    assert res.status_code == 202
+    res = client.get(ADM_CTRL_INSTANCE, headers={"If-None-Match": instance_etag})
+    assert res.status_code == 200
+
+    # a new instance changes the list
+    res = client.put(ADM_CTRL_POLICIES + "/second_instance", json=adm_instance_good)
+    assert res.status_code == 202
+    res = client.get(ADM_CTRL_POLICIES, headers={"If-None-Match": list_etag})
+    assert res.status_code == 200
+    assert res.json == [ADM_CTRL_IID, "second_instance"]
+
+    # clean up
+    a1rmr.replace_rcv_func(_fake_dequeue_none)
+    res = client.delete(ADM_CTRL_POLICIES + "/second_instance")
+    assert res.status_code == 202
+    _delete_instance(client)
+    _instance_is_gone(client)
+    _delete_ac_type(client)
+
+
+def test_if_match(client, monkeypatch, adm_type_good, adm_instance_good):
+    """
+    writes with If-Match only apply to the version the client read
+    """
+    _put_ac_type(client, adm_type_good)
+    a1rmr.replace_rcv_func(_fake_dequeue_none)
+
+    # there is nothing to match yet
+    res = client.put(ADM_CTRL_INSTANCE, json=adm_instance_good, headers={"If-Match": "*"})
+    assert res.status_code == 412
+
+    _put_ac_instance(client, monkeypatch, adm_instance_good)
+    etag = client.get(ADM_CTRL_INSTANCE).headers["ETag"]
+
+    # the version read can be replaced once; the next write with the same etag is stale
+    res = client.put(ADM_CTRL_INSTANCE, json=adm_instance_good, headers={"If-Match": etag})
+    assert res.status_code == 202
+    res = client.put(ADM_CTRL_INSTANCE, json=adm_instance_good, headers={"If-Match": etag})
+    assert res.status_code == 412
+    res = client.delete(ADM_CTRL_INSTANCE, headers={"If-Match": etag})
+    assert res.status_code == 412
+
+    # clean up, with the current etag
+    etag = client.get(ADM_CTRL_INSTANCE).headers["ETag"]
+    res = client.delete(ADM_CTRL_INSTANCE, headers={"If-Match": etag})
+    assert res.status_code == 202
+    _instance_is_gone(client)
+    _delete_ac_type(client)
+
+
 def test_bad_instances(client, monkeypatch, adm_type_good):
     """
     test various failure modes
@@ -352,7 +646,7 @@ def test_bad_instances(client, monkeypatch, adm_type_good):
 
     # test 503 handlers
 
-    def monkey_set(ns, key, value):
+    def monkey_set(ns, key, value, usemsgpack=True):
         # set a key override function that throws sdl errors on certain keys
         if key == "a1.policy_type.111":
             raise RejectedByBackend()
@@ -400,12 +694,43 @@ def test_healthcheck(client):
     assert res.status_code == 200
 
 
-def test_metrics(client):
+def _metrics_after_put(typedef, instancedef):
     """
-    test Prometheus metrics
+    runs in a process of its own: PUTs an instance, waits for it to be sent and acked, and answers the metrics
     """
-    res = client.get("/a1-p/metrics")
-    assert res.status_code == 200
+    with pytest.MonkeyPatch.context() as m:
+        _test_put_patch(m)
+        data.SDL = metrics.TimedSDL(SDLClient(use_fake_sdl=True))
+        a1rmr.start_rmr_thread(init_func_override=lambda: None, rcv_func_override=_fake_dequeue)
+        try:
+            client = app.app.test_client()
+            _put_ac_type(client, typedef)
+            _put_ac_instance(client, m, instancedef)
+            _verify_instance_and_status(client, instancedef, "IN EFFECT", False)
+            for _ in range(50):
+                res = client.get("/a1-p/metrics")
+                if b"A1RmrSendSeconds_bucket" in res.data:
+                    break
+                time.sleep(0.1)
+            return res.status_code, res.data
+        finally:
+            a1rmr.stop_rmr_thread()
+
+
+def test_metrics(monkeypatch, tmp_path, adm_type_good, adm_instance_good):
+    """
+    test Prometheus metrics, in a fresh process whose metrics directory holds only what its own PUT recorded
+    """
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    monkeypatch.setenv("prometheus_multiproc_dir", str(tmp_path))
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        status_code, body = pool.submit(_metrics_after_put, adm_type_good, adm_instance_good).result(timeout=60)
+    assert status_code == 200
+    # the PUT went through every stage
+    for histogram in (b"A1RequestLatencySeconds", b"A1SdlLatencySeconds", b"A1ValidationSeconds", b"A1RmrSendSeconds", b"A1RmrLoopSeconds"):
+        assert histogram + b"_bucket" in body
+    assert b'A1RequestLatencySeconds_count{operation="create_or_replace_policy_instance"} 2.0' in body
+    assert b'operation="delete_policy_instance"' not in body
 
 
 def teardown_module():
@@ -0,0 +1,574 @@
+"""
+tests for the database functions
+"""
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+import json
+import time
+import pytest
+from a1 import a1rmr, data
+from a1.sdl import SDLClient
+from a1.exceptions import PolicyInstanceConflict, PolicyInstanceNotFound, PolicyTypeNotFound
+
+TYPE_ID = 20000
+
+
+def _type(policy_type_id=TYPE_ID, name="t"):
+    return {"name": name, "description": "", "policy_type_id": policy_type_id, "create_schema": {"type": "object"}}
+
+
+@pytest.fixture(autouse=True)
+def fake_sdl(monkeypatch):
+    """
+    every test starts from an empty fake SDL and cold caches
+    """
+    sdl = SDLClient(use_fake_sdl=True)
+    monkeypatch.setattr(data, "SDL", sdl)
+    monkeypatch.setattr(data, "_type_cache", data._TypeCache(10, 30, 0))
+    monkeypatch.setattr(data, "_query_snapshot", data._QuerySnapshot())
+    monkeypatch.setattr(data, "_type_etags", {})
+    monkeypatch.setattr(data, "_indexes_ready", False)
+    return sdl
+
+
+# Type cache
+
+
+def test_type_cache_lru():
+    """
+    the least recently used type is evicted once the cache is full
+    """
+    cache = data._TypeCache(2, 30, 0)
+    cache.put(1, _type(1))
+    cache.put(2, _type(2))
+    assert cache.get(1) == _type(1)
+    cache.put(3, _type(3))
+    assert cache.get(2) is None
+    assert cache.get(1) == _type(1)
+    assert cache.get(3) == _type(3)
+
+
+def test_type_cache_ttl():
+    """
+    entries expire, and a size or ttl of 0 disables the cache
+    """
+    cache = data._TypeCache(10, 0.05, 0)
+    cache.put(1, _type(1))
+    assert cache.get(1) == _type(1)
+    time.sleep(0.1)
+    assert cache.get(1) is None
+
+    for disabled in (data._TypeCache(0, 30, 0), data._TypeCache(10, 0, 0)):
+        disabled.put(1, _type(1))
+        assert disabled.get(1) is None
+
+
+def test_type_cache_invalidated_on_delete(fake_sdl):
+    """
+    deleting a type drops it from the cache and writes a new generation token
+    """
+    data.store_policy_type(TYPE_ID, _type())
+    assert data._type_cache.get(TYPE_ID) == _type()
+    generation = fake_sdl.get(data.A1NS, data.TYPE_GENERATION_KEY)
+
+    data.delete_policy_type(TYPE_ID)
+    assert data._type_cache.get(TYPE_ID) is None
+    assert fake_sdl.get(data.A1NS, data.TYPE_GENERATION_KEY) != generation
+    with pytest.raises(PolicyTypeNotFound):
+        data.get_policy_type(TYPE_ID)
+
+
+def test_type_etag_dropped_on_delete():
+    """
+    a type deleted and created again gets the entity tag of its new body
+    """
+    data.store_policy_type(TYPE_ID, _type(name="first"))
+    etag = data.get_policy_type_etag(TYPE_ID)
+    assert data.get_policy_type_etag(TYPE_ID) == etag
+
+    data.delete_policy_type(TYPE_ID)
+    assert TYPE_ID not in data._type_etags
+    data.store_policy_type(TYPE_ID, _type(name="second"))
+    assert data.get_policy_type_etag(TYPE_ID) != etag
+
+
+def test_type_cache_generation(monkeypatch):
+    """
+    a replica drops its cached types once another replica bumped the generation token in SDL,
+    so it never serves a type that was deleted, or deleted and created again, elsewhere
+    """
+    data.store_policy_type(TYPE_ID, _type(name="first"))
+    assert data.get_policy_type(TYPE_ID)["name"] == "first"
+
+    # another replica, sharing the SDL but not the cache, deletes the type and creates it again
+    here = data._type_cache
+    monkeypatch.setattr(data, "_type_cache", data._TypeCache(10, 30, 0))
+    data.delete_policy_type(TYPE_ID)
+    data.store_policy_type(TYPE_ID, _type(name="second"))
+    monkeypatch.setattr(data, "_type_cache", here)
+    assert data.get_policy_type(TYPE_ID)["name"] == "second"
+
+    # the token is only read every generation_check seconds
+    lazy = data._TypeCache(10, 30, 60)
+    assert lazy.get(TYPE_ID) is None  # reads the current token
+    lazy.put(TYPE_ID, _type(name="second"))
+    assert lazy.get(TYPE_ID)["name"] == "second"
+    data.SDL.set(data.A1NS, data.TYPE_GENERATION_KEY, "bumped elsewhere")
+    assert lazy.get(TYPE_ID)["name"] == "second"
+    lazy.generation_check = 0
+    assert lazy.get(TYPE_ID) is None
+
+
+# Index sets
+
+
+def test_rebuild_indexes(fake_sdl, monkeypatch):
+    """
+    a database written before the index sets gets them at startup, listing each key prefix only once
+    """
+    for policy_type_id in (TYPE_ID, TYPE_ID + 1):
+        fake_sdl.set(data.A1NS, data._generate_type_key(policy_type_id), _type(policy_type_id))
+    for policy_instance_id in ("a", "a.b", "c"):
+        fake_sdl.set(data.A1NS, data._generate_instance_key(TYPE_ID, policy_instance_id), {})
+        fake_sdl.set(data.A1NS, data._generate_instance_metadata_key(TYPE_ID, policy_instance_id), {"created_at": 1, "has_been_deleted": False})
+    fake_sdl.set(data.A1NS, data._generate_handler_key(TYPE_ID, "a", "x"), "OK")
+    fake_sdl.set(data.A1NS, data._generate_handler_key(TYPE_ID, "a.b", "y.z"), "ERROR")
+    # an instance of a type that is gone, and a handler of an instance that is gone
+    fake_sdl.set(data.A1NS, data._generate_instance_key(TYPE_ID + 2, "d"), {})
+    fake_sdl.set(data.A1NS, data._generate_handler_key(TYPE_ID, "e", "x"), "OK")
+
+    # the values are already in the configured encoding
+    fake_sdl.set(data.A1NS, data.VALUE_CODEC_KEY, data._codec.name)
+    listed = []
+    find_keys = fake_sdl.find_keys
+    monkeypatch.setattr(fake_sdl, "find_keys", lambda ns, prefix: listed.append(prefix) or find_keys(ns, prefix))
+    data.prepare_database()
+    assert len(listed) == 3
+
+    assert data.get_type_list() == [TYPE_ID, TYPE_ID + 1]
+    assert data.get_instance_list(TYPE_ID) == ["a", "a.b", "c"]
+    assert data.get_instance_list(TYPE_ID + 1) == []
+    assert fake_sdl.get_members(data.A1NS, data._generate_handler_set(TYPE_ID, "a")) == {"x"}
+    assert fake_sdl.get_members(data.A1NS, data._generate_handler_set(TYPE_ID, "a.b")) == {"y.z"}
+    assert data.get_policy_instance_status(TYPE_ID, "a.b")["instance_status"] == "NOT IN EFFECT"
+
+    # once built, they are not built again
+    data._indexes_ready = False
+    data.prepare_database()
+    assert len(listed) == 3
+
+
+# Writes
+
+
+def _count_calls(monkeypatch, sdl, *names):
+    calls = dict.fromkeys(names, 0)
+    for name in names:
+        method = getattr(sdl, name)
+
+        def counted(*args, name=name, method=method, **kwargs):
+            calls[name] += 1
+            return method(*args, **kwargs)
+
+        monkeypatch.setattr(sdl, name, counted)
+    return calls
+
+
+def _replace_metadata(sdl, policy_instance_id, **changes):
+    """
+    what another writer does: replace the metadata of an instance
+    """
+    key = data._generate_instance_metadata_key(TYPE_ID, policy_instance_id)
+    sdl.set(data.A1NS, key, data._codec.encode(dict(data._get(key), **changes)), usemsgpack=False)
+
+
+def test_store_instances_without_if_match(fake_sdl, monkeypatch):
+    """
+    a batch without If-Match costs the same few round trips whatever its size, and never compares-and-swaps
+    """
+    data.store_policy_type(TYPE_ID, _type())
+    data.prepare_database()
+    calls = _count_calls(monkeypatch, fake_sdl, "get_many", "set_many", "set_if", "set_if_not_exists", "add_members", "set")
+    operations = data.store_policy_instances(TYPE_ID, {str(i): {"x": i} for i in range(200)})
+    assert set(operations.values()) == {"CREATE"}
+    assert calls == {"get_many": 2, "set_many": 1, "set_if": 0, "set_if_not_exists": 0, "add_members": 1, "set": 1}
+    assert len(data.get_instance_list(TYPE_ID)) == 200
+    assert data.get_policy_instance(TYPE_ID, "199") == {"x": 199}
+
+
+def test_store_instances_contended(fake_sdl, monkeypatch):
+    """
+    an instance another writer changed while a batch was written is written again with compare-and-swap,
+    with a version after the other write; if the other writers never stop, only that instance is given up
+    """
+    data.store_policy_type(TYPE_ID, _type())
+    data.store_policy_instances(TYPE_ID, {"a": {"x": 1}, "b": {"x": 1}})
+
+    set_many = fake_sdl.set_many
+
+    def meddling_set_many(ns, values):
+        set_many(ns, values)
+        _replace_metadata(fake_sdl, "b", version=10)
+
+    monkeypatch.setattr(fake_sdl, "set_many", meddling_set_many)
+    assert data.store_policy_instances(TYPE_ID, {"a": {"x": 2}, "b": {"x": 2}, "c": {"x": 2}}) == {"a": "UPDATE", "b": "UPDATE", "c": "CREATE"}
+    assert data.get_policy_instances(TYPE_ID, ["a", "b", "c"]) == {"a": {"x": 2}, "b": {"x": 2}, "c": {"x": 2}}
+    assert data._get(data._generate_instance_metadata_key(TYPE_ID, "b"))["version"] == 11
+
+    set_if = fake_sdl.set_if
+
+    def losing_set_if(ns, key, old_value, new_value, usemsgpack=True):
+        if key == data._generate_instance_metadata_key(TYPE_ID, "d"):
+            return False
+        return set_if(ns, key, old_value, new_value, usemsgpack)
+
+    monkeypatch.setattr(fake_sdl, "set_many", lambda ns, values: (set_many(ns, values), _replace_metadata(fake_sdl, "d", version=10)))
+    monkeypatch.setattr(fake_sdl, "set_if", losing_set_if)
+    etag = data.get_instance_list_etag(TYPE_ID)
+    assert data.store_policy_instances(TYPE_ID, {"d": {"x": 3}, "e": {"x": 3}}) == {"e": "CREATE"}
+    assert data.get_instance_list(TYPE_ID) == ["a", "b", "c", "e"]
+    assert data.get_instance_list_etag(TYPE_ID) != etag
+    with pytest.raises(PolicyInstanceConflict):
+        data.store_policy_instance(TYPE_ID, "d", {"x": 4})
+
+
+# Statuses
+
+
+def _handler_status(policy_instance_id, handler_id):
+    return data._get(data._generate_handler_key(TYPE_ID, policy_instance_id, handler_id))
+
+
+def test_set_statuses(fake_sdl, monkeypatch):
+    """
+    a batch of statuses is written with one multi-set; the last status of a handler wins, statuses of
+    unknown or malformed instances are answered as rejected, and repeated statuses change nothing
+    """
+    data.store_policy_type(TYPE_ID, _type())
+    data.store_policy_instances(TYPE_ID, {"a": {"x": 1}, "b": {"x": 1}})
+    data.prepare_database()
+    calls = _count_calls(monkeypatch, fake_sdl, "set_many", "set", "set_if")
+
+    unknown_instance = (TYPE_ID, "z", "h1", "OK")
+    unknown_type = (TYPE_ID + 1, "a", "h1", "OK")
+    unhashable = (TYPE_ID, ["a"], "h1", "OK")
+    statuses = [
+        (TYPE_ID, "a", "h1", "ERROR"),
+        unknown_instance,
+        (TYPE_ID, "a", "h2", "ERROR"),
+        (TYPE_ID, "a", "h1", "OK"),
+        unhashable,
+        (TYPE_ID, "b", "h1", "ERROR"),
+        unknown_type,
+    ]
+    assert data.set_policy_instance_statuses(statuses) == [unhashable, unknown_instance, unknown_type]
+    assert calls == {"set_many": 1, "set": 0, "set_if": 2}
+    assert (_handler_status("a", "h1"), _handler_status("a", "h2"), _handler_status("b", "h1")) == ("OK", "ERROR", "ERROR")
+    assert data.get_policy_instance_status(TYPE_ID, "a")["instance_status"] == "IN EFFECT"
+    assert data.get_policy_instance_status(TYPE_ID, "b")["instance_status"] == "NOT IN EFFECT"
+    assert fake_sdl.get_members(data.A1NS, data._generate_handler_set(TYPE_ID, "a")) == {"h1", "h2"}
+    assert _handler_status("z", "h1") is None
+
+    # handlers repeat themselves; that writes nothing, and leaves the status etag alone
+    etag = data.get_policy_instance_status_version(TYPE_ID, "a")
+    assert data.set_policy_instance_statuses([(TYPE_ID, "a", "h1", "OK"), (TYPE_ID, "a", "h2", "ERROR")]) == []
+    assert calls == {"set_many": 1, "set": 0, "set_if": 2}
+    assert data.get_policy_instance_status_version(TYPE_ID, "a") == etag
+
+
+def _aggregate(policy_instance_id):
+    metadata = data._get(data._generate_instance_metadata_key(TYPE_ID, policy_instance_id))
+    return data._get_aggregate(TYPE_ID, policy_instance_id, metadata)
+
+
+def _report(policy_instance_id, **statuses):
+    data.set_policy_instance_statuses([(TYPE_ID, policy_instance_id, h, status) for h, status in statuses.items()])
+
+
+def test_status_aggregate(fake_sdl):
+    """
+    the metadata counts the handlers that reported, and those that reported OK, through status changes;
+    replacing the instance starts over
+    """
+    data.store_policy_type(TYPE_ID, _type())
+    data.store_policy_instance(TYPE_ID, "a", {"x": 1})
+    assert _aggregate("a") == (0, 0)
+    _report("a", h1="OK", h2="ERROR")
+    assert _aggregate("a") == (1, 2)
+    _report("a", h1="ERROR")
+    assert _aggregate("a") == (0, 2)
+    assert data.get_policy_instance_status(TYPE_ID, "a")["instance_status"] == "NOT IN EFFECT"
+    _report("a", h1="OK", h2="OK")
+    assert _aggregate("a") == (2, 2)
+    assert data.get_policy_instance_status(TYPE_ID, "a")["instance_status"] == "IN EFFECT"
+
+    data.store_policy_instance(TYPE_ID, "a", {"x": 2})
+    assert _aggregate("a") == (0, 0)
+    assert data.get_policy_instance_status(TYPE_ID, "a")["instance_status"] == "NOT IN EFFECT"
+    _report("a", h1="ERROR")
+    assert _aggregate("a") == (0, 1)
+
+
+def test_status_aggregate_legacy(fake_sdl):
+    """
+    metadata written before it held the counts has them counted from the handler statuses, and gets them on the next status
+    """
+    data.store_policy_type(TYPE_ID, _type())
+    data.store_policy_instance(TYPE_ID, "a", {"x": 1})
+    _report("a", h1="OK", h2="ERROR")
+    key = data._generate_instance_metadata_key(TYPE_ID, "a")
+    legacy = {k: v for k, v in data._get(key).items() if k not in ("handlers_ok", "handlers_total")}
+    fake_sdl.set(data.A1NS, key, data._codec.encode(legacy), usemsgpack=False)
+    assert _aggregate("a") == (1, 2)
+    assert data.get_policy_instance_status(TYPE_ID, "a")["instance_status"] == "IN EFFECT"
+
+    _report("a", h2="OK")
+    assert (data._get(key)["handlers_ok"], data._get(key)["handlers_total"]) == (2, 2)
+
+
+def test_status_aggregate_recounted(fake_sdl, monkeypatch):
+    """
+    when another replica records a status of the same instance meanwhile, the counts are taken again from all statuses
+    """
+    data.store_policy_type(TYPE_ID, _type())
+    data.store_policy_instance(TYPE_ID, "a", {"x": 1})
+    _report("a", h1="OK")
+    key = data._generate_instance_metadata_key(TYPE_ID, "a")
+    set_if = fake_sdl.set_if
+    lost = []
+
+    def racing_set_if(ns, k, old_value, new_value, usemsgpack=True):
+        if k == key and not lost:
+            # the other replica writes h3 and its counts first
+            lost.append(k)
+            fake_sdl.set(data.A1NS, data._generate_handler_key(TYPE_ID, "a", "h3"), data._codec.encode("OK"), usemsgpack=False)
+            fake_sdl.add_member(data.A1NS, data._generate_handler_set(TYPE_ID, "a"), "h3")
+            _replace_metadata(fake_sdl, "a", handlers_ok=2, handlers_total=2, version=data._get(key)["version"] + 1)
+        return set_if(ns, k, old_value, new_value, usemsgpack)
+
+    monkeypatch.setattr(fake_sdl, "set_if", racing_set_if)
+    _report("a", h2="ERROR")
+    assert lost
+    assert _aggregate("a") == (2, 3)
+
+
+def test_record_statuses(monkeypatch):
+    """
+    the rmr loop records a batch of statuses and logs the rejected ones
+    """
+    data.store_policy_type(TYPE_ID, _type())
+    data.store_policy_instance(TYPE_ID, "a", {"x": 1})
+    warnings = []
+    monkeypatch.setattr(a1rmr.mdc_logger, "warning", lambda msg, *args, **kwargs: warnings.append(args))
+
+    rmr_loop = a1rmr._RmrLoop(init_func_override=lambda: None, rcv_func_override=lambda: [], run_in_thread=False)
+    try:
+        rmr_loop.record_statuses([(TYPE_ID, "a", "h1", "OK"), (TYPE_ID, "gone", "h1", "OK")])
+    finally:
+        rmr_loop.stop()
+    assert _handler_status("a", "h1") == "OK"
+    assert warnings == [((TYPE_ID, "gone", "h1", "OK"),)]
+
+
+# Policy queries
+
+
+def test_query_snapshot(fake_sdl, instances, monkeypatch):
+    """
+    the messages answering a policy query are built once, and again only for instances whose stored
+    bytes changed, whoever changed them; deleting the type drops what is left
+    """
+    built = []
+    to_bytes = data.messages.a1_to_handler_bytes
+    monkeypatch.setattr(data.messages, "a1_to_handler_bytes", lambda *args: built.append(args[2]) or to_bytes(*args))
+
+    payloads = data.get_policy_query_payloads(TYPE_ID)
+    assert [json.loads(p)["payload"] for p in payloads] == [{"x": 1}, {"x": 2}]
+    again = data.get_policy_query_payloads(TYPE_ID)
+    assert all(p is q for p, q in zip(payloads, again))
+    assert built == ["a", "b"]
+
+    # another replica changes b, so our snapshot is not told
+    key = data._generate_instance_key(TYPE_ID, "b")
+    fake_sdl.set(data.A1NS, key, data._codec.encode({"x": 4}), usemsgpack=False)
+    payloads = data.get_policy_query_payloads(TYPE_ID)
+    assert [json.loads(p)["payload"] for p in payloads] == [{"x": 1}, {"x": 4}]
+    assert built == ["a", "b", "b"]
+    # we change a
+    data.store_policy_instance(TYPE_ID, "a", {"x": 3})
+    assert [json.loads(p)["payload"] for p in data.get_policy_query_payloads(TYPE_ID)] == [{"x": 3}, {"x": 4}]
+    assert built == ["a", "b", "b", "a"]
+
+    # a query racing the last deletion may leave an entry behind; it goes with the type
+    for pii in ("a", "b"):
+        data.delete_policy_instance(TYPE_ID, pii)
+    assert _wait_until(lambda: data.get_instance_list(TYPE_ID) == [])
+    data._query_snapshot.put(TYPE_ID, "a", b"packed", b"payload")
+    data.delete_policy_type(TYPE_ID)
+    assert data._query_snapshot.get(TYPE_ID, "a", b"packed") is None
+
+
+# Deletions
+
+
+def _wait_until(condition, seconds=5):
+    deadline = time.time() + seconds
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def _instance_exists(policy_instance_id):
+    return data.SDL.get(data.A1NS, data._generate_instance_key(TYPE_ID, policy_instance_id), usemsgpack=False) is not None
+
+
+@pytest.fixture
+def instances(monkeypatch):
+    """
+    a type with instances a and b, a scheduler of our own and no delete delay
+    """
+    monkeypatch.setattr(data, "_deletion_scheduler", data._DeletionScheduler())
+    monkeypatch.setattr(data, "INSTANCE_DELETE_NO_RESP_TTL", 0)
+    monkeypatch.setattr(data, "INSTANCE_DELETE_RESP_TTL", 0)
+    data.store_policy_type(TYPE_ID, _type())
+    data.store_policy_instances(TYPE_ID, {"a": {"x": 1}, "b": {"x": 2}})
+    return data._deletion_scheduler
+
+
+def test_deletion_scheduler(instances, monkeypatch):
+    """
+    deleted instances are gone once their timer expires; a deletion that fails unexpectedly is retried,
+    up to a limit, and does not hold up the others
+    """
+    monkeypatch.setattr(data, "INSTANCE_DELETE_RETRY_DELAY", 0.05)
+    monkeypatch.setattr(data, "INSTANCE_DELETE_MAX_ERRORS", 3)
+    delete_now = data._delete_now
+    attempts = []
+
+    def broken(policy_type_id, policy_instance_id, times):
+        attempts.append(policy_instance_id)
+        if attempts.count(policy_instance_id) <= times.get(policy_instance_id, 0):
+            raise TypeError("broken")
+        delete_now(policy_type_id, policy_instance_id)
+
+    # a fails twice, then goes; b goes right away
+    monkeypatch.setattr(data, "_delete_now", lambda *ids: broken(*ids, times={"a": 2}))
+    data.delete_policy_instance(TYPE_ID, "a")
+    data.delete_policy_instance(TYPE_ID, "b")
+    assert _wait_until(lambda: not _instance_exists("a") and not _instance_exists("b"))
+    assert attempts.count("a") == 3
+    assert data.get_instance_list(TYPE_ID) == []
+
+    # c always fails; it is given up after the limit, and stays marked deleted for the next start
+    data.store_policy_instance(TYPE_ID, "c", {"x": 3})
+    attempts.clear()
+    monkeypatch.setattr(data, "_delete_now", lambda *ids: broken(*ids, times={"c": 100}))
+    data.delete_policy_instance(TYPE_ID, "c")
+    assert _wait_until(lambda: attempts.count("c") == 3 and instances.pending() == 0)
+    time.sleep(0.2)
+    assert attempts.count("c") == 3
+    assert data.get_policy_instance_status(TYPE_ID, "c")["has_been_deleted"]
+
+
+def test_deletion_skips_recreated_instance(instances, monkeypatch):
+    """
+    an instance created again while its delete timer ran is left alone when the timer expires
+    """
+    monkeypatch.setattr(data, "INSTANCE_DELETE_NO_RESP_TTL", 3600)
+    data.delete_policy_instance(TYPE_ID, "a")
+    data.store_policy_instance(TYPE_ID, "a", {"x": 3})
+    data._delete_now(TYPE_ID, "a")
+    assert data.get_policy_instance(TYPE_ID, "a") == {"x": 3}
+    assert data.get_instance_list(TYPE_ID) == ["a", "b"]
+    assert not data.get_policy_instance_status(TYPE_ID, "a")["has_been_deleted"]
+
+
+@pytest.mark.parametrize("at", [0, 1])
+@pytest.mark.parametrize("body", [{"x": 1}, {"x": 3}])
+def test_deletion_races_write(instances, monkeypatch, at, body):
+    """
+    an instance written while it is deleted, before the body or before the metadata is deleted,
+    survives with the body of that write, even when it is the same as the deleted one
+    """
+    monkeypatch.setattr(data, "INSTANCE_DELETE_NO_RESP_TTL", 3600)
+    data.delete_policy_instance(TYPE_ID, "a")
+    delete_if = data.SDL.delete_if
+    deletes = []
+
+    def racing_delete_if(ns, key, value, usemsgpack=True):
+        if len(deletes) == at:
+            data.store_policy_instance(TYPE_ID, "a", body)
+        deletes.append(key)
+        return delete_if(ns, key, value, usemsgpack)
+
+    monkeypatch.setattr(data.SDL, "delete_if", racing_delete_if)
+    data._delete_now(TYPE_ID, "a")
+    monkeypatch.setattr(data.SDL, "delete_if", delete_if)
+    assert deletes[0] == data._generate_instance_key(TYPE_ID, "a")
+    assert data.get_policy_instance(TYPE_ID, "a") == body
+    assert data.get_instance_list(TYPE_ID) == ["a", "b"]
+    assert not data.get_policy_instance_status(TYPE_ID, "a")["has_been_deleted"]
+
+    monkeypatch.setattr(data, "INSTANCE_DELETE_NO_RESP_TTL", 0)
+    data.delete_policy_instance(TYPE_ID, "a")
+    assert _wait_until(lambda: data.get_instance_list(TYPE_ID) == ["b"])
+
+
+def test_deletion_stopped_half_way(instances, monkeypatch):
+    """
+    metadata left without a body is deleted: when its deletion is found stopped, or on request
+    """
+    monkeypatch.setattr(data, "INSTANCE_DELETE_NO_RESP_TTL", 3600)
+    data.delete_policy_instance(TYPE_ID, "a")
+    for pii in ("a", "b"):
+        data.SDL.delete(data.A1NS, data._generate_instance_key(TYPE_ID, pii))
+
+    monkeypatch.setattr(data, "INSTANCE_DELETE_NO_RESP_TTL", 0)
+    with pytest.raises(PolicyInstanceNotFound):
+        data.get_policy_instance(TYPE_ID, "a")
+    assert _wait_until(lambda: data.get_instance_list(TYPE_ID) == ["b"])
+
+    # b is not marked deleted, it may be being created; it is only deleted when asked to
+    with pytest.raises(PolicyInstanceNotFound):
+        data.get_policy_instance(TYPE_ID, "b")
+    time.sleep(0.1)
+    assert data.get_instance_list(TYPE_ID) == ["b"]
+    data.delete_policy_instance(TYPE_ID, "b")
+    assert _wait_until(lambda: data.get_instance_list(TYPE_ID) == [])
+    with pytest.raises(PolicyInstanceNotFound):
+        data.get_policy_instance_status(TYPE_ID, "b")
+
+
+def test_resume_pending_deletions(instances, monkeypatch):
+    """
+    after a restart, instances that were marked deleted are scheduled again, for what is left of their timers
+    """
+    monkeypatch.setattr(data, "INSTANCE_DELETE_NO_RESP_TTL", 3600)
+    data.delete_policy_instance(TYPE_ID, "a")
+
+    # a new process, with an empty scheduler
+    restarted = data._DeletionScheduler()
+    monkeypatch.setattr(data, "_deletion_scheduler", restarted)
+    assert data.resume_pending_deletions() == 1
+    assert restarted.pending() == 1
+    assert _instance_exists("a")
+
+    monkeypatch.setattr(data, "INSTANCE_DELETE_NO_RESP_TTL", 0)
+    assert data.resume_pending_deletions() == 1
+    assert _wait_until(lambda: not _instance_exists("a"))
+    assert data.get_instance_list(TYPE_ID) == ["b"]
+    assert data.resume_pending_deletions() == 0
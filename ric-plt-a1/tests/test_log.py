@@ -0,0 +1,54 @@
+"""
+tests for lazy and rate limited logging
+"""
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+import json
+from mdclogpy import Logger, Level
+from a1 import log
+
+
+class _CapturingLogger(Logger):
+    def __init__(self):
+        super().__init__(level=Level.WARNING)
+        self.lines = []
+
+    def _output_log(self, line):
+        self.lines.append(json.loads(line)["msg"])
+
+
+def test_log_rate_limit(monkeypatch):
+    """
+    a storm of warnings with the same key is cut to the budget, disabled levels are never formatted
+    """
+    monkeypatch.setattr(log, "LOG_RATE_LIMIT", 3)
+    logger = _CapturingLogger()
+    mdc_logger = log.LazyLogger(logger=logger)
+
+    def explode():
+        raise AssertionError("formatted a disabled message")
+
+    mdc_logger.debug("summary {0}", log.lazy(explode))
+    for i in range(100):
+        mdc_logger.warning("Dropping malformed message: {0}", i, key="malformed")
+    mdc_logger.warning("other {0}", "key", key="other")
+    assert logger.lines == ["Dropping malformed message: 0", "Dropping malformed message: 1", "Dropping malformed message: 2", "other key"]
+
+    # a new window starts with the count of what was suppressed
+    monkeypatch.setattr(log, "LOG_RATE_WINDOW", 0)
+    mdc_logger.warning("Dropping malformed message: {0}", 100, key="malformed")
+    assert logger.lines[-1] == "Dropping malformed message: 100 (97 similar messages suppressed)"
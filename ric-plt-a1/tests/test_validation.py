@@ -0,0 +1,105 @@
+"""
+tests for the compiled validator cache
+"""
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+import pytest
+from jsonschema.exceptions import ValidationError
+from a1 import data, validation
+from a1.sdl import SDLClient
+
+TYPE_ID = 20003
+SCHEMA = {"type": "object", "properties": {"threshold": {"type": "integer"}}, "required": ["threshold"]}
+
+
+@pytest.fixture(autouse=True)
+def compiled(monkeypatch):
+    """
+    an empty validator cache, counting compilations
+    """
+    monkeypatch.setattr(validation, "_validators", {})
+    schemas = []
+    compile_ = validation._compile
+    monkeypatch.setattr(validation, "_compile", lambda schema: schemas.append(schema) or compile_(schema))
+    return schemas
+
+
+def test_validator_reused(compiled):
+    """
+    a type's validator is compiled once, and again only when its schema changes
+    """
+    validation.validate_instance(TYPE_ID, SCHEMA, {"threshold": 1})
+    validation.validate_instance(TYPE_ID, SCHEMA, {"threshold": 2})
+    # an equal schema read again from SDL is found by its hash
+    validation.validate_instance(TYPE_ID, dict(SCHEMA), {"threshold": 3})
+    assert len(compiled) == 1
+    with pytest.raises(ValidationError):
+        validation.validate_instance(TYPE_ID, SCHEMA, {"threshold": "high"})
+
+    # the type was deleted and created again with another schema
+    changed = dict(SCHEMA, required=[])
+    validation.validate_instance(TYPE_ID, changed, {})
+    assert compiled == [SCHEMA, changed]
+    with pytest.raises(ValidationError):
+        validation.validate_instance(TYPE_ID, SCHEMA, {})
+    assert len(compiled) == 3
+
+
+def test_validator_evicted_on_type_delete(client, monkeypatch):
+    """
+    deleting a type drops its validator
+    """
+    monkeypatch.setattr(data, "SDL", SDLClient(use_fake_sdl=True))
+    monkeypatch.setattr(data, "_type_cache", data._TypeCache(10, 30, 0))
+    monkeypatch.setattr(data, "_indexes_ready", False)
+    data.store_policy_type(TYPE_ID, {"name": "t", "description": "", "policy_type_id": TYPE_ID, "create_schema": SCHEMA})
+    validation.validate_instance(TYPE_ID, SCHEMA, {"threshold": 1})
+    assert TYPE_ID in validation._validators
+
+    res = client.delete("/a1-p/policytypes/{0}".format(TYPE_ID))
+    assert res.status_code == 204
+    assert TYPE_ID not in validation._validators
+
+
+def test_fast_validator_fallback(monkeypatch):
+    """
+    jsonschema validates when fastjsonschema is not installed, or cannot compile the schema
+    """
+    monkeypatch.setattr(validation, "USE_FAST_VALIDATOR", True)
+
+    def not_installed(schema):
+        raise AssertionError("used fastjsonschema although it is not installed")
+
+    with monkeypatch.context() as m:
+        m.setattr(validation, "fastjsonschema", None)
+        m.setattr(validation, "_compile_fast", not_installed)
+        with pytest.raises(ValidationError):
+            validation.validate_instance(TYPE_ID, SCHEMA, {})
+
+    fastjsonschema = pytest.importorskip("fastjsonschema")
+
+    def rejects(schema):
+        raise fastjsonschema.JsonSchemaDefinitionException("unsupported")
+
+    monkeypatch.setattr(validation, "_validators", {})
+    monkeypatch.setattr(fastjsonschema, "compile", rejects)
+    assert validation._compile_fast(SCHEMA) is None
+    validation.validate_instance(TYPE_ID, SCHEMA, {"threshold": 1})
+    with pytest.raises(ValidationError) as exc:
+        validation.validate_instance(TYPE_ID, SCHEMA, {})
+    # a jsonschema error, with its path and validator, not one made from a fastjsonschema message
+    assert exc.value.validator == "required"
@@ -0,0 +1,86 @@
+"""
+smoke test for the multi-worker mode
+"""
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+import os
+import socket
+import time
+from threading import Thread
+import requests
+from a1 import a1rmr, workers
+
+TYPE_ID = 20002
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until(condition, seconds=30):
+    deadline = time.time() + seconds
+    while not condition() and time.time() < deadline:
+        time.sleep(0.1)
+    return condition()
+
+
+def _get(url):
+    try:
+        return requests.get(url, timeout=1).status_code
+    except requests.ConnectionError:
+        return None
+
+
+def test_worker_put_reaches_master(monkeypatch, adm_type_good, adm_instance_good):
+    """
+    an instance PUT to a spawned http worker is forwarded to, and sent by, the rmr loop of the master process
+    """
+    # the worker has its own in memory SDL; with one worker that is all the test needs
+    monkeypatch.setenv("USE_FAKE_SDL", "True")
+    monkeypatch.setattr(a1rmr, "__RMR_LOOP__", None)
+    sent = []
+    monkeypatch.setattr(a1rmr._RmrLoop, "_handle_send", lambda rmr_loop, kind, work_item: sent.append((os.getpid(), rmr_loop, kind, work_item)))
+    a1rmr.start_rmr_thread(init_func_override=lambda: None, rcv_func_override=lambda: [])
+
+    port = _free_port()
+    master = workers._Master(port, 1)
+    proc = master._spawn()
+    Thread(target=workers._forward, args=(master.channel, master.heartbeat, master.stopped), daemon=True).start()
+    base = "http://127.0.0.1:{0}/a1-p".format(port)
+    try:
+        # the worker is healthy once it serves and has seen the master's heartbeat
+        assert _wait_until(lambda: _get(base + "/healthcheck") == 200)
+
+        adm_type_good["policy_type_id"] = TYPE_ID
+        assert requests.put("{0}/policytypes/{1}".format(base, TYPE_ID), json=adm_type_good).status_code == 201
+        res = requests.put("{0}/policytypes/{1}/policies/smoke".format(base, TYPE_ID), json=adm_instance_good)
+        assert res.status_code == 202
+
+        assert _wait_until(lambda: sent, 10)
+        pid, rmr_loop, kind, work_item = sent[0]
+        assert pid == os.getpid() != proc.pid
+        assert rmr_loop is a1rmr.__RMR_LOOP__
+        assert kind == a1rmr.POLICY_WORK
+        assert work_item[:3] == ("CREATE", TYPE_ID, "smoke")
+    finally:
+        master.stopped.set()
+        proc.terminate()
+        proc.join(5)
+        master.listener.close()
+        a1rmr.stop_rmr_thread()